@@ -26,8 +26,12 @@ target_metadata = None
 # my_important_option = config.get_main_option("my_important_option")
 # ... etc.
 
-from app import app
-app_config = app.config
+from database import create_base_app
+app_config = create_base_app().config
+# alembic -x city=springfield upgrade head migrates one of CITIES instead.
+city = context.get_x_argument(as_dictionary=True).get('city')
+if city:
+    app_config = app_config['CITIES'][city]
 config.set_main_option('sqlalchemy.url', app_config.get('SQLALCHEMY_DATABASE_URI'))
 
 def run_migrations_offline():
@@ -0,0 +1,30 @@
+"""add dispatch aggregates to address_summaries
+
+Revision ID: 1d3f8e6b7c25
+Revises: 51d7c3b2a9e0
+Create Date: 2026-10-19 11:48:05.927731
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1d3f8e6b7c25'
+down_revision = '51d7c3b2a9e0'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('address_summaries', sa.Column('fire_dispatch_count', sa.Integer, server_default='0'))
+    op.add_column('address_summaries', sa.Column('fire_unit_seconds', sa.Integer, server_default='0'))
+    op.add_column('address_summaries', sa.Column('fire_response_p50', sa.Integer))
+    op.add_column('address_summaries', sa.Column('fire_response_p90', sa.Integer))
+    op.add_column('address_summaries', sa.Column('fire_response_digest', sa.Text))
+
+
+def downgrade():
+    op.drop_column('address_summaries', 'fire_response_digest')
+    op.drop_column('address_summaries', 'fire_response_p90')
+    op.drop_column('address_summaries', 'fire_response_p50')
+    op.drop_column('address_summaries', 'fire_unit_seconds')
+    op.drop_column('address_summaries', 'fire_dispatch_count')
@@ -0,0 +1,24 @@
+"""add coordinates to address_summaries
+
+Revision ID: 2c9a6d1e8f43
+Revises: 3f232866635a
+Create Date: 2026-10-19 10:12:41.503112
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2c9a6d1e8f43'
+down_revision = '3f232866635a'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('address_summaries', sa.Column('x_coordinate', sa.Float))
+    op.add_column('address_summaries', sa.Column('y_coordinate', sa.Float))
+
+
+def downgrade():
+    op.drop_column('address_summaries', 'y_coordinate')
+    op.drop_column('address_summaries', 'x_coordinate')
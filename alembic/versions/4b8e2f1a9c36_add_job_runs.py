@@ -0,0 +1,34 @@
+"""add job_runs
+
+Revision ID: 4b8e2f1a9c36
+Revises: 1d3f8e6b7c25
+Create Date: 2026-10-19 15:21:40.118372
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4b8e2f1a9c36'
+down_revision = '1d3f8e6b7c25'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'job_runs',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('job_name', sa.String(50), nullable=False),
+        sa.Column('status', sa.String(10), nullable=False),
+        sa.Column('started_at', sa.DateTime(timezone=True)),
+        sa.Column('finished_at', sa.DateTime(timezone=True)),
+        sa.Column('duration_seconds', sa.Float),
+        sa.Column('peak_memory_kb', sa.Integer),
+        sa.Column('phases', sa.Text),
+        sa.Column('error', sa.Text))
+    op.create_index('ix_job_runs_job_name', 'job_runs', ['job_name'])
+
+
+def downgrade():
+    op.drop_index('ix_job_runs_job_name', 'job_runs')
+    op.drop_table('job_runs')
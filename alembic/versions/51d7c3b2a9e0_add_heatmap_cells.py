@@ -0,0 +1,29 @@
+"""add heatmap_cells
+
+Revision ID: 51d7c3b2a9e0
+Revises: 2c9a6d1e8f43
+Create Date: 2026-10-19 11:02:17.664218
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '51d7c3b2a9e0'
+down_revision = '2c9a6d1e8f43'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'heatmap_cells',
+        sa.Column('department', sa.String(10), primary_key=True),
+        sa.Column('days', sa.Integer, primary_key=True),
+        sa.Column('level', sa.Integer, primary_key=True),
+        sa.Column('cell_x', sa.Integer, primary_key=True),
+        sa.Column('cell_y', sa.Integer, primary_key=True),
+        sa.Column('count', sa.Integer, nullable=False))
+
+
+def downgrade():
+    op.drop_table('heatmap_cells')
@@ -0,0 +1,28 @@
+"""unique police_incidents.cad_call_number
+
+Revision ID: 5e07a4c2d913
+Revises: 4b8e2f1a9c36
+Create Date: 2026-10-19 16:04:52.381907
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5e07a4c2d913'
+down_revision = '4b8e2f1a9c36'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Keep one row per CAD call before the index makes duplicates impossible.
+    op.execute('''
+        DELETE FROM police_incidents duplicate
+        USING police_incidents kept
+        WHERE duplicate.cad_call_number = kept.cad_call_number
+          AND duplicate.ctid < kept.ctid''')
+    op.create_index('ix_police_incidents_cad_call_number', 'police_incidents', ['cad_call_number'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_police_incidents_cad_call_number', 'police_incidents')
@@ -0,0 +1,25 @@
+"""add address_details
+
+Revision ID: 6a1f3c8d2b57
+Revises: 5e07a4c2d913
+Create Date: 2026-10-19 18:02:11.406233
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6a1f3c8d2b57'
+down_revision = '5e07a4c2d913'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'address_details',
+        sa.Column('address', sa.String(50), primary_key=True),
+        sa.Column('detail', sa.Text, nullable=False))
+
+
+def downgrade():
+    op.drop_table('address_details')
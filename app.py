@@ -1,60 +1,99 @@
 import datetime
 from datetime import timedelta
-import os
+import csv
+import json
+from cStringIO import StringIO
 import operator
 import pytz
 import logging
-import sqlalchemy.exc
+import time
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import make_transient_to_detached
 from logging.handlers import RotatingFileHandler
 
-from flask import Flask, render_template, abort, request, Response, session, redirect, url_for, make_response
-from flask.ext.sqlalchemy import SQLAlchemy
+from flask import render_template, abort, request, Response, redirect, url_for, make_response, \
+    stream_with_context, jsonify, session
 from flask.ext.login import LoginManager, login_user, logout_user, current_user, login_required
 from flask.ext.seasurf import SeaSurf
 from flask_sslify import SSLify 
-import flask.ext.assets
 
 from functools import wraps
 
-from requests import post
+from database import db, create_base_app, current_city, set_city, replica_reads
+from cities import CityMiddleware, request_city
+from fast_path import FastPathMiddleware, SlidingSessionInterface
+from cache import TTLCache
+from upstream import LazySession, WorkerPool, CircuitBreaker, CircuitOpen, spreadsheets_client
+from spatial_index import GridIndex
 
-from gdata.spreadsheets.client import SpreadsheetsClient
-from oauth2client.client import SignedJwtAssertionCredentials
-from gdata.gauth import OAuth2TokenFromCredentials
-
-app = Flask(__name__)
-
-try:
-    import clb_config
-    app.config.from_object('clb_config.Config')
-except:
-    app.config.from_object(os.environ['APP_SETTINGS'])
-
-app.permanent_session_lifetime = timedelta(minutes=15)
-db = SQLAlchemy(app)
-
-meta = db.MetaData()
-meta.bind = db.engine
-
-activated_table = db.Table('activated_addresses', meta,
-                            db.Column('address', db.String, primary_key=True))
-
-csrf = SeaSurf(app)
-
-import models
+# Google's auth and spreadsheet clients, requests, Flask-Assets and NumPy
+# (through heatmap) are imported where they're first used, so that starting
+# a worker doesn't wait on them.
 
+csrf = SeaSurf()
 login_manager = LoginManager()
-login_manager.init_app(app)
 login_manager.login_view = "login_page"
 
-assets = flask.ext.assets.Environment()
-assets.init_app(app)
+def init_assets(app):
+    ''' Set up Flask-Assets before the first template is rendered. '''
+    import flask.ext.assets
+    flask.ext.assets.Environment().init_app(app)
+
+def setup_web_app():
+    ''' Set up the one web app this module serves: the database and
+    configuration from create_base_app, plus sessions, CSRF protection,
+    logins, assets and HTTPS redirects, with each request's queries sent to
+    the databases of the city it's for. It runs once, at import, because the
+    views below are registered on the module's `app` and the caches below
+    are sized from its config; it isn't a factory for further apps. Jobs
+    and scripts that want an app of their own use create_base_app. '''
+    app = create_base_app(__name__)
+
+    app.permanent_session_lifetime = timedelta(minutes=15)
+    app.session_interface = SlidingSessionInterface()
+    app.wsgi_app = FastPathMiddleware(app.wsgi_app, app.static_url_path, app.static_folder)
+    app.wsgi_app = CityMiddleware(app.wsgi_app, app.config.setdefault('CITIES', {}),
+                                  app.config.get('CITY_ROUTING', 'path'))
+    # Before anything else touches the database.
+    app.before_request(lambda: set_city(request_city(request.environ)))
+    app.teardown_request(lambda exception: set_city(None))
+
+    csrf.init_app(app)
+    login_manager.init_app(app)
+    app.before_first_request(lambda: init_assets(app))
+    SSLify(app)
+
+    return app
+
+app = setup_web_app()
 
-sslify = SSLify(app)
+import models
+
+activated_table = models.ActivatedAddress.__table__
+
+# Every city's entries share these caches, so their keys start with the city.
+user_cache = TTLCache(app.config.get('USER_CACHE_TTL', 60))
+spatial_index_cache = TTLCache(app.config.get('SPATIAL_INDEX_TTL', 3600))
+data_freshness_cache = TTLCache(app.config.get('DATA_FRESHNESS_TTL', 300))
+# The last authorization row seen for each email, for when the spreadsheet
+# can't be reached.
+authorization_cache = TTLCache(app.config.get('AUTHORIZATION_CACHE_TTL', 86400))
+
+# The spatial index's cells are this size, so it's fixed for the process.
+NEARBY_RADIUS_FEET = app.config.get('NEARBY_RADIUS_FEET', 1320)
+
+# Login's calls to Persona and Google reuse connections and run in the
+# background, and each upstream stops being called for a while after it has
+# failed a few times in a row.
+persona_session = LazySession()
+upstream_pool = WorkerPool(app.config.get('UPSTREAM_POOL_SIZE', 10))
+persona_breaker = CircuitBreaker('Persona', app.config.get('UPSTREAM_FAILURE_THRESHOLD', 3),
+                                 app.config.get('UPSTREAM_RESET_SECONDS', 30))
+authorization_breaker = CircuitBreaker('The authorization spreadsheet', app.config.get('UPSTREAM_FAILURE_THRESHOLD', 3),
+                                       app.config.get('UPSTREAM_RESET_SECONDS', 30))
 
 @app.before_request
 def func():
-    session.modified = True
     # Set in env or the postactivate file. Only "on" will activate maintenance mode.
     maintenance_mode_enabled = app.config.get('MAINTENANCE_MODE', False) == "on"
 
@@ -71,7 +110,52 @@ def load_user(userid):
         app.logger.error('There was a ValueError in load_user.')
         return None
 
-    return models.User.query.get(userid)
+    # Rebuild the user from cached column values and attach it to this
+    # request's session without a round trip to the database.
+    cached_columns = user_cache.get((current_city(), userid))
+    if cached_columns is not None:
+        user = models.User(**cached_columns)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    user = models.User.query.get(userid)
+    if user:
+        user_cache.set((current_city(), userid), dict((column.key, getattr(user, column.key))
+                                                      for column in models.User.__table__.columns))
+
+    return user
+
+@app.after_request
+def remember_write(response):
+    ''' Anything but a GET may have written something, so this visitor's
+    next REPLICA_STICKY_SECONDS of reads go to the primary, where they'll
+    see it (the address page after posting a comment, for instance). '''
+    if request.method not in ('GET', 'HEAD'):
+        session['read_primary_until'] = int(time.time()) + app.config.get('REPLICA_STICKY_SECONDS', 30)
+
+    return response
+
+def replica_allowed():
+    ''' Whether this visitor's reads may go to the replicas, which they may
+    unless they've written something recently. '''
+    return session.get('read_primary_until', 0) <= time.time()
+
+def read_from_replica(f):
+    ''' Lets a read-only view's queries go to the read replicas. Views that
+    stream their response also need streamed_from_replica. '''
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        with replica_reads(replica_allowed()):
+            return f(*args, **kwargs)
+
+    return decorated_function
+
+def streamed_from_replica(chunks):
+    ''' `chunks`, read with replica reads as read_from_replica allows them,
+    for a streamed response whose queries only run after the view returns. '''
+    with replica_reads(replica_allowed()):
+        for chunk in chunks:
+            yield chunk
 
 def audit_log(f):
     @wraps(f)
@@ -195,17 +279,112 @@ def get_top_incident_reasons_by_timeframes(incidents, timeframes, include_fire=T
     return top_call_types
 
 
+def build_spatial_index(cell_size):
+    summary = models.AddressSummary
+    locations = db.session.query(summary.address, summary.x_coordinate, summary.y_coordinate,
+                                 summary.fire_incidents_last365 + summary.police_incidents_last365)
+    locations = locations.filter(summary.x_coordinate != None, summary.y_coordinate != None)
+
+    index = GridIndex(cell_size)
+    for address, x, y, calls in locations.yield_per(5000):
+        index.add(address, x, y, calls or 0)
+
+    return index
+
+def get_spatial_index():
+    ''' Each worker builds each city's index from its address_summaries on
+    first use and rebuilds it once it is SPATIAL_INDEX_TTL seconds old. '''
+    index = spatial_index_cache.get(current_city())
+    if index is None:
+        index = build_spatial_index(NEARBY_RADIUS_FEET)
+        spatial_index_cache.set(current_city(), index)
+
+    return index
+
+def find_nearby_hot_addresses(address):
+    limit = app.config.get('NEARBY_ADDRESS_LIMIT', 5)
+
+    nearby = get_spatial_index().nearby_address(address.upper(), NEARBY_RADIUS_FEET)
+    nearby.sort(key=lambda match: (-match[2], match[1]))
+
+    return [{'address': nearby_address, 'distance': int(round(distance)), 'calls': calls}
+            for nearby_address, distance, calls in nearby[:limit]]
+
 def search_for_address_summaries(query):
 
     # Similarity threshold determined by trial and error
     threshold = 0.4
-    db.engine.execute(db.select([db.func.set_limit(threshold)]))
+    # On the session, so the search's own connection (replica or primary) gets it.
+    db.session.execute(db.select([db.func.set_limit(threshold)]))
 
     summary_query = models.AddressSummary.query.filter(models.AddressSummary.address.op('%%')(query))
     summary_query = summary_query.order_by(db.desc(db.func.similarity(models.AddressSummary.address, query)))
 
     return summary_query
 
+ADDRESS_SORT_KEYS = ('address', 'fire', 'police', 'biz_type', 'status')
+
+def address_sort_key(sort_by):
+    ''' `sort_by` if it's one of ADDRESS_SORT_KEYS, otherwise 'fire'. '''
+    return sort_by if sort_by in ADDRESS_SORT_KEYS else 'fire'
+
+def order_address_summaries(date_range, sort_by, sort_order):
+    order_column_map = {
+        'address': getattr(models.AddressSummary, 'address'),
+        'fire': getattr(models.AddressSummary, 'fire_incidents_last%d' % date_range),
+        'police': getattr(models.AddressSummary, 'police_incidents_last%d' % date_range),
+        'biz_type': getattr(models.AddressSummary, 'business_types'),
+        'status': getattr(models.AddressSummary, 'active')
+    }
+    order_column = order_column_map[address_sort_key(sort_by)]
+
+    if sort_order == 'asc':
+        order_column = order_column.asc()
+    else:
+        order_column = order_column.desc()
+
+    return models.AddressSummary.query.order_by(order_column)
+
+CSV_EXPORT_BATCH_SIZE = 1000
+
+def generate_summaries_csv(summaries, date_range):
+    ''' Yield CSV text for the given summary query in chunks of
+    CSV_EXPORT_BATCH_SIZE rows, reading from a server-side cursor so the
+    whole export is never held in memory.
+    '''
+    def encode(value):
+        if isinstance(value, unicode):
+            return value.strip().encode('utf-8')
+        return value
+
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['address', 'business_count', 'business_types', 'business_names',
+                     'fire_incidents_last%d' % date_range, 'fire_incidents_prev%d' % date_range,
+                     'police_incidents_last%d' % date_range, 'police_incidents_prev%d' % date_range,
+                     'active'])
+
+    for row_number, summary in enumerate(summaries.yield_per(CSV_EXPORT_BATCH_SIZE), 1):
+        counts = summary.counts_for_days_ago(date_range)
+        writer.writerow([encode(value) for value in [
+            summary.address, summary.business_count, summary.business_types, summary.business_names,
+            counts['fire']['last'], counts['fire']['prior'],
+            counts['police']['last'], counts['police']['prior'],
+            summary.active == True
+        ]])
+
+        if row_number % CSV_EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
+
+def csv_response(rows, filename):
+    response = Response(stream_with_context(rows), mimetype='text/csv')
+    response.headers['Content-Disposition'] = 'attachment; filename=%s' % filename
+    return response
+
 @app.route('/')
 def home():
     if not current_user.is_anonymous():
@@ -222,17 +401,17 @@ def login_page():
     next = request.args.get('next')
     return render_template('login.html', next=next, email=get_email_of_current_user())
 
-def fetch_authorization_row(email):
+def fetch_authorization_rows():
+    ''' Every row of the authorization spreadsheet, keyed by email. '''
+    from oauth2client.client import SignedJwtAssertionCredentials
+
     CLIENT_EMAIL = app.config['GOOGLE_CLIENT_EMAIL']
     PRIVATE_KEY = app.config['GOOGLE_PRIVATE_KEY']
 
     SCOPE = "https://spreadsheets.google.com/feeds/"
     
     credentials = SignedJwtAssertionCredentials(CLIENT_EMAIL, PRIVATE_KEY, SCOPE)
-    token = OAuth2TokenFromCredentials(credentials)
-    client = SpreadsheetsClient()
-
-    token.authorize(client)
+    client = spreadsheets_client(credentials, app.config.get('AUTHORIZATION_TIMEOUT', 10))
 
     # Load worksheet with auth info
     spreadsheet_id = app.config['GOOGLE_SPREADSHEET_ID']
@@ -248,26 +427,72 @@ def fetch_authorization_row(email):
 
     rows = [row.to_dict() for row in list_feed.entry]
 
-    user_auth_row = None
-    for row in rows:
-        if row['email'] == email:
-            user_auth_row = row
-            break
+    return dict((row['email'], row) for row in rows)
+
+def start_fetching_authorization():
+    ''' Start reading the spreadsheet in the background, unless it's been
+    failing. Returns the pending result or None. '''
+    if authorization_breaker.is_open():
+        return None
+
+    return upstream_pool.apply_async(fetch_authorization_rows)
+
+def fetch_authorization_row(email, pending=None):
+    ''' The spreadsheet row for `email`, or None if it isn't there. When the
+    spreadsheet doesn't answer within AUTHORIZATION_TIMEOUT seconds or has
+    been failing, the last row seen for the email is used instead; raises
+    CircuitOpen if there isn't one. '''
+    if pending is None:
+        pending = start_fetching_authorization()
 
-    return user_auth_row
+    try:
+        if pending is None:
+            raise CircuitOpen('%s is unavailable.' % authorization_breaker.name)
+        rows = authorization_breaker.call(pending.get, app.config.get('AUTHORIZATION_TIMEOUT', 10))
+    except Exception as e:
+        app.logger.warning('Falling back to cached authorization for %s: %r' % (email, e))
+        cached = authorization_cache.get(email)
+        if cached is None:
+            raise CircuitOpen('No authorization is cached for %s.' % email)
+        return cached
+
+    for row_email, row in rows.iteritems():
+        authorization_cache.set(row_email, row)
+
+    return rows.get(email)
+
+def verify_assertion(assertion):
+    posted = persona_session.post(app.config.get('PERSONA_VERIFIER_URL', 'https://verifier.login.persona.org/verify'),
+                                  data=dict(assertion=assertion, audience=app.config['BROWSERID_URL']),
+                                  timeout=app.config.get('PERSONA_TIMEOUT', 5))
+    posted.raise_for_status()
+    return posted.json()
 
 @app.route('/log-in', methods=['POST'])
 @audit_log
 def log_in():
-    posted = post('https://verifier.login.persona.org/verify',
-                  data=dict(assertion=request.form.get('assertion'),
-                            audience=app.config['BROWSERID_URL']))
+    ''' Check the assertion with Persona, then the email with the
+    authorization spreadsheet. The spreadsheet doesn't depend on who is
+    logging in, so it's read while Persona checks the assertion; a failed
+    log in costs a spreadsheet read in exchange for faster successful ones.
+    While Persona's circuit is open every log in fails, so it isn't read. '''
+    pending_authorization = None
+    if not persona_breaker.is_open():
+        pending_authorization = start_fetching_authorization()
 
-    response = posted.json()
+    try:
+        response = persona_breaker.call(verify_assertion, request.form.get('assertion'))
+    # requests' exceptions are IOErrors, and a garbled answer a ValueError.
+    except (CircuitOpen, IOError, ValueError) as e:
+        app.logger.warning('Persona verification failed: %r' % e)
+        return Response('Log in is unavailable right now, please try again shortly.', status=503)
 
     if response.get('status', '') == 'okay':
         email = response['email']
-        user_auth_row = fetch_authorization_row(email)
+        try:
+            user_auth_row = fetch_authorization_row(email, pending_authorization)
+        except CircuitOpen:
+            return Response('Log in is unavailable right now, please try again shortly.', status=503)
 
         if not user_auth_row or user_auth_row['canviewsite'] != 'Y':
             return 'Not authorized', 403
@@ -280,6 +505,7 @@ def log_in():
         user.name = user_auth_row['name']
         user.can_view_fire_data = user_auth_row['canviewfiredata'] == 'Y'
         db.session.commit()
+        user_cache.invalidate((current_city(), user.id))
 
         login_user(user)
         return 'OK'
@@ -291,6 +517,7 @@ def maintenance():
     return render_template('maintenance.html')
 
 @app.route("/browse")
+@read_from_replica
 @login_required
 @audit_log
 def browse():
@@ -300,27 +527,29 @@ def browse():
     sort_by = request.args.get('sort_by', 'fire')
     sort_order = request.args.get('sort_order', 'desc')
 
-    order_column_map = {
-        'address': getattr(models.AddressSummary, 'address'),
-        'fire': getattr(models.AddressSummary, 'fire_incidents_last%d' % date_range),
-        'police': getattr(models.AddressSummary, 'police_incidents_last%d' % date_range),
-        'biz_type': getattr(models.AddressSummary, 'business_types'),
-        'status': getattr(models.AddressSummary, 'active')
-    }
-    order_column = order_column_map.get(sort_by, order_column_map['fire'])
-
-    if sort_order == 'asc':
-        order_column = order_column.asc()
-    else:
-        order_column = order_column.desc()
-
-    summaries = models.AddressSummary.query
-    summaries = summaries.order_by(order_column).paginate(page, per_page=10)
+    summaries = order_address_summaries(date_range, sort_by, sort_order)
+    summaries = summaries.paginate(page, per_page=10)
 
     return render_template("browse.html", summaries=summaries, date_range=date_range,
         sort_by=sort_by, sort_order=sort_order, email=get_email_of_current_user())
 
+@app.route("/browse.csv")
+@read_from_replica
+@login_required
+@audit_log
+def browse_csv():
+    date_range = int(request.args.get('date_range', 365))
+    # It's part of the file name, so only the keys we sort by.
+    sort_by = address_sort_key(request.args.get('sort_by', 'fire'))
+    sort_order = request.args.get('sort_order', 'desc')
+
+    summaries = order_address_summaries(date_range, sort_by, sort_order)
+
+    return csv_response(streamed_from_replica(generate_summaries_csv(summaries, date_range)),
+                        'addresses-last%d-by-%s.csv' % (date_range, sort_by))
+
 @app.route("/search")
+@read_from_replica
 @login_required
 @audit_log
 def search():
@@ -332,6 +561,22 @@ def search():
     return render_template("search.html", summaries=summaries, email=get_email_of_current_user(),
                            search_query=query)
 
+@app.route("/search.csv")
+@read_from_replica
+@login_required
+@audit_log
+def search_csv():
+    query = request.args.get('q', '')
+
+    # Searched as the rows stream, so the similarity threshold is set on the
+    # connection they come from. Search results always show counts for the
+    # last 365 days.
+    def search_rows():
+        for chunk in generate_summaries_csv(search_for_address_summaries(query), 365):
+            yield chunk
+
+    return csv_response(streamed_from_replica(search_rows()), 'address-search.csv')
+
 
 @csrf.exempt
 @app.route('/log-out', methods=['POST'])
@@ -373,48 +618,163 @@ def is_address_activated(address):
 
     return db.session.query(address_query.exists()).scalar()
 
-def activate_address(address):
-    query = activated_table.insert().values(address=address)
-    db.session.execute(query)
+# SQLite refuses compound selects with more than 500 terms.
+MAX_BULK_ADDRESSES = 500
+
+def activated_addresses_among(addresses):
+    return set(row[0] for row in db.session.query(activated_table.c.address)
+               .filter(activated_table.c.address.in_(addresses)))
+
+def activation_insert(addresses):
+    ''' INSERT of whichever of `addresses` aren't activated when it runs. '''
+    candidates = db.union_all(*[db.select([db.literal(address).label('address')])
+                                for address in addresses]).alias('candidates')
+    new_addresses = db.select([candidates.c.address]).where(
+        ~db.exists().where(activated_table.c.address == candidates.c.address))
+    return activated_table.insert().from_select(['address'], new_addresses)
+
+def insert_activated_addresses(addresses):
+    ''' Activate `addresses`, returning the ones this transaction actually
+    inserted; any a concurrent request committed first are left out. One
+    that commits while the INSERT runs still raises IntegrityError. '''
+    insert = activation_insert(addresses)
+    if db.session.get_bind(clause=insert).dialect.name == 'postgresql':
+        result = db.session.execute(insert.returning(activated_table.c.address))
+        return sorted(row[0] for row in result)
+
+    # Without RETURNING, one row at a time tells which were inserted.
+    return [address for address in addresses
+            if db.session.execute(activation_insert([address])).rowcount]
+
+def delete_activated_addresses(addresses):
+    ''' Deactivate `addresses`, returning the ones this transaction actually
+    deleted; any a concurrent request deleted first are left out. '''
+    delete = activated_table.delete().where(activated_table.c.address.in_(addresses))
+    if db.session.get_bind(clause=delete).dialect.name == 'postgresql':
+        result = db.session.execute(delete.returning(activated_table.c.address))
+        return sorted(row[0] for row in result)
+
+    # Without RETURNING, one row at a time tells which were deleted.
+    return [address for address in addresses
+            if db.session.execute(activated_table.delete().where(activated_table.c.address == address)).rowcount]
+
+def set_addresses_activation(addresses, activate):
+    ''' Activate or deactivate many addresses in one transaction, recording
+    an Action for each address that changed and updating its summary so
+    browse reflects the change immediately. Returns the changed addresses.
+    Raises IntegrityError when a concurrent activation wins a race for one
+    of them; the caller rolls back.
+    '''
+    addresses = sorted(set(address.upper() for address in addresses))
+    if not addresses:
+        return []
+
+    already_active = activated_addresses_among(addresses)
+
+    if activate:
+        candidates = [address for address in addresses if address not in already_active]
+        changed = insert_activated_addresses(candidates) if candidates else []
+    else:
+        candidates = [address for address in addresses if address in already_active]
+        changed = delete_activated_addresses(candidates) if candidates else []
+
+    if changed:
+        action_type = "activated" if activate else "deactivated"
+        db.session.execute(models.Action.__table__.insert(),
+                           [dict(user_id=current_user.id, type=action_type, address=address)
+                            for address in changed])
+
+        summaries = models.AddressSummary.__table__
+        db.session.execute(summaries.update().where(summaries.c.address.in_(changed))
+                                             .values(active=activate))
 
-    action = models.Action(user_id=current_user.id, type="activated", address=address)
-    db.session.add(action)
     db.session.commit()
 
+    return changed
+
+def activate_address(address):
+    return set_addresses_activation([address], True)
+
 def deactivate_address(address):
-    query = activated_table.delete().where(activated_table.c.address == address)
-    db.session.execute(query)
+    return set_addresses_activation([address], False)
 
-    action = models.Action(user_id=current_user.id, type="deactivated", address=address)
-    db.session.add(action)
-    db.session.commit()
+@app.context_processor
+def inject_data_freshness():
+    ''' When the address summaries were last rebuilt, for the page footer. '''
+    updated_at = data_freshness_cache.get((current_city(), models.SUMMARY_JOB_NAME), False)
+    if updated_at is False:
+        updated_at = models.JobRun.last_success(models.SUMMARY_JOB_NAME)
+        data_freshness_cache.set((current_city(), models.SUMMARY_JOB_NAME), updated_at)
+
+    return {'data_updated_at': updated_at}
+
+@app.template_filter('duration')
+def format_duration(seconds):
+    if seconds is None:
+        return 'Unknown'
+    if seconds >= 3600:
+        return '%.1f hours' % (seconds / 3600.0)
+
+    return '%dm %02ds' % divmod(seconds, 60)
+
+def current_user_can_view_fire():
+    if current_user.is_anonymous() and app.config['TESTING']:
+        return True
+    elif current_user.is_authenticated() and current_user.can_view_fire_data:
+        return True
+
+    return False
+
+def get_address_detail(address, include_fire=True):
+    ''' Counts and top call types for each window and the businesses at an
+    address, from the row the nightly rebuild wrote to address_details. An
+    address without one is worked out from its incidents, and is None if it
+    has none. '''
+    detail = models.AddressDetail.query.get(address.upper())
+    if detail is not None:
+        detail = detail.as_dict()
+        if not include_fire:
+            del detail['top_call_types']['fire']
+        return detail
+
+    incidents = fetch_incidents_at_address(address)
+    if len(incidents['fire']) == 0 and len(incidents['police']) == 0:
+        return None
+
+    return {
+        'counts': count_incidents_by_timeframes(incidents, models.DETAIL_TIMEFRAMES),
+        'top_call_types': get_top_incident_reasons_by_timeframes(incidents, models.DETAIL_TIMEFRAMES,
+                                                                 include_fire=include_fire),
+        'business_names': [biz.name.strip() for biz in incidents['businesses']],
+        'business_types': [biz.business_service_description.strip() for biz in incidents['businesses']]
+    }
 
 @app.route("/address/<address>")
+@read_from_replica
 @login_required
 @audit_log
 def address(address):
-    incidents = fetch_incidents_at_address(address)
-    if len(incidents['fire']) == 0 and len(incidents['police']) == 0:
+    can_view_fire = current_user_can_view_fire()
+    detail = get_address_detail(address, include_fire=can_view_fire)
+    if detail is None:
         abort(404)
 
-    counts = count_incidents_by_timeframes(incidents, [7, 30, 90, 365])
-    business_types = [biz.business_service_description.strip() for biz in incidents['businesses']]
-    business_names = [biz.name.strip() for biz in incidents['businesses']]
-
-    can_view_fire = False
-    if current_user.is_anonymous() and app.config['TESTING']:
-        can_view_fire = True
-    elif current_user.is_authenticated() and current_user.can_view_fire_data:
-        can_view_fire = True
+    dispatch_summary = None
+    if can_view_fire:
+        summary = models.AddressSummary.query.get(address.upper())
+        if summary and summary.fire_dispatch_count:
+            dispatch_summary = summary
 
-    top_call_types = get_top_incident_reasons_by_timeframes(incidents, [7, 30, 90, 365], include_fire=can_view_fire)
     actions = models.Action.query.filter(models.Action.address==address.upper()).order_by(models.Action.created).all()
     activated = is_address_activated(address)
+    nearby_addresses = find_nearby_hot_addresses(address)
 
-    kwargs = dict(email=get_email_of_current_user(), incidents=incidents, counts=counts,
-                           business_types=business_types, business_names=business_names,
-                           top_call_types=top_call_types, address=address, actions=actions,
-                           activated=activated)
+    kwargs = dict(email=get_email_of_current_user(), counts=detail['counts'],
+                           business_types=detail['business_types'], business_names=detail['business_names'],
+                           top_call_types=detail['top_call_types'], address=address, actions=actions,
+                           activated=activated, dispatch_summary=dispatch_summary,
+                           nearby_addresses=nearby_addresses,
+                           nearby_radius=NEARBY_RADIUS_FEET)
 
     return render_template('address.html', **kwargs)
 
@@ -436,20 +796,85 @@ def post_comment(address):
 @app.route("/address/<address>/activate", methods=["POST"])
 @login_required
 def activate(address):
-    try: 
-        activate_address(address.upper())
-        db.session.commit()
-        return 'activated'
-    except sqlalchemy.exc.IntegrityError:
+    try:
+        changed = activate_address(address)
+    except IntegrityError:
+        db.session.rollback()
+        changed = []
+
+    if not changed:
         return 'already activated', 400
 
+    return 'activated'
+
 @app.route("/address/<address>/deactivate", methods=["POST"])
 @login_required
 def deactivate(address):
-    deactivate_address(address.upper())
-    db.session.commit()
+    deactivate_address(address)
     return 'deactivated'
 
+def bulk_activation_response(activate):
+    posted = request.get_json(silent=True)
+    if posted is None:
+        addresses = request.form.getlist('addresses')
+    elif isinstance(posted, dict) and isinstance(posted.get('addresses'), list):
+        addresses = posted['addresses']
+    else:
+        return 'Expected {"addresses": [...]}', 400
+
+    if not addresses or not all(isinstance(address, basestring) for address in addresses):
+        return 'No addresses given', 400
+    if len(addresses) > MAX_BULK_ADDRESSES:
+        return 'At most %d addresses can be changed at once' % MAX_BULK_ADDRESSES, 400
+
+    try:
+        changed = set_addresses_activation(addresses, activate)
+    except IntegrityError:
+        db.session.rollback()
+        return 'Another request changed some of these addresses, please try again', 400
+
+    unchanged = sorted(set(address.upper() for address in addresses) - set(changed))
+
+    return jsonify(changed=changed, unchanged=unchanged)
+
+@app.route("/addresses/activate", methods=["POST"])
+@login_required
+def bulk_activate():
+    return bulk_activation_response(True)
+
+@app.route("/addresses/deactivate", methods=["POST"])
+@login_required
+def bulk_deactivate():
+    return bulk_activation_response(False)
+
+
+@app.route("/heatmap/<department>/<int:days>/<int:level>/<int:tile_x>/<int:tile_y>.json")
+@read_from_replica
+@login_required
+def heatmap_tile(department, days, level, tile_x, tile_y):
+    ''' Pre-aggregated incident counts for one tile, as [cell_x, cell_y, count]
+    triples. Cell indexes are multiples of cell_size feet. '''
+    import heatmap
+
+    if department not in heatmap.DEPARTMENTS or days not in heatmap.TIMEFRAMES \
+            or not 0 <= level < heatmap.LEVELS:
+        abort(404)
+    if department == 'fire' and not current_user_can_view_fire():
+        abort(403)
+
+    first_x, last_x = heatmap.tile_cell_range(tile_x)
+    first_y, last_y = heatmap.tile_cell_range(tile_y)
+
+    cell = models.HeatmapCell
+    cells = db.session.query(cell.cell_x, cell.cell_y, cell.count)
+    cells = cells.filter(cell.department == department, cell.days == days, cell.level == level,
+                         cell.cell_x.between(first_x, last_x), cell.cell_y.between(first_y, last_y))
+
+    tile = {'cell_size': heatmap.cell_size(level), 'cells': [list(row) for row in cells]}
+    response = Response(json.dumps(tile, separators=(',', ':')), mimetype='application/json')
+    response.cache_control.private = True
+    response.cache_control.max_age = 3600
+    return response
 
 @app.route("/audit_log")
 @login_required
@@ -0,0 +1,26 @@
+import argparse
+from sqlalchemy import create_engine
+from transformer import transform
+
+table_name = 'all_business_licenses'
+transformations = []
+# A business is one license per name and address.
+unique_key = ['name', 'business_address']
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Transform a database')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--hostdb')
+    source.add_argument('--csv', metavar='PATH', help='read rows from a CSV or CSV.gz export instead of --hostdb')
+    parser.add_argument('--destinationdb')
+    parser.add_argument('--staging', action='store_true',
+                        help='load every row into a staging table and swap it in at the end')
+    parser.add_argument('--metrics', metavar='PATH',
+                        help='append timings and row counts for the run to PATH as a line of JSON')
+    args = parser.parse_args()
+
+    host_engine = create_engine(args.hostdb) if args.hostdb else None
+    dest_engine = create_engine(args.destinationdb)
+
+    transform(host_engine, dest_engine, table_name, transformations, unique_key,
+              staging=args.staging, metrics_path=args.metrics, csv_path=args.csv)
@@ -0,0 +1,38 @@
+import threading
+import time
+
+
+class TTLCache(object):
+    ''' A small per-process cache whose entries expire `ttl` seconds after
+    they are set. Each gunicorn worker keeps its own copy.
+    '''
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+
+            expires_at, value = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return default
+
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, value)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,46 @@
+# Where CityMiddleware leaves the name of the city a request is for, or None
+# for the default city.
+CITY_ENVIRON_KEY = 'clb.city'
+
+
+def request_city(environ):
+    return environ.get(CITY_ENVIRON_KEY)
+
+
+class CityMiddleware(object):
+    ''' Works out which city a request is for before Flask sees it, from the
+    first label of the host name with 'subdomain' routing
+    (springfield.example.com), or from the first segment of the path with
+    'path' routing (/springfield/browse). A path prefix is moved into
+    SCRIPT_NAME, so the routes match as they are and url_for keeps it.
+    Requests that don't name one of `cities` are for the default city.
+    '''
+
+    def __init__(self, wsgi_app, cities, routing='path'):
+        self.wsgi_app = wsgi_app
+        # Kept as given, usually the CITIES setting itself.
+        self.cities = cities
+        self.routing = routing
+
+    def city_from_host(self, environ):
+        host = environ.get('HTTP_HOST') or environ.get('SERVER_NAME', '')
+        label = host.split(':')[0].split('.')[0]
+        return label if label in self.cities else None
+
+    def city_from_path(self, environ):
+        path = environ.get('PATH_INFO', '')
+        segment = path.split('/')[1] if path.startswith('/') else ''
+        if segment not in self.cities:
+            return None
+
+        environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '').rstrip('/') + '/' + segment
+        environ['PATH_INFO'] = path[len(segment) + 1:] or '/'
+        return segment
+
+    def __call__(self, environ, start_response):
+        if self.routing == 'subdomain':
+            environ[CITY_ENVIRON_KEY] = self.city_from_host(environ)
+        else:
+            environ[CITY_ENVIRON_KEY] = self.city_from_path(environ)
+
+        return self.wsgi_app(environ, start_response)
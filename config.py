@@ -1,4 +1,6 @@
+import json
 import os
+from datetime import timedelta
 
 
 class Config(object):
@@ -6,11 +8,51 @@ class Config(object):
     DEBUG = False
     TESTING = False
     CSRF_ENABLED = True
+    # Sessions are only re-signed once they have less than this long to live.
+    SESSION_REFRESH_WINDOW = timedelta(minutes=5)
+    # Seconds a worker may reuse a logged-in user without reloading it.
+    USER_CACHE_TTL = 60
+    # The address page lists the busiest addresses within this many feet.
+    NEARBY_RADIUS_FEET = 1320
+    NEARBY_ADDRESS_LIMIT = 5
+    # Seconds each worker keeps its spatial index before rebuilding it.
+    SPATIAL_INDEX_TTL = 3600
+    # Seconds each worker caches when the summaries were last rebuilt.
+    DATA_FRESHNESS_TTL = 300
+    # Where batch jobs keep their lock files when the database has no advisory locks.
+    JOB_LOCK_DIR = os.environ.get('JOB_LOCK_DIR', '/tmp')
+    # Seconds log in waits for Persona and for the authorization spreadsheet.
+    PERSONA_VERIFIER_URL = os.environ.get('PERSONA_VERIFIER_URL', 'https://verifier.login.persona.org/verify')
+    PERSONA_TIMEOUT = 5
+    AUTHORIZATION_TIMEOUT = 10
+    # Failures in a row before log in stops calling an upstream, and for how long.
+    UPSTREAM_FAILURE_THRESHOLD = 3
+    UPSTREAM_RESET_SECONDS = 30
+    # Seconds a spreadsheet row is used when the spreadsheet can't be reached.
+    AUTHORIZATION_CACHE_TTL = 86400
     SECRET_KEY = os.environ['SECRET_KEY']
     SQLALCHEMY_DATABASE_URI = os.environ['DATABASE_URL']
     SQLALCHEMY_BINDS = {
         'lbc_data': os.environ.get('DATA_DATABASE_URL', os.environ['DATABASE_URL'])
     }
+    # Cities served alongside the default one, each with databases of its own
+    # (and so its own users, summaries and connection pools), as JSON:
+    # {"springfield": {"SQLALCHEMY_DATABASE_URI": ..., "SQLALCHEMY_BINDS": {"lbc_data": ...}}}
+    CITIES = json.loads(os.environ.get('CITIES', '{}'))
+    # How a request names its city: 'path' (/springfield/browse) or 'subdomain'
+    # (springfield.example.com). Anything else is for the default city.
+    CITY_ROUTING = os.environ.get('CITY_ROUTING', 'path')
+    # Read replicas of SQLALCHEMY_DATABASE_URI and of SQLALCHEMY_BINDS, which
+    # read-only pages query while they're within REPLICA_MAX_LAG_SECONDS. A
+    # visitor's reads stay on the primary for REPLICA_STICKY_SECONDS after
+    # anything but a GET, so they see their own changes. Cities in CITIES can
+    # have the same two settings.
+    SQLALCHEMY_REPLICA_URI = os.environ.get('REPLICA_DATABASE_URL')
+    SQLALCHEMY_REPLICA_BINDS = {
+        'lbc_data': os.environ.get('DATA_REPLICA_DATABASE_URL')
+    }
+    REPLICA_MAX_LAG_SECONDS = 10
+    REPLICA_STICKY_SECONDS = 30
     BROWSERID_URL = os.environ['BROWSERID_URL']
     BROWSERID_LOGIN_URL = '/log-in'
     BROWSERID_LOGOUT_URL = '/log-out'
@@ -42,3 +84,5 @@ class TestingConfig(Config):
     SQLALCHEMY_BINDS = {
         'lbc_data': 'sqlite:///:memory:'
     }
+    SQLALCHEMY_REPLICA_URI = None
+    SQLALCHEMY_REPLICA_BINDS = {}
@@ -1,10 +1,29 @@
-from app import db
-from models import FireIncident, PoliceIncident, BusinessLicense, AddressSummary, ActivatedAddress
+from database import db, current_city, use_city
+from models import FireIncident, FireDispatch, PoliceIncident, BusinessLicense, AddressSummary, ActivatedAddress, \
+    AddressDetail, HeatmapCell, SUMMARY_JOB_NAME, DETAIL_TIMEFRAMES
+from jobs import PhaseTimer, JobLocked, run_job
+from dispatches import summarize_dispatches
+from spatial_index import parse_coordinate
+from heatmap import CellCounter, aggregate_snapshot_cells
+from incident_snapshot import IncidentSnapshot, epoch_day, today_epoch_day
+import numpy as np
 import pytz
 
+import argparse
 import datetime
+import heapq
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+from multiprocessing.pool import ThreadPool
 
 DEFAULT_TIMEFRAMES = [7, 14, 30, 60, 90, 180, 365]
+# Call types kept per window in address_details.
+TOP_REASONS = 5
 
 def count_calls(incidents, time_field, output_header, timeframes):
     start_dates = {}
@@ -41,67 +60,441 @@ def count_police_calls(incidents):
     return count_calls(incidents, 'call_datetime', 
                        'police_counts', DEFAULT_TIMEFRAMES)
 
+def count_calls_from_snapshot(snapshot, output_header, prior_header, timeframes, today=None):
+    ''' Vectorized count_calls over an IncidentSnapshot, which also counts
+    each timeframe's prior window. Only addresses with an incident in the
+    longest timeframe are included. '''
+    if today is None:
+        today = today_epoch_day()
 
-def fetch_business_summary_data():
+    counts = dict((num_days, snapshot.window_counts(num_days, today)) for num_days in timeframes)
+    prior_counts = dict((num_days, snapshot.prior_window_counts(num_days, today)) for num_days in timeframes)
+
+    addresses = {}
+    for address_id in np.flatnonzero(counts[max(timeframes)]):
+        addresses[snapshot.addresses[address_id]] = {
+            output_header: dict((num_days, int(counts[num_days][address_id])) for num_days in timeframes),
+            prior_header: dict((num_days, int(prior_counts[num_days][address_id])) for num_days in timeframes)
+        }
+
+    return addresses
+
+
+def sum_coordinates(incidents, coordinate_sums=None):
+    ''' Accumulate [x total, y total, count] per address from the x and y
+    coordinates at positions 2 and 3 of each incident tuple. '''
+    if coordinate_sums is None:
+        coordinate_sums = {}
+
+    for incident in incidents:
+        x = parse_coordinate(incident[2])
+        y = parse_coordinate(incident[3])
+        if x is None or y is None:
+            continue
+
+        sums = coordinate_sums.setdefault(incident[0].strip(), [0.0, 0.0, 0])
+        sums[0] += x
+        sums[1] += y
+        sums[2] += 1
+
+    return coordinate_sums
+
+def sum_snapshot_coordinates(snapshot, num_days, today, coordinate_sums=None):
+    ''' sum_coordinates for the last `num_days` days of an IncidentSnapshot. '''
+    if coordinate_sums is None:
+        coordinate_sums = {}
+
+    x_totals, y_totals, counts = snapshot.coordinate_totals(num_days, today)
+    for address_id in np.flatnonzero(counts):
+        sums = coordinate_sums.setdefault(snapshot.addresses[address_id], [0.0, 0.0, 0])
+        sums[0] += float(x_totals[address_id])
+        sums[1] += float(y_totals[address_id])
+        sums[2] += int(counts[address_id])
+
+    return coordinate_sums
+
+def address_sort_key(column):
+    ''' The trimmed address in `column`, compared bytewise on PostgreSQL so the
+    database sorts addresses the same way Python compares strings. '''
+    key = db.func.coalesce(db.func.trim(column), '')
+    if db.engine.dialect.name == 'postgresql':
+        key = key.op('COLLATE')(db.literal_column('"C"'))
+    return key
+
+def shard_conditions(key, shard):
+    ''' Conditions keeping `key` within a shard's [lower, upper) address
+    range, where None leaves that end open. '''
+    if shard is None:
+        return []
+
+    lower, upper = shard
+    conditions = []
+    if lower is not None:
+        conditions.append(key >= lower)
+    if upper is not None:
+        conditions.append(key < upper)
+    return conditions
+
+def fetch_fire_incident_rows(since, by_address=False, shard=None):
+    ''' Stream one (address, datetime, call type, x, y) row per CAD call,
+    optionally sorted by address and limited to one shard. Calls are
+    deduplicated when they're loaded, so this is a plain range scan. '''
+    query = db.session.query(FireIncident.standardized_address,
+                             FireIncident.alarm_datetime,
+                             FireIncident.actual_nfirs_incident_type_description,
+                             FireIncident.x_coordinate,
+                             FireIncident.y_coordinate)
+    query = query.filter(FireIncident.alarm_datetime >= since)
+    for condition in shard_conditions(address_sort_key(FireIncident.standardized_address), shard):
+        query = query.filter(condition)
+    if by_address:
+        query = query.order_by(address_sort_key(FireIncident.standardized_address))
+    return query.yield_per(10000)
+
+def fetch_police_incident_rows(since, by_address=False, shard=None):
+    ''' Stream one (address, datetime, call type, x, y) row per CAD call,
+    optionally sorted by address and limited to one shard. Calls are
+    deduplicated when they're loaded, so this is a plain range scan. '''
+    query = db.session.query(PoliceIncident.standardized_address,
+                             PoliceIncident.call_datetime,
+                             PoliceIncident.final_cad_call_type_description,
+                             PoliceIncident.x_coordinate,
+                             PoliceIncident.y_coordinate)
+    query = query.filter(PoliceIncident.call_datetime >= since)
+    for condition in shard_conditions(address_sort_key(PoliceIncident.standardized_address), shard):
+        query = query.filter(condition)
+    if by_address:
+        query = query.order_by(address_sort_key(PoliceIncident.standardized_address))
+    return query.yield_per(10000)
+
+def fetch_business_summary_data(by_address=False, shard=None):
     query = db.session.query(BusinessLicense.business_address, 
                              db.func.count(), 
                              db.func.string_agg(BusinessLicense.business_service_description, ","),
                              db.func.string_agg(BusinessLicense.name, ",")) \
             .group_by(BusinessLicense.business_address)
+    for condition in shard_conditions(address_sort_key(BusinessLicense.business_address), shard):
+        query = query.filter(condition)
+    if by_address:
+        return query.order_by(address_sort_key(BusinessLicense.business_address)).yield_per(10000)
     return query.all()
 
-def fetch_active_addresses():
-    addresses = db.session.query(ActivatedAddress.address).all()
+def fetch_business_details(by_address=False, shard=None):
+    ''' (address, name, type) for every business license. '''
+    query = db.session.query(BusinessLicense.business_address,
+                             BusinessLicense.name,
+                             BusinessLicense.business_service_description)
+    for condition in shard_conditions(address_sort_key(BusinessLicense.business_address), shard):
+        query = query.filter(condition)
+    if by_address:
+        return query.order_by(address_sort_key(BusinessLicense.business_address)).yield_per(10000)
+    return query.all()
+
+def fetch_dispatches_by_address(since, shard=None):
+    ''' Stream every dispatch for incidents since `since`, joined to the
+    incident's address and sorted by it, optionally limited to one shard. '''
+    incident_addresses = db.session.query(FireIncident.incident_number.label('incident_number'),
+                                          db.func.max(FireIncident.standardized_address).label('address'))
+    incident_addresses = incident_addresses.filter(FireIncident.alarm_datetime >= since)
+    incident_addresses = incident_addresses.group_by(FireIncident.incident_number).subquery()
+
+    query = db.session.query(incident_addresses.c.address,
+                             FireDispatch.dispatch_datetime,
+                             FireDispatch.arrival_datetime,
+                             FireDispatch.clear_datetime,
+                             FireDispatch.response_time_in_sec,
+                             FireDispatch.duration_time_in_sec)
+    query = query.select_from(FireDispatch)
+    query = query.join(incident_addresses, incident_addresses.c.incident_number == FireDispatch.incident_number)
+    for condition in shard_conditions(address_sort_key(incident_addresses.c.address), shard):
+        query = query.filter(condition)
+    query = query.order_by(address_sort_key(incident_addresses.c.address))
+    return query.yield_per(5000)
+
+def fetch_active_addresses(by_address=False, shard=None):
+    query = db.session.query(ActivatedAddress.address)
+    for condition in shard_conditions(address_sort_key(ActivatedAddress.address), shard):
+        query = query.filter(condition)
+    if by_address:
+        return query.order_by(address_sort_key(ActivatedAddress.address)).yield_per(10000)
+    addresses = query.all()
     return addresses
 
-def address_counts_dict_to_call_summary(address, counts):
+def heatmap_cell_rows(department, cells):
+    return [dict(department=department, days=days, level=level, cell_x=cell_x, cell_y=cell_y, count=count)
+            for (days, level, cell_x, cell_y), count in cells.iteritems()]
+
+def address_summary_row(address, counts):
     row = {
         'address': address.strip(),
         'business_count': counts.get('business_count', 0),
         'business_types': counts.get('business_types', ''),
         'business_names': counts.get('business_names', ''),
-        'active': counts.get('active', False)
+        'active': counts.get('active', False),
+        'x_coordinate': counts.get('x_coordinate'),
+        'y_coordinate': counts.get('y_coordinate'),
+        'fire_dispatch_count': counts.get('fire_dispatch_count', 0),
+        'fire_unit_seconds': counts.get('fire_unit_seconds', 0),
+        'fire_response_p50': counts.get('fire_response_p50'),
+        'fire_response_p90': counts.get('fire_response_p90'),
+        'fire_response_digest': counts.get('fire_response_digest')
     }
 
     model_timeframes = [7, 30, 90, 365]
 
     for department in ['fire', 'police']:
         count_field = department + '_counts'
+        prior_field = department + '_prior_counts'
 
         if count_field in counts:
             for days_ago in model_timeframes:
                 row['%s_incidents_last%d' % (department, days_ago)] = counts[count_field][days_ago]
-                row['%s_incidents_prev%d' % (department, days_ago)] = counts[count_field][days_ago] * 2 - counts[count_field][days_ago]
+                if prior_field in counts:
+                    row['%s_incidents_prev%d' % (department, days_ago)] = counts[prior_field][days_ago]
+                else:
+                    row['%s_incidents_prev%d' % (department, days_ago)] = counts[count_field][days_ago] * 2 - counts[count_field][days_ago]
         else:
             for days_ago in model_timeframes:
                 row['%s_incidents_last%d' % (department, days_ago)] = 0
                 row['%s_incidents_prev%d' % (department, days_ago)] = 0
 
-    return AddressSummary(**row)
+    return row
 
-if __name__ == '__main__':
+def address_counts_dict_to_call_summary(address, counts):
+    return AddressSummary(**address_summary_row(address, counts))
+
+def top_reasons(reason_counts, limit=TOP_REASONS):
+    ''' The `limit` most common (call type, count) pairs, ties broken by
+    call type like IncidentSnapshot.top_reasons. '''
+    return sorted(reason_counts.iteritems(), key=lambda item: (-item[1], item[0]))[:limit]
+
+def business_list(rows):
+    ''' Sorted (name, type) pairs for an address's (address, name, type) rows. '''
+    return sorted(((name or u'').strip(), (business_type or u'').strip()) for address, name, business_type in rows)
+
+def address_detail_row(address, fields):
+    ''' An address_details row holding what the address page shows: each
+    department's counts and top call types for DETAIL_TIMEFRAMES, and the
+    businesses at the address. '''
+    detail = {'counts': {}, 'top_call_types': {}}
+    for department in ['fire', 'police']:
+        counts = fields.get(department + '_counts', {})
+        reasons = fields.get(department + '_top_reasons', {})
+        detail['counts'][department] = dict((num_days, counts.get(num_days, 0)) for num_days in DETAIL_TIMEFRAMES)
+        detail['top_call_types'][department] = dict((num_days, reasons.get(num_days, []))
+                                                    for num_days in DETAIL_TIMEFRAMES)
+
+    businesses = fields.get('businesses', [])
+    detail['business_names'] = [name for name, business_type in businesses]
+    detail['business_types'] = [business_type for name, business_type in businesses]
+
+    return {'address': address.strip(), 'detail': json.dumps(detail, sort_keys=True)}
+
+def group_by_address(rows):
+    ''' Group rows sorted by their trimmed address (the first column) into
+    (address, rows) pairs, failing loudly if the order is broken. '''
+    previous = None
+    for address, group in itertools.groupby(rows, key=lambda row: (row[0] or u'').strip()):
+        if previous is not None and address <= previous:
+            raise ValueError('Rows are not sorted by address: %r came after %r' % (address, previous))
+        previous = address
+        yield address, group
+
+def summarize_incidents(incidents, department, timeframes, today, cells):
+    ''' Consume one department's (address, datetime, call type, x, y) rows
+    sorted by address and yield (address, fields) as each address's group
+    ends. Windows are whole days, as in count_calls_from_snapshot, and counts
+    and top call types are only included for addresses with an incident in
+    the longest timeframe. Every incident is also added to the `cells`
+    CellCounter. '''
+    count_field = department + '_counts'
+    prior_field = department + '_prior_counts'
+    longest = max(timeframes)
+
+    for address, group in group_by_address(incidents):
+        counts = dict((num_days, 0) for num_days in timeframes)
+        prior_counts = dict((num_days, 0) for num_days in timeframes)
+        reason_counts = dict((num_days, {}) for num_days in DETAIL_TIMEFRAMES)
+        coordinate_sums = [0.0, 0.0, 0]
+
+        for incident in group:
+            incident_datetime = incident[1]
+            if incident_datetime is None:
+                continue
+
+            cells.add(incident_datetime, incident[3], incident[4])
+
+            days_ago = today - epoch_day(incident_datetime)
+            if days_ago < 0:
+                continue
+
+            for num_days in timeframes:
+                if days_ago < num_days:
+                    counts[num_days] += 1
+                elif days_ago < 2 * num_days:
+                    prior_counts[num_days] += 1
+
+            reason = (incident[2] or u'').strip()
+            for num_days in DETAIL_TIMEFRAMES:
+                if days_ago < num_days:
+                    reason_counts[num_days][reason] = reason_counts[num_days].get(reason, 0) + 1
+
+            x = parse_coordinate(incident[3])
+            y = parse_coordinate(incident[4])
+            if days_ago < 365 and x is not None and y is not None:
+                coordinate_sums[0] += x
+                coordinate_sums[1] += y
+                coordinate_sums[2] += 1
+
+        fields = {}
+        if counts[longest]:
+            fields[count_field] = counts
+            fields[prior_field] = prior_counts
+            fields[department + '_top_reasons'] = dict((num_days, top_reasons(reason_counts[num_days]))
+                                                       for num_days in DETAIL_TIMEFRAMES)
+        if coordinate_sums[2]:
+            fields[department + '_coordinate_sums'] = coordinate_sums
+        if fields:
+            yield address, fields
+
+def summarize_businesses(business_info):
+    for address, rows in group_by_address(business_info):
+        for row in rows:
+            fields = {'business_count': row[1], 'business_types': row[2], 'business_names': row[3]}
+        yield address, fields
+
+def summarize_business_details(business_details):
+    for address, rows in group_by_address(business_details):
+        yield address, {'businesses': business_list(rows)}
+
+def summarize_active_addresses(active_addresses):
+    for address, rows in group_by_address(active_addresses):
+        yield address, {'active': True}
+
+def tag_stream(stream, index):
+    for address, fields in stream:
+        yield address, index, fields
+
+def merge_by_address(*streams):
+    ''' Merge (address, fields) streams, each sorted by address, into one
+    stream with every stream's fields for an address combined. Only the
+    current address from each stream is held in memory. '''
+    merged = heapq.merge(*[tag_stream(stream, index) for index, stream in enumerate(streams)])
+    for address, group in itertools.groupby(merged, key=lambda item: item[0]):
+        fields = {}
+        for _, index, stream_fields in group:
+            fields.update(stream_fields)
+        yield address, fields
+
+def streamed_address_rows(addresses):
+    ''' (address_summaries row, address_details row) pairs for the merged
+    per-address fields, keeping the same addresses rebuild_summaries does. '''
+    numbers = ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9']
+    for address, fields in addresses:
+        if 'fire_counts' not in fields and 'police_counts' not in fields:
+            continue
+        if len(address) == 0 or address[0] not in numbers:
+            continue
+
+        x_total, y_total, count = 0.0, 0.0, 0
+        for department in ['fire', 'police']:
+            sums = fields.get(department + '_coordinate_sums')
+            if sums:
+                x_total += sums[0]
+                y_total += sums[1]
+                count += sums[2]
+        if count:
+            fields['x_coordinate'] = x_total / count
+            fields['y_coordinate'] = y_total / count
+
+        yield address_summary_row(address, fields), address_detail_row(address, fields)
+
+def batches(rows, batch_size):
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+class InlineResult(object):
+    ''' Stands in for an AsyncResult when the rebuild runs serially. '''
+
+    def __init__(self, f, args):
+        self.value = f(*args)
+
+    def get(self):
+        return self.value
+
+
+def in_own_session(city, f, *args):
+    ''' Run `f` in a worker thread with that thread's own scoped session and
+    connection to `city`'s databases, and give the connection back when it
+    finishes. '''
+    with use_city(city):
+        try:
+            return f(*args)
+        finally:
+            db.session.remove()
+
+
+def build_snapshot(directory, rows):
+    return IncidentSnapshot.build(directory, rows)
+
+
+def summarize_dispatches_since(since):
+    return list(summarize_dispatches(fetch_dispatches_by_address(since)))
+
+
+def rebuild_summaries(snapshot_dir, concurrent=True, timer=None):
+    ''' Rebuild address_summaries and heatmap_cells. With `concurrent`, the
+    independent database reads run at once on separate connections, and each
+    department is counted as soon as its snapshot is loaded. '''
+    timer = timer or PhaseTimer()
+    now = datetime.datetime.now(pytz.utc)
+    today = today_epoch_day()
     # All the days within the last year, with a bit of padding to make sure all gets included
-    one_year_ago = datetime.datetime.now(pytz.utc) - datetime.timedelta(days=370)
-
-    print "Loading Fire Data..."
-    fire_incidents_query = db.session.query(db.func.max(FireIncident.standardized_address), 
-                                            db.func.max(FireIncident.alarm_datetime))
-    fire_incidents_query = fire_incidents_query.filter(FireIncident.alarm_datetime >= one_year_ago)
-    fire_incidents_query = fire_incidents_query.group_by(FireIncident.cad_call_number)
-    fire_incidents = fire_incidents_query.all()
-    print "Fire Data Loaded."
-    addresses = count_fire_calls(fire_incidents)
-    print "Fire Data Counted."
-
-    print "Loading Police Data..."
-    police_incidents_query = db.session.query(db.func.max(PoliceIncident.standardized_address), 
-                                              db.func.max(PoliceIncident.call_datetime))
-    police_incidents_query = police_incidents_query.filter(PoliceIncident.call_datetime >= one_year_ago)
-    police_incidents_query = police_incidents_query.group_by(PoliceIncident.cad_call_number)
-    police_incidents = police_incidents_query.all()
-    print "Police Data Loaded."
-    police_addresses = count_police_calls(police_incidents)
-    print "Police Data Counted."
+    one_year_ago = now - datetime.timedelta(days=370)
+    # Prior windows reach back twice the longest timeframe.
+    snapshot_start = now - datetime.timedelta(days=max(DEFAULT_TIMEFRAMES) * 2 + 5)
+
+    pool = ThreadPool(5) if concurrent else None
+
+    def start(name, f, *args):
+        task = (in_own_session, (current_city(), timer.run, name, f) + args) if pool else (timer.run, (name, f) + args)
+        if pool:
+            return pool.apply_async(*task)
+        return InlineResult(*task)
+
+    try:
+        fire_loading = start('Loading fire data', lambda: build_snapshot(os.path.join(snapshot_dir, 'fire'),
+                                                                         fetch_fire_incident_rows(snapshot_start)))
+        police_loading = start('Loading police data',
+                               lambda: build_snapshot(os.path.join(snapshot_dir, 'police'),
+                                                      fetch_police_incident_rows(snapshot_start)))
+        dispatches_loading = start('Summarizing fire dispatches', summarize_dispatches_since, one_year_ago)
+        business_loading = start('Loading business data', fetch_business_summary_data)
+        business_details_loading = start('Loading business details', fetch_business_details)
+        active_loading = start('Loading active addresses', fetch_active_addresses)
+
+        fire_snapshot = fire_loading.get()
+        timer.count_rows('Loading fire data', len(fire_snapshot))
+        addresses = timer.run('Counting fire data', count_calls_from_snapshot, fire_snapshot,
+                              'fire_counts', 'fire_prior_counts', DEFAULT_TIMEFRAMES, today)
+
+        police_snapshot = police_loading.get()
+        timer.count_rows('Loading police data', len(police_snapshot))
+        police_addresses = timer.run('Counting police data', count_calls_from_snapshot, police_snapshot,
+                                     'police_counts', 'police_prior_counts', DEFAULT_TIMEFRAMES, today)
+
+        dispatch_summaries = dispatches_loading.get()
+        business_info = business_loading.get()
+        business_details = business_details_loading.get()
+        active_addresses = active_loading.get()
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
 
     for address in police_addresses:
         if address.strip() not in addresses:
@@ -109,7 +502,26 @@ if __name__ == '__main__':
         else:
             addresses[address.strip()].update(police_addresses[address.strip()])
 
-    business_info = fetch_business_summary_data()
+    coordinate_sums = sum_snapshot_coordinates(fire_snapshot, 365, today)
+    coordinate_sums = sum_snapshot_coordinates(police_snapshot, 365, today, coordinate_sums)
+    for address, (x_total, y_total, count) in coordinate_sums.iteritems():
+        if address in addresses:
+            addresses[address]['x_coordinate'] = x_total / count
+            addresses[address]['y_coordinate'] = y_total / count
+
+    def rank_call_types():
+        for department, snapshot in [('fire', fire_snapshot), ('police', police_snapshot)]:
+            for num_days in DETAIL_TIMEFRAMES:
+                for address, reasons in snapshot.top_reasons(num_days, today, TOP_REASONS).iteritems():
+                    if department + '_counts' in addresses.get(address, {}):
+                        addresses[address].setdefault(department + '_top_reasons', {})[num_days] = reasons
+
+    timer.run('Ranking call types', rank_call_types)
+
+    for address, dispatch_summary in dispatch_summaries:
+        if address in addresses:
+            addresses[address].update(dispatch_summary)
+
     for row in business_info:
         stripped_address = row[0].strip()
         count = row[1]
@@ -120,7 +532,13 @@ if __name__ == '__main__':
             addresses[stripped_address]['business_types'] = types
             addresses[stripped_address]['business_names'] = names
 
-    active_addresses = fetch_active_addresses()
+    businesses = {}
+    for row in business_details:
+        businesses.setdefault((row[0] or u'').strip(), []).append(row)
+    for address, rows in businesses.iteritems():
+        if address in addresses:
+            addresses[address]['businesses'] = business_list(rows)
+
     for address_row in active_addresses:
         stripped_address = address_row[0].strip()
         if stripped_address in addresses:
@@ -131,7 +549,270 @@ if __name__ == '__main__':
     numbers = ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9']
     summaries = [address_counts_dict_to_call_summary(address, counts) for address, counts in addresses.iteritems()
                  if len(address) > 0 and address[0] in numbers]
+    details = [address_detail_row(address, counts) for address, counts in addresses.iteritems()
+               if len(address) > 0 and address[0] in numbers]
+
+    heatmap_rows = timer.run('Aggregating heatmap cells', lambda: (
+        heatmap_cell_rows('fire', aggregate_snapshot_cells(fire_snapshot, today)) +
+        heatmap_cell_rows('police', aggregate_snapshot_cells(police_snapshot, today))))
+
+    def write_summaries():
+        db.session.query(AddressSummary).delete()
+        [db.session.add(summary) for summary in summaries]
+
+        db.session.query(AddressDetail).delete()
+        if details:
+            db.session.execute(AddressDetail.__table__.insert(), details)
+
+        db.session.query(HeatmapCell).delete()
+        if heatmap_rows:
+            db.session.execute(HeatmapCell.__table__.insert(), heatmap_rows)
+
+        db.session.commit()
+
+    timer.run('Writing summaries', write_summaries)
+    timer.count_rows('Writing summaries', len(summaries) + len(details) + len(heatmap_rows))
+    timer.report()
+
+def rebuild_windows():
+    ''' Today's epoch day, the start of the dispatch window and the start of
+    the incident window, which reaches back to cover the prior windows. '''
+    now = datetime.datetime.now(pytz.utc)
+    return (today_epoch_day(),
+            now - datetime.timedelta(days=370),
+            now - datetime.timedelta(days=max(DEFAULT_TIMEFRAMES) * 2 + 5))
+
+def stream_address_fields(shard, today, one_year_ago, window_start, cells):
+    ''' Merged per-address fields for every address in `shard` (None for all
+    of them), adding each incident to the `cells` CellCounters. '''
+    return merge_by_address(
+        summarize_incidents(fetch_fire_incident_rows(window_start, by_address=True, shard=shard), 'fire',
+                            DEFAULT_TIMEFRAMES, today, cells['fire']),
+        summarize_incidents(fetch_police_incident_rows(window_start, by_address=True, shard=shard), 'police',
+                            DEFAULT_TIMEFRAMES, today, cells['police']),
+        summarize_dispatches(fetch_dispatches_by_address(one_year_ago, shard=shard)),
+        summarize_businesses(fetch_business_summary_data(by_address=True, shard=shard)),
+        summarize_business_details(fetch_business_details(by_address=True, shard=shard)),
+        summarize_active_addresses(fetch_active_addresses(by_address=True, shard=shard)))
+
+def write_address_rows(rows, batch_size, summary_table=AddressSummary.__table__,
+                       detail_table=AddressDetail.__table__):
+    ''' Insert (summary, detail) row pairs `batch_size` pairs at a time.
+    Returns the number of pairs written. '''
+    written = 0
+    for batch in batches(rows, batch_size):
+        db.session.execute(summary_table.insert(), [summary for summary, detail in batch])
+        db.session.execute(detail_table.insert(), [detail for summary, detail in batch])
+        written += len(batch)
+    return written
+
+def write_heatmap_cells(cells, batch_size):
+    db.session.query(HeatmapCell).delete()
+
+    written = 0
+    for department in ['fire', 'police']:
+        heatmap_rows = heatmap_cell_rows(department, cells[department].cells())
+        for batch in batches(heatmap_rows, batch_size):
+            db.session.execute(HeatmapCell.__table__.insert(), batch)
+        written += len(heatmap_rows)
+    return written
 
+def rebuild_summaries_streaming(batch_size=1000, timer=None):
+    ''' rebuild_summaries with memory bounded by `batch_size` rather than by
+    the size of the city. Every input is read from a cursor sorted by address
+    and merged, so each address's summary is finished as soon as its group
+    ends, and summaries are inserted `batch_size` rows at a time. The heatmap
+    counters grow only with the area covered. Everything is committed in one
+    transaction at the end. '''
+    timer = timer or PhaseTimer()
+    today, one_year_ago, window_start = rebuild_windows()
+    cells = {'fire': CellCounter(today), 'police': CellCounter(today)}
+
+    def stream_summaries():
+        db.session.query(AddressSummary).delete()
+        db.session.query(AddressDetail).delete()
+
+        addresses = stream_address_fields(None, today, one_year_ago, window_start, cells)
+        written = write_address_rows(streamed_address_rows(addresses), batch_size)
+        print "Wrote %d summaries." % written
+        return written
+
+    timer.count_rows('Streaming summaries', timer.run('Streaming summaries', stream_summaries))
+
+    def write_heatmap():
+        written = write_heatmap_cells(cells, batch_size)
+        db.session.commit()
+        return written
+
+    timer.count_rows('Writing heatmap cells', timer.run('Writing heatmap cells', write_heatmap))
+    timer.report()
+
+def shard_bounds(shard_count, since):
+    ''' Split the incident addresses seen since `since` into up to
+    `shard_count` contiguous [lower, upper) ranges with about the same
+    number of addresses in each. The first and last ranges are open ended. '''
+    keys = db.session.query(address_sort_key(FireIncident.standardized_address).label('address')) \
+        .filter(FireIncident.alarm_datetime >= since) \
+        .union(db.session.query(address_sort_key(PoliceIncident.standardized_address).label('address'))
+               .filter(PoliceIncident.call_datetime >= since)).subquery()
+    addresses = db.session.query(keys.c.address).distinct().order_by(keys.c.address)
+    address_count = addresses.count()
+
+    boundaries = []
+    for shard in range(1, shard_count):
+        boundary = addresses.offset(shard * address_count // shard_count).limit(1).scalar()
+        if boundary is not None and boundary not in boundaries:
+            boundaries.append(boundary)
+
+    return zip([None] + boundaries, boundaries + [None])
+
+def shard_tables(index):
+    ''' Empty copies of address_summaries and address_details named
+    <table>_shard<index>, where one worker writes its shard's rows. '''
+    metadata = db.MetaData()
+    return [db.Table('%s_shard%d' % (table.name, index), metadata,
+                     *[column.copy() for column in table.columns])
+            for table in [AddressSummary.__table__, AddressDetail.__table__]]
+
+def summarize_shard(args):
+    ''' Worker process entry point: write the summary and detail rows for
+    every address in one shard of `city` to the shard's own tables,
+    `batch_size` at a time, and return how many there were along with the
+    shard's level 0 heatmap cells. '''
+    city, index, shard, today, one_year_ago, window_start, batch_size = args
+    cells = {'fire': CellCounter(today), 'police': CellCounter(today)}
+    with use_city(city):
+        try:
+            tables = shard_tables(index)
+            for table in tables:
+                table.drop(db.engine, checkfirst=True)
+                table.create(db.engine)
+
+            rows = streamed_address_rows(stream_address_fields(shard, today, one_year_ago, window_start, cells))
+            written = write_address_rows(rows, batch_size, *tables)
+            db.session.commit()
+            return written, cells
+        finally:
+            db.session.remove()
+
+def publish_shards(shard_count):
+    ''' Replace address_summaries and address_details with the rows in
+    every shard's tables, in the session's transaction. '''
     db.session.query(AddressSummary).delete()
-    [db.session.add(summary) for summary in summaries]
-    db.session.commit()
\ No newline at end of file
+    db.session.query(AddressDetail).delete()
+
+    for index in range(shard_count):
+        for table, shard_table in zip([AddressSummary.__table__, AddressDetail.__table__], shard_tables(index)):
+            names = [column.name for column in table.columns]
+            db.session.execute(table.insert().from_select(names, db.select([shard_table.c[name] for name in names])))
+
+def rebuild_summaries_sharded(workers, batch_size=1000, timer=None, pool=None):
+    ''' rebuild_summaries_streaming split by address range across `workers`
+    processes. Each shard runs its own sorted queries and counters, and since
+    every input for an address lands in the same shard, the merged output is
+    the same as a single process's. Workers write their shards in batches
+    to tables of their own in parallel, and once they have all finished the
+    shards are copied into place in one transaction, so neither the workers
+    nor this process hold more than a batch of rows. Pass a multiprocessing
+    `pool` to share one between the rebuilds of several cities. '''
+    timer = timer or PhaseTimer()
+    today, one_year_ago, window_start = rebuild_windows()
+    cells = {'fire': CellCounter(today), 'police': CellCounter(today)}
+
+    shards = timer.run('Choosing shards', shard_bounds, workers, window_start)
+
+    # Workers open their own connections; don't let them inherit ours.
+    db.session.remove()
+    db.engine.dispose()
+
+    own_pool = pool is None
+    if own_pool:
+        pool = multiprocessing.Pool(workers)
+
+    def summarize_shards():
+        written = 0
+        jobs = [(current_city(), index, shard, today, one_year_ago, window_start, batch_size)
+                for index, shard in enumerate(shards)]
+        for shard_written, shard_cells in pool.imap_unordered(summarize_shard, jobs):
+            written += shard_written
+            for department in ['fire', 'police']:
+                cells[department].merge(shard_cells[department])
+        print "Summarized %d addresses in %d shards." % (written, len(shards))
+        return written
+
+    def write_heatmap():
+        written = write_heatmap_cells(cells, batch_size)
+        db.session.commit()
+        return written
+
+    try:
+        timer.count_rows('Summarizing shards', timer.run('Summarizing shards', summarize_shards))
+        timer.run('Publishing shards', publish_shards, len(shards))
+        timer.count_rows('Writing heatmap cells', timer.run('Writing heatmap cells', write_heatmap))
+    finally:
+        if own_pool:
+            pool.close()
+            pool.join()
+        db.session.remove()
+        for index in range(len(shards)):
+            for table in shard_tables(index):
+                table.drop(db.engine, checkfirst=True)
+
+    timer.report()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rebuild address summaries from incident data')
+    parser.add_argument('--snapshot-dir',
+                        help='keep the columnar incident snapshot in this directory instead of a temporary one')
+    parser.add_argument('--serial', action='store_true',
+                        help='load data one query at a time on a single connection')
+    parser.add_argument('--streaming', action='store_true',
+                        help='stream address-sorted data and write summaries in batches to bound memory use')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='rows per insert in streaming mode (default: 1000)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='split the streaming rebuild by address range across this many processes')
+    parser.add_argument('--city', action='append', dest='cities', metavar='CITY',
+                        help="rebuild this city's summaries instead of the default city's; may be repeated")
+    parser.add_argument('--all-cities', action='store_true',
+                        help='rebuild the default city and then every city in CITIES')
+    args = parser.parse_args()
+
+    cities = args.cities or [None]
+    if args.all_cities:
+        cities = [None] + sorted(db.get_app().config.get('CITIES') or {})
+
+    # Started before any connections are open, and shared by every city.
+    pool = multiprocessing.Pool(args.workers) if args.workers > 1 else None
+
+    def rebuild(timer):
+        if pool:
+            rebuild_summaries_sharded(args.workers, args.batch_size, timer=timer, pool=pool)
+        elif args.streaming:
+            rebuild_summaries_streaming(args.batch_size, timer=timer)
+        else:
+            snapshot_dir = args.snapshot_dir or tempfile.mkdtemp(prefix='incident-snapshot-')
+            try:
+                rebuild_summaries(snapshot_dir, concurrent=not args.serial, timer=timer)
+            finally:
+                if not args.snapshot_dir:
+                    shutil.rmtree(snapshot_dir)
+
+    locked = False
+    try:
+        for city in cities:
+            if len(cities) > 1:
+                print "Rebuilding %s..." % (city or 'the default city')
+            with use_city(city):
+                try:
+                    run_job(SUMMARY_JOB_NAME, rebuild)
+                except JobLocked as e:
+                    print e
+                    locked = True
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    if locked:
+        sys.exit(1)
@@ -0,0 +1,119 @@
+import csv
+import datetime
+import decimal
+import gzip
+
+import pytz
+from sqlalchemy import types
+
+from dispatches import DISPATCH_DATETIME_FORMATS
+
+# The city's extracts give timestamps in local time without an offset.
+CSV_TIMEZONE = 'America/Los_Angeles'
+TRUE_VALUES = ('t', 'true', 'y', 'yes', '1')
+
+
+def open_csv(path):
+    ''' `path` opened for reading, decompressed as it's read if it ends in .gz. '''
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+
+    return open(path, 'rb')
+
+
+def header_name(field):
+    ''' Extract headers like "CAD Call Number" name the column cad_call_number. '''
+    if field.startswith('\xef\xbb\xbf'):
+        field = field[3:]
+
+    return field.strip().lower().replace(' ', '_')
+
+
+def parse_datetime(value):
+    for datetime_format in DISPATCH_DATETIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, datetime_format)
+        except ValueError:
+            continue
+
+    raise ValueError('unrecognized timestamp %r' % value)
+
+
+def column_coercer(column, timezone):
+    ''' A function turning one CSV field into a value of `column`'s type.
+    Blank fields are null; values that don't fit raise ValueError. '''
+    column_type = column.type
+
+    if isinstance(column_type, types.Boolean):
+        convert = lambda value: value.strip().lower() in TRUE_VALUES
+    elif isinstance(column_type, types.Integer):
+        convert = lambda value: int(value.strip())
+    elif isinstance(column_type, types.Float):
+        convert = lambda value: float(value.strip())
+    elif isinstance(column_type, types.Numeric):
+        convert = lambda value: decimal.Decimal(value.strip())
+    elif isinstance(column_type, types.DateTime):
+        def convert(value):
+            value = parse_datetime(value.strip())
+            if column_type.timezone:
+                value = timezone.localize(value)
+            return value
+    elif isinstance(column_type, types.Date):
+        convert = lambda value: parse_datetime(value.strip()).date()
+    else:
+        length = getattr(column_type, 'length', None)
+
+        def convert(value):
+            value = value.decode('utf-8')
+            if length is not None and len(value) > length:
+                raise ValueError('%r is longer than %d characters' % (value, length))
+            return value
+
+    return lambda value: convert(value) if value.strip() else None
+
+
+class CsvSource(object):
+    ''' Reads a CSV export with a header row in place of a query on the host
+    database. Like a result proxy, it has keys() and fetchmany(); rows come
+    back as dicts with each field coerced to the type of the column of
+    `table` it names, and fields for columns `table` doesn't have are left
+    out. The file is read as it's fetched, so memory stays with the chunk. '''
+
+    def __init__(self, path, table, timezone=CSV_TIMEZONE):
+        self.path = path
+        self.file = open_csv(path)
+        self.reader = csv.reader(self.file)
+
+        header = [header_name(field) for field in next(self.reader, [])]
+        timezone = pytz.timezone(timezone)
+        self.fields = [(index, name, column_coercer(table.c[name], timezone))
+                       for index, name in enumerate(header) if name in table.c]
+        self.ignored = [name for name in header if name not in table.c]
+
+    def keys(self):
+        return [name for index, name, convert in self.fields]
+
+    def coerce(self, fields):
+        row = {}
+        for index, name, convert in self.fields:
+            try:
+                row[name] = convert(fields[index] if index < len(fields) else '')
+            except ValueError as e:
+                raise ValueError('%s line %d, %s: %s' % (self.path, self.reader.line_num, name, e))
+        return row
+
+    def fetchmany(self, size):
+        rows = []
+        for fields in self.reader:
+            # Blank lines come back as no fields at all.
+            if fields:
+                rows.append(self.coerce(fields))
+                if len(rows) == size:
+                    break
+
+        if not rows:
+            self.close()
+        return rows
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,248 @@
+import os
+import threading
+from contextlib import contextmanager
+
+from flask import Flask, current_app
+from flask.ext.sqlalchemy import SQLAlchemy, _EngineConnector, _SignallingSession
+from sqlalchemy import orm
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.sql.expression import Select
+from sqlalchemy.sql.util import find_tables
+
+from cache import TTLCache
+
+# The city whose databases this thread's queries go to; None is the default
+# city, configured by SQLALCHEMY_DATABASE_URI and SQLALCHEMY_BINDS as usual.
+city_state = threading.local()
+# Whether this thread's reads may go to the replicas.
+replica_state = threading.local()
+
+# Seconds each process trusts its last check of how far a replica is behind.
+REPLICA_CHECK_SECONDS = 5
+
+# How far a PostgreSQL standby is behind, in seconds. It's caught up when it
+# has replayed everything it has received, however long ago that was.
+REPLICA_LAG_QUERY = '''
+SELECT CASE WHEN pg_last_xlog_receive_location() = pg_last_xlog_replay_location() THEN 0
+            ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END
+'''
+
+
+def load_config(app):
+    try:
+        import clb_config
+        app.config.from_object('clb_config.Config')
+    except:
+        app.config.from_object(os.environ['APP_SETTINGS'])
+
+
+def create_base_app(import_name=__name__):
+    ''' A Flask app with the configuration loaded and the database set up,
+    and none of the web app's views, auth or assets. app.setup_web_app builds
+    the web app on top of it. '''
+    app = Flask(import_name)
+    load_config(app)
+
+    db.init_app(app)
+    # Jobs and scripts use db.session outside of any request.
+    db.app = app
+    return app
+
+
+def current_city():
+    return getattr(city_state, 'name', None)
+
+
+def set_city(city):
+    ''' Send this thread's queries to `city`'s databases from now on. The
+    thread's session is closed if it was using another city's, so objects
+    and connections never cross from one city to the next. '''
+    if city is not None and city not in (db.get_app().config.get('CITIES') or {}):
+        raise ValueError('Unknown city %r' % city)
+
+    if city != current_city():
+        db.session.remove()
+        city_state.name = city
+
+
+@contextmanager
+def use_city(city):
+    ''' set_city for the length of a with block. '''
+    previous = current_city()
+    set_city(city)
+    try:
+        yield
+    finally:
+        set_city(previous)
+
+
+@contextmanager
+def replica_reads(enabled=True):
+    ''' Within the block, this thread's SELECTs go to the read replicas when
+    there are any and they're keeping up, unless not `enabled`. Writes
+    always go to the primary. '''
+    previous = getattr(replica_state, 'enabled', False)
+    replica_state.enabled = enabled
+    try:
+        yield
+    finally:
+        replica_state.enabled = previous
+
+
+def city_config(app, city):
+    ''' The settings naming `city`'s databases: the app's own for the
+    default city, otherwise its entry in CITIES. '''
+    return app.config if city is None else app.config['CITIES'][city]
+
+
+def replica_uri(config, bind):
+    ''' The replica of `bind` in SQLALCHEMY_REPLICA_URI or
+    SQLALCHEMY_REPLICA_BINDS, or None when it doesn't have one. '''
+    if bind is None:
+        return config.get('SQLALCHEMY_REPLICA_URI')
+
+    return (config.get('SQLALCHEMY_REPLICA_BINDS') or {}).get(bind)
+
+
+def statement_tables(mapper, clause):
+    ''' The tables a statement the session is running reads or writes. '''
+    if clause is not None:
+        return find_tables(clause, include_crud=True)
+    if mapper is not None:
+        return [mapper.mapped_table]
+    return []
+
+
+def statement_bind_key(mapper, tables):
+    ''' The bind key of the table a query is on, as Flask-SQLAlchemy's
+    session finds it for mapped classes. '''
+    if mapper is not None:
+        tables = [mapper.mapped_table]
+
+    for table in tables:
+        return getattr(table, 'info', {}).get('bind_key')
+
+
+class RoutedEngineConnector(_EngineConnector):
+    ''' Connects to one of a city's databases, or to a replica of one. Its
+    bind is (city, bind key, replica), looked up in city_config the way the
+    default city's primaries are in SQLALCHEMY_DATABASE_URI and
+    SQLALCHEMY_BINDS. '''
+
+    def get_uri(self):
+        city, bind, replica = self._bind
+        config = city_config(self._app, city)
+        if replica:
+            return replica_uri(config, bind)
+
+        if bind is None:
+            return config['SQLALCHEMY_DATABASE_URI']
+
+        binds = config.get('SQLALCHEMY_BINDS') or ()
+        assert bind in binds, 'Bind %r is not specified for %s' % (bind, city)
+        return binds[bind]
+
+
+class RoutingSession(_SignallingSession):
+    ''' Sends SELECTs to a replica within replica_reads(), except those on
+    tables the session has written to; it reads those from the primary, so
+    it sees its own writes. '''
+
+    def __init__(self, db, **options):
+        self.db = db
+        # Tables written to, or None once there's been a write to who knows what.
+        self.written = set()
+        _SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        tables = statement_tables(mapper, clause)
+        if not isinstance(clause, Select):
+            # Flushes, and INSERTs, UPDATEs and DELETEs executed directly.
+            if tables and self.written is not None:
+                self.written.update(tables)
+            else:
+                self.written = None
+        elif getattr(replica_state, 'enabled', False) and self.written is not None \
+                and not self.written.intersection(tables):
+            replica = self.db.get_replica_engine(self.app, statement_bind_key(mapper, tables))
+            if replica is not None:
+                return replica
+
+        return _SignallingSession.get_bind(self, mapper, clause)
+
+    def close(self):
+        _SignallingSession.close(self)
+        self.written = set()
+
+
+class Database(SQLAlchemy):
+    ''' Flask-SQLAlchemy that sets up a bare app with create_base_app when
+    it's first used without one, as in batch scripts that never import the
+    web app. Engines are only created on first use either way.
+
+    Every engine it hands out is for the current city, each with a pool of
+    its own, so sessions, db.engine and create_all all follow set_city.
+    Sessions can read from replicas; see RoutingSession. '''
+
+    def __init__(self, *args, **kwargs):
+        # Whether each replica engine was within REPLICA_MAX_LAG_SECONDS.
+        self.replica_checks = TTLCache(REPLICA_CHECK_SECONDS)
+        SQLAlchemy.__init__(self, *args, **kwargs)
+
+    def get_app(self, reference_app=None):
+        if reference_app is None and self.app is None and not current_app:
+            create_base_app()
+
+        return SQLAlchemy.get_app(self, reference_app)
+
+    def create_scoped_session(self, options=None):
+        options = dict(options or {})
+        scopefunc = options.pop('scopefunc', None)
+        return orm.scoped_session(lambda: RoutingSession(self, **options), scopefunc=scopefunc)
+
+    def make_connector(self, app, bind=None):
+        if isinstance(bind, tuple):
+            return RoutedEngineConnector(self, app, bind)
+
+        return SQLAlchemy.make_connector(self, app, bind)
+
+    def get_engine(self, app, bind=None):
+        city = current_city()
+        if city is not None and not isinstance(bind, tuple):
+            bind = (city, bind, False)
+
+        return SQLAlchemy.get_engine(self, app, bind)
+
+    def get_replica_engine(self, app, bind=None):
+        ''' The current city's replica of `bind`, or None if it hasn't got
+        one or the replica is too far behind or can't be reached. '''
+        city = current_city()
+        if replica_uri(city_config(app, city), bind) is None:
+            return None
+
+        engine = SQLAlchemy.get_engine(self, app, (city, bind, True))
+        current = self.replica_checks.get(engine)
+        if current is None:
+            max_lag = app.config.get('REPLICA_MAX_LAG_SECONDS', 10)
+            try:
+                lag = self.replica_lag(engine)
+            except DBAPIError as e:
+                app.logger.warning('Reading from the primary, the replica failed: %r' % e)
+                lag = None
+            current = lag is not None and lag <= max_lag
+            if lag is not None and not current:
+                app.logger.warning('Reading from the primary, the replica is %.1fs behind' % lag)
+            self.replica_checks.set(engine, current)
+
+        return engine if current else None
+
+    def replica_lag(self, engine):
+        ''' Seconds the replica `engine` connects to is behind its primary.
+        Only PostgreSQL can tell; other replicas are taken to be caught up. '''
+        if engine.dialect.name != 'postgresql':
+            return 0
+
+        return engine.execute(REPLICA_LAG_QUERY).scalar() or 0
+
+
+db = Database()
@@ -0,0 +1,87 @@
+import datetime
+import itertools
+import json
+
+from sketches import TDigest
+
+# Timestamp layouts seen in CAD dispatch extracts.
+DISPATCH_DATETIME_FORMATS = [
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%d %H:%M:%S.%f',
+    '%m/%d/%Y %H:%M:%S',
+    '%m/%d/%Y %I:%M:%S %p',
+    '%m/%d/%Y %H:%M',
+]
+
+
+def parse_dispatch_datetime(value):
+    ''' fire_dispatches stores its timestamps as CHAR(30); blank or
+    unrecognized values come back as None. '''
+    if not value:
+        return None
+
+    value = value.strip()
+    for datetime_format in DISPATCH_DATETIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, datetime_format)
+        except ValueError:
+            continue
+
+    return None
+
+
+def seconds_between(start, end):
+    start = parse_dispatch_datetime(start)
+    end = parse_dispatch_datetime(end)
+    if start is None or end is None or end < start:
+        return None
+
+    delta = end - start
+    return delta.days * 86400 + delta.seconds
+
+
+def dispatch_durations(dispatch):
+    ''' Unit time and response time in seconds for one dispatch row of
+    (address, dispatch, arrival, clear, response_time_in_sec,
+    duration_time_in_sec), preferring the CAD's own durations. '''
+    address, dispatched, arrived, cleared, response_seconds, duration_seconds = dispatch
+
+    if duration_seconds is None:
+        duration_seconds = seconds_between(dispatched, cleared)
+    if response_seconds is None:
+        response_seconds = seconds_between(dispatched, arrived)
+
+    return duration_seconds, response_seconds
+
+
+def summarize_dispatches(dispatches):
+    ''' Consume dispatch rows sorted by address and yield (address, totals)
+    as each address's group ends, so only one address is held at a time. '''
+    for address, rows in itertools.groupby(dispatches, key=lambda dispatch: (dispatch[0] or '').strip()):
+        dispatch_count = 0
+        unit_seconds = 0
+        response_times = TDigest()
+
+        for dispatch in rows:
+            duration_seconds, response_seconds = dispatch_durations(dispatch)
+
+            dispatch_count += 1
+            if duration_seconds is not None:
+                unit_seconds += duration_seconds
+            if response_seconds is not None:
+                response_times.add(response_seconds)
+
+        yield address, {
+            'fire_dispatch_count': dispatch_count,
+            'fire_unit_seconds': unit_seconds,
+            'fire_response_p50': seconds_or_none(response_times.quantile(0.5)),
+            'fire_response_p90': seconds_or_none(response_times.quantile(0.9)),
+            'fire_response_digest': json.dumps(response_times.to_list(), separators=(',', ':'))
+        }
+
+
+def seconds_or_none(value):
+    if value is None:
+        return None
+
+    return int(round(value))
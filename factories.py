@@ -5,7 +5,7 @@ import datetime
 import pytz
 import models
 
-from app import app, db
+from database import db
 
 class FireIncidentFactory(factory.alchemy.SQLAlchemyModelFactory):
     class Meta:
@@ -39,4 +39,11 @@ class UserFactory(factory.alchemy.SQLAlchemyModelFactory):
 
     email = factory.fuzzy.FuzzyText(suffix='@example.org')
     name = factory.fuzzy.FuzzyText()
-    
\ No newline at end of file
+    
+class AddressSummaryFactory(factory.alchemy.SQLAlchemyModelFactory):
+    class Meta:
+        model = models.AddressSummary
+        sqlalchemy_session = db.session
+
+    business_count = 0
+    active = False
@@ -0,0 +1,107 @@
+import datetime
+from datetime import timedelta
+
+from flask import request
+from flask.sessions import SecureCookieSessionInterface, total_seconds
+from itsdangerous import BadSignature
+from werkzeug.wsgi import SharedDataMiddleware
+
+from cities import request_city
+
+HEALTH_CHECK_PATH = '/health'
+
+
+class FastPathMiddleware(object):
+    ''' Serves static files and health checks before the Flask request context
+    is created, so they skip the session, maintenance, SSLify, login and audit
+    machinery entirely.
+    '''
+
+    def __init__(self, wsgi_app, static_url_path, static_folder,
+                 health_check_path=HEALTH_CHECK_PATH):
+        self.wsgi_app = wsgi_app
+        self.static_url_path = static_url_path.rstrip('/') + '/'
+        self.health_check_path = health_check_path
+        self.static_app = SharedDataMiddleware(self.not_found,
+                                               {static_url_path: static_folder})
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+
+        if path == self.health_check_path:
+            start_response('200 OK', [('Content-Type', 'text/plain'),
+                                      ('Content-Length', '2'),
+                                      ('Cache-Control', 'no-cache')])
+            return ['OK']
+
+        if path.startswith(self.static_url_path):
+            return self.static_app(environ, start_response)
+
+        return self.wsgi_app(environ, start_response)
+
+    def not_found(self, environ, start_response):
+        start_response('404 NOT FOUND', [('Content-Type', 'text/plain')])
+        return ['Not Found']
+
+
+class SlidingSessionInterface(SecureCookieSessionInterface):
+    ''' A signed cookie session that is only re-sent when its contents change
+    or when its signature is within `SESSION_REFRESH_WINDOW` of expiring.
+
+    The stock interface re-signs the cookie on every response, which is what
+    kept the sliding 15 minute expiry alive but also made every response
+    carry a fresh Set-Cookie header.
+
+    Each city's session has a cookie of its own, since user ids are only
+    unique within one city's database.
+    '''
+
+    def get_cookie_name(self, app, environ):
+        city = request_city(environ)
+        return app.session_cookie_name if city is None else '%s_%s' % (app.session_cookie_name, city)
+
+    def open_session(self, app, request):
+        s = self.get_signing_serializer(app)
+        if s is None:
+            return None
+        val = request.cookies.get(self.get_cookie_name(app, request.environ))
+        if not val:
+            return self.session_class()
+        max_age = total_seconds(app.permanent_session_lifetime)
+        try:
+            data, signed_at = s.loads(val, max_age=max_age, return_timestamp=True)
+        except BadSignature:
+            return self.session_class()
+
+        session = self.session_class(data)
+        session.original_data = dict(data)
+        session.signed_at = signed_at
+        return session
+
+    def needs_refresh(self, app, session):
+        signed_at = getattr(session, 'signed_at', None)
+        if signed_at is None:
+            return True
+
+        refresh_window = app.config.get('SESSION_REFRESH_WINDOW', timedelta(minutes=5))
+        age = datetime.datetime.utcnow() - signed_at
+        return age >= app.permanent_session_lifetime - refresh_window
+
+    def save_session(self, app, session, response):
+        if session and dict(session) == getattr(session, 'original_data', None) \
+                and not self.needs_refresh(app, session):
+            return
+
+        # The stock save_session, under this city's cookie name.
+        name = self.get_cookie_name(app, request.environ)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.modified:
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        response.set_cookie(name, self.get_signing_serializer(app).dumps(dict(session)),
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                            secure=self.get_cookie_secure(app))
@@ -1,27 +1,39 @@
 import argparse
 from sqlalchemy import create_engine
-from transformer import transform
+from transformer import transform, ExcludeStartingWith
 
 table_name = 'fire_incidents'
 transformations = []
+# Duplicate CAD rows collapse into the last one loaded.
+unique_key = ['cad_call_number']
+# Later runs only copy rows past the last one seen in this column.
+incremental_column = 'cad_call_number'
 
-def remove_900X(row):
-    ''' Remove calls with types in the 900-range, which aren't relevant for us '''
-    if row.actual_nfirs_incident_type_description and row.actual_nfirs_incident_type_description[0] == '9':
-        return None
-    else:
-        return row
-
+# Calls with types in the 900-range aren't relevant for us. As a Rule, this
+# runs in the host database's WHERE clause.
+remove_900X = ExcludeStartingWith('actual_nfirs_incident_type_description', '9')
 
 transformations.append(remove_900X)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Transform a database')
-    parser.add_argument('--hostdb')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--hostdb')
+    source.add_argument('--csv', metavar='PATH', help='read rows from a CSV or CSV.gz export instead of --hostdb')
     parser.add_argument('--destinationdb')
+    parser.add_argument('--full-refresh', action='store_true',
+                        help='copy every row instead of only those past the high-water mark')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue an interrupted run after its last committed batch')
+    parser.add_argument('--staging', action='store_true',
+                        help='load every row into a staging table and swap it in at the end')
+    parser.add_argument('--metrics', metavar='PATH',
+                        help='append timings and row counts for the run to PATH as a line of JSON')
     args = parser.parse_args()
 
-    host_engine = create_engine(args.hostdb)
+    host_engine = create_engine(args.hostdb) if args.hostdb else None
     dest_engine = create_engine(args.destinationdb)
 
-    transform(host_engine, dest_engine, table_name, transformations)
+    transform(host_engine, dest_engine, table_name, transformations, unique_key,
+              incremental_column, args.full_refresh, args.resume, args.staging, args.metrics,
+              args.csv)
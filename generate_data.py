@@ -1,5 +1,5 @@
 from factories import FireIncidentFactory, PoliceIncidentFactory, BusinessLicenseFactory
-from app import db
+from database import db
 import factory
 import factory.fuzzy
 import datetime
@@ -0,0 +1,112 @@
+import math
+
+import numpy as np
+
+from incident_snapshot import epoch_day, today_epoch_day
+from spatial_index import parse_coordinate
+
+# Level 0 cells are BASE_CELL_FEET on a side; each level up doubles that,
+# so a level's cells are exactly four cells of the level below.
+BASE_CELL_FEET = 250
+LEVELS = 7
+# Tiles are TILE_CELLS x TILE_CELLS cells at their level.
+TILE_CELLS = 64
+TIMEFRAMES = [7, 30, 90, 365]
+DEPARTMENTS = ['fire', 'police']
+
+
+def cell_size(level):
+    return BASE_CELL_FEET * 2 ** level
+
+
+class CellCounter(object):
+    ''' Counts incidents per level 0 cell one at a time, so memory grows with
+    the area covered rather than with the number of incidents. Windows are
+    whole days, like IncidentSnapshot. '''
+
+    def __init__(self, today, timeframes=TIMEFRAMES):
+        self.today = today
+        self.timeframes = timeframes
+        self.base_cells = {}
+
+    def add(self, incident_datetime, x, y):
+        x = parse_coordinate(x)
+        y = parse_coordinate(y)
+        if incident_datetime is None or x is None or y is None:
+            return
+
+        day = epoch_day(incident_datetime)
+        cell_x = int(math.floor(x / BASE_CELL_FEET))
+        cell_y = int(math.floor(y / BASE_CELL_FEET))
+        for days in self.timeframes:
+            if day > self.today - days:
+                key = (days, cell_x, cell_y)
+                self.base_cells[key] = self.base_cells.get(key, 0) + 1
+
+    def merge(self, other):
+        for key, count in other.base_cells.iteritems():
+            self.base_cells[key] = self.base_cells.get(key, 0) + count
+
+    def cells(self, levels=LEVELS):
+        ''' Roll the base cells up through `levels` levels. Returns a dict keyed
+        by (days, level, cell_x, cell_y). '''
+        cells = {}
+        level_cells = self.base_cells
+        for level in range(levels):
+            parent_cells = {}
+            for (days, cell_x, cell_y), count in level_cells.iteritems():
+                cells[(days, level, cell_x, cell_y)] = count
+
+                parent = (days, cell_x >> 1, cell_y >> 1)
+                parent_cells[parent] = parent_cells.get(parent, 0) + count
+            level_cells = parent_cells
+
+        return cells
+
+
+def aggregate_incident_cells(incidents, timeframes=TIMEFRAMES, levels=LEVELS, today=None):
+    ''' Count incidents per grid cell for every timeframe and level. Incidents
+    are (address, datetime, x, y) tuples. Returns a dict keyed by
+    (days, level, cell_x, cell_y). '''
+    counter = CellCounter(today_epoch_day() if today is None else today, timeframes)
+    for incident in incidents:
+        counter.add(incident[1], incident[2], incident[3])
+
+    return counter.cells(levels)
+
+
+def aggregate_snapshot_cells(snapshot, today, timeframes=TIMEFRAMES, levels=LEVELS):
+    ''' aggregate_incident_cells for an IncidentSnapshot, counting each
+    window's cells with one np.unique per level. '''
+    cells = {}
+    for days in timeframes:
+        rows = snapshot.window(today, days)
+        x = snapshot.x[rows]
+        y = snapshot.y[rows]
+        geocoded = ~(np.isnan(x) | np.isnan(y))
+
+        cell_x = np.floor(x[geocoded] / BASE_CELL_FEET).astype(np.int64)
+        cell_y = np.floor(y[geocoded] / BASE_CELL_FEET).astype(np.int64)
+
+        for level in range(levels):
+            if len(cell_x) == 0:
+                break
+
+            # Pack each (x, y) pair into one integer so np.unique can count them.
+            min_y = cell_y.min()
+            span_y = cell_y.max() - min_y + 1
+            keys, counts = np.unique((cell_x * span_y) + (cell_y - min_y), return_counts=True)
+            for key, count in zip(keys, counts):
+                packed_x, packed_y = divmod(int(key), int(span_y))
+                cells[(days, level, packed_x, packed_y + int(min_y))] = int(count)
+
+            cell_x = cell_x >> 1
+            cell_y = cell_y >> 1
+
+    return cells
+
+
+def tile_cell_range(tile_index):
+    ''' The first and last cell index along one axis covered by a tile. '''
+    first = tile_index * TILE_CELLS
+    return first, first + TILE_CELLS - 1
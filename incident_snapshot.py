@@ -0,0 +1,174 @@
+import array
+import codecs
+import datetime
+import os
+
+import numpy as np
+import pytz
+
+from spatial_index import parse_coordinate
+
+EPOCH = datetime.date(1970, 1, 1)
+
+COLUMNS = [
+    ('address_ids', 'i', np.int32),
+    ('days', 'i', np.int32),
+    ('call_type_ids', 'i', np.int32),
+    ('x', 'f', np.float32),
+    ('y', 'f', np.float32),
+]
+
+
+def epoch_day(value):
+    ''' Days since 1970-01-01, taking the UTC date of aware datetimes. '''
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(pytz.utc)
+        value = value.date()
+
+    return (value - EPOCH).days
+
+
+def today_epoch_day():
+    return epoch_day(datetime.datetime.now(pytz.utc))
+
+
+def write_lines(path, values):
+    with codecs.open(path, 'w', 'utf-8') as output:
+        for value in values:
+            output.write(value + u'\n')
+
+
+def read_lines(path):
+    with codecs.open(path, 'r', 'utf-8') as lines:
+        return [line.rstrip(u'\n') for line in lines]
+
+
+class IncidentSnapshot(object):
+    ''' One department's incidents as memory-mapped NumPy columns sorted by
+    day: dictionary-encoded address and call type ids, the epoch day of each
+    call, and its x/y coordinates (NaN when not geocoded). Since rows are
+    sorted by day, any time window is a contiguous slice found with
+    searchsorted, and per-address counts are a bincount over that slice.
+    '''
+
+    def __init__(self, directory, addresses, call_types, columns):
+        self.directory = directory
+        self.addresses = addresses
+        self.call_types = call_types
+
+        for name, values in columns.iteritems():
+            setattr(self, name, values)
+
+    @classmethod
+    def build(cls, directory, incidents):
+        ''' Write a snapshot of `incidents`, an iterable of (address, datetime,
+        call type, x, y) rows, to `directory` and open it. Rows are appended
+        to compact typed arrays as they stream in. '''
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        address_ids = {}
+        call_type_ids = {}
+        columns = dict((name, array.array(typecode)) for name, typecode, dtype in COLUMNS)
+        nan = float('nan')
+
+        for address, incident_datetime, call_type, x, y in incidents:
+            if incident_datetime is None:
+                continue
+
+            address = (address or u'').strip()
+            call_type = (call_type or u'').strip()
+            x = parse_coordinate(x)
+            y = parse_coordinate(y)
+
+            columns['address_ids'].append(address_ids.setdefault(address, len(address_ids)))
+            columns['days'].append(epoch_day(incident_datetime))
+            columns['call_type_ids'].append(call_type_ids.setdefault(call_type, len(call_type_ids)))
+            columns['x'].append(nan if x is None or y is None else x)
+            columns['y'].append(nan if x is None or y is None else y)
+
+        days = np.frombuffer(columns['days'], dtype=np.int32) if columns['days'] else np.zeros(0, np.int32)
+        order = np.argsort(days, kind='mergesort')
+
+        for name, typecode, dtype in COLUMNS:
+            values = np.frombuffer(columns[name], dtype=dtype) if columns[name] else np.zeros(0, dtype)
+            np.save(os.path.join(directory, name + '.npy'), values[order])
+            del columns[name]
+
+        write_lines(os.path.join(directory, 'addresses.txt'), sorted(address_ids, key=address_ids.get))
+        write_lines(os.path.join(directory, 'call_types.txt'), sorted(call_type_ids, key=call_type_ids.get))
+
+        return cls.open(directory)
+
+    @classmethod
+    def open(cls, directory):
+        columns = {}
+        for name, typecode, dtype in COLUMNS:
+            columns[name] = np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+
+        return cls(directory,
+                   read_lines(os.path.join(directory, 'addresses.txt')),
+                   read_lines(os.path.join(directory, 'call_types.txt')),
+                   columns)
+
+    def __len__(self):
+        return len(self.days)
+
+    def window(self, today, start_days_ago, end_days_ago=0):
+        ''' The slice of rows whose day falls after `start_days_ago` days
+        before `today` and on or before `end_days_ago` days before it. '''
+        first = np.searchsorted(self.days, today - start_days_ago, side='right')
+        last = np.searchsorted(self.days, today - end_days_ago, side='right')
+        return slice(first, last)
+
+    def count_rows(self, rows):
+        return np.bincount(self.address_ids[rows], minlength=len(self.addresses))
+
+    def window_counts(self, days, today):
+        ''' Incidents per address id in the last `days` days. '''
+        return self.count_rows(self.window(today, days))
+
+    def prior_window_counts(self, days, today):
+        ''' Incidents per address id in the `days` days before the last `days`. '''
+        return self.count_rows(self.window(today, 2 * days, days))
+
+    def coordinate_totals(self, days, today):
+        ''' Summed x and y and the number of geocoded incidents per address id
+        over the last `days` days. '''
+        rows = self.window(today, days)
+        x = self.x[rows]
+        y = self.y[rows]
+        geocoded = ~(np.isnan(x) | np.isnan(y))
+        address_ids = self.address_ids[rows][geocoded]
+
+        x_totals = np.bincount(address_ids, weights=x[geocoded], minlength=len(self.addresses))
+        y_totals = np.bincount(address_ids, weights=y[geocoded], minlength=len(self.addresses))
+        counts = np.bincount(address_ids, minlength=len(self.addresses))
+
+        return x_totals, y_totals, counts
+
+    def top_reasons(self, days, today, limit=5):
+        ''' The `limit` most common call types per address in the last `days`
+        days, as {address: [(call type, count), ...]}, most common first. '''
+        rows = self.window(today, days)
+        keys = self.address_ids[rows].astype(np.int64) * len(self.call_types) + self.call_type_ids[rows]
+        keys, counts = np.unique(keys, return_counts=True)
+        address_ids = keys // max(len(self.call_types), 1)
+        call_type_ids = keys % max(len(self.call_types), 1)
+
+        # Sort by address, then by descending count, then by call type name.
+        call_type_ranks = np.argsort(np.argsort(np.array(self.call_types, dtype=object)))
+        order = np.lexsort((call_type_ranks[call_type_ids], -counts, address_ids))
+        address_ids = address_ids[order]
+        call_type_ids = call_type_ids[order]
+        counts = counts[order]
+
+        group_starts = np.searchsorted(address_ids, address_ids, side='left')
+        keep = np.arange(len(address_ids)) - group_starts < limit
+
+        top = {}
+        for address_id, call_type_id, count in zip(address_ids[keep], call_type_ids[keep], counts[keep]):
+            top.setdefault(self.addresses[address_id], []).append((self.call_types[call_type_id], int(count)))
+
+        return top
@@ -0,0 +1,156 @@
+from database import db, current_city
+from models import JobRun
+import pytz
+
+import datetime
+import fcntl
+import json
+import os
+import resource
+import tempfile
+import threading
+import time
+import traceback
+import zlib
+
+
+def peak_memory_kb():
+    ''' The largest resident set size so far of this process or any of its
+    finished worker processes. '''
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+class PhaseTimer(object):
+    ''' Records how long each named phase of a job takes, from when it
+    starts until it finishes, even when phases overlap in threads, along
+    with the peak memory when it finished and any row count reported for it. '''
+
+    def __init__(self):
+        self.started = time.time()
+        self.durations = []
+        self.row_counts = {}
+        self.peak_memory = {}
+        self.lock = threading.Lock()
+
+    def run(self, name, f, *args):
+        print "%s..." % name
+        phase_started = time.time()
+        try:
+            return f(*args)
+        finally:
+            elapsed = time.time() - phase_started
+            with self.lock:
+                self.durations.append((name, elapsed))
+                self.peak_memory[name] = peak_memory_kb()
+            print "%s took %.2fs." % (name, elapsed)
+
+    def count_rows(self, name, rows):
+        with self.lock:
+            self.row_counts[name] = rows
+
+    def phases(self):
+        return [{'name': name,
+                 'seconds': round(elapsed, 3),
+                 'rows': self.row_counts.get(name),
+                 'peak_memory_kb': self.peak_memory.get(name)}
+                for name, elapsed in self.durations]
+
+    def report(self):
+        print "Phase wall times:"
+        for phase in self.phases():
+            rows = '' if phase['rows'] is None else '%d rows' % phase['rows']
+            print "  %-32s %8.2fs %14s %10d KB" % (phase['name'], phase['seconds'], rows, phase['peak_memory_kb'])
+        print "  %-32s %8.2fs" % ('Total', time.time() - self.started)
+
+
+class JobLocked(Exception):
+    pass
+
+
+class JobLock(object):
+    ''' Keeps two runs of the same job from overlapping. On PostgreSQL this is
+    a session advisory lock held on a connection of its own; on other
+    databases, such as SQLite, it's an flock on a file in JOB_LOCK_DIR. '''
+
+    def __init__(self, name):
+        # Each city's runs are locked separately.
+        city = current_city()
+        self.name = name if city is None else '%s.%s' % (name, city)
+        self.connection = None
+        self.lock_file = None
+        self.acquired = False
+
+    def key(self):
+        return zlib.crc32(self.name) & 0x7fffffff
+
+    def __enter__(self):
+        if db.engine.dialect.name == 'postgresql':
+            self.connection = db.engine.connect()
+            self.acquired = self.connection.execute(db.select([db.func.pg_try_advisory_lock(self.key())])).scalar()
+        else:
+            lock_dir = db.get_app().config.get('JOB_LOCK_DIR', tempfile.gettempdir())
+            self.lock_file = open(os.path.join(lock_dir, '%s.lock' % self.name), 'a')
+            try:
+                fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self.acquired = True
+            except IOError:
+                self.acquired = False
+
+        if not self.acquired:
+            self.release()
+            raise JobLocked('%s is already running.' % self.name)
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.release()
+
+    def release(self):
+        if self.connection is not None:
+            if self.acquired:
+                self.connection.execute(db.select([db.func.pg_advisory_unlock(self.key())]))
+            self.connection.close()
+            self.connection = None
+
+        if self.lock_file is not None:
+            if self.acquired:
+                fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+            self.lock_file.close()
+            self.lock_file = None
+
+        self.acquired = False
+
+
+def run_job(name, job, *args):
+    ''' Run `job(timer, *args)` under the job's lock and record the run in
+    job_runs: its status, duration, peak memory and the timer's phases.
+    Raises JobLocked without running anything if another run holds the lock. '''
+    with JobLock(name):
+        run = JobRun(job_name=name, status='running', started_at=datetime.datetime.now(pytz.utc))
+        db.session.add(run)
+        db.session.commit()
+        run_id = run.id
+
+        timer = PhaseTimer()
+        status = 'failed'
+        error = None
+        try:
+            result = job(timer, *args)
+            status = 'succeeded'
+            return result
+        except Exception:
+            error = traceback.format_exc()
+            raise
+        finally:
+            # Whatever the job left uncommitted is abandoned, not recorded.
+            db.session.rollback()
+
+            run = JobRun.query.get(run_id)
+            run.status = status
+            run.finished_at = datetime.datetime.now(pytz.utc)
+            run.duration_seconds = time.time() - timer.started
+            run.peak_memory_kb = peak_memory_kb()
+            run.phases = json.dumps(timer.phases())
+            run.error = error
+            db.session.commit()
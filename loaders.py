@@ -0,0 +1,101 @@
+from cStringIO import StringIO
+
+from sqlalchemy import MetaData, Table, util
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.sql import select
+
+
+def copy_value(value):
+    ''' One CSV field for COPY: unquoted empty for null, so that quoted empty
+    strings stay empty strings. '''
+    if value is None:
+        return ''
+
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    else:
+        value = str(value)
+
+    return '"%s"' % value.replace('"', '""')
+
+
+class ExecutemanyLoader(object):
+    ''' Inserts each batch with an executemany; works on any database. '''
+
+    def __init__(self, table):
+        self.table = table
+
+    def insert(self, connection, rows):
+        if rows:
+            connection.execute(self.table.insert(), rows)
+
+
+class CopyLoader(ExecutemanyLoader):
+    ''' Streams each batch to PostgreSQL through COPY FROM STDIN as CSV, on
+    the connection's own transaction. '''
+
+    def statement(self, connection):
+        preparer = connection.dialect.identifier_preparer
+        return 'COPY %s (%s) FROM STDIN WITH CSV' % (
+            preparer.format_table(self.table),
+            ', '.join(preparer.quote(column.name) for column in self.table.columns))
+
+    def insert(self, connection, rows):
+        if not rows:
+            return
+
+        names = [column.name for column in self.table.columns]
+        buffer = StringIO()
+        for row in rows:
+            buffer.write(','.join(copy_value(row.get(name)) for name in names))
+            buffer.write('\n')
+        buffer.seek(0)
+
+        statement = self.statement(connection)
+        dbapi = connection.dialect.dbapi
+        cursor = connection.connection.cursor()
+        try:
+            cursor.copy_expert(statement, buffer)
+        except dbapi.Error as e:
+            # The raw cursor's errors aren't wrapped the way execute()'s are,
+            # and load_batch only retries SQLAlchemy's OperationalError.
+            invalidated = connection.dialect.is_disconnect(e, connection.connection, cursor)
+            util.raise_from_cause(DBAPIError.instance(statement, None, e, dbapi.Error, invalidated))
+        finally:
+            cursor.close()
+
+
+def loader_for(engine, table):
+    ''' COPY where the driver supports it, executemany everywhere else. '''
+    if engine.dialect.name == 'postgresql' and engine.dialect.driver == 'psycopg2':
+        return CopyLoader(table)
+
+    return ExecutemanyLoader(table)
+
+
+def staging_table(dest_table):
+    ''' An empty copy of `dest_table`'s columns named <table>_staging. '''
+    return Table(dest_table.name + '_staging', MetaData(),
+                 *[column.copy() for column in dest_table.columns])
+
+
+def prepare_staging(engine, dest_table, keep_existing=False):
+    ''' Create the staging table for `dest_table`, replacing any left over
+    from an earlier run unless `keep_existing` (when resuming into it). '''
+    staging = staging_table(dest_table)
+    if not keep_existing:
+        staging.drop(engine, checkfirst=True)
+    staging.create(engine, checkfirst=True)
+    return staging
+
+
+def publish_staging(engine, dest_table, staging):
+    ''' Replace the contents of `dest_table` with the staging table in one
+    transaction, then drop the staging table. Rows are copied rather than
+    the tables renamed, so views built on `dest_table` keep working. '''
+    names = [column.name for column in dest_table.columns]
+    with engine.begin() as connection:
+        connection.execute(dest_table.delete())
+        connection.execute(dest_table.insert().from_select(names, select([staging.c[name] for name in names])))
+
+    staging.drop(engine)
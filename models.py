@@ -1,6 +1,7 @@
 import datetime
+import json
 
-from app import db
+from database import db
 
 
 class FireIncident(db.Model):
@@ -150,6 +151,18 @@ class AddressSummary(db.Model):
 
     active = db.Column(db.Boolean)
 
+    # Mean location of geocoded incidents at this address, in state plane feet.
+    x_coordinate = db.Column(db.Float)
+    y_coordinate = db.Column(db.Float)
+
+    # Apparatus dispatched to this address over the last year. Response times
+    # are in seconds; the digest is a JSON t-digest of all of them.
+    fire_dispatch_count = db.Column(db.Integer, default=0)
+    fire_unit_seconds = db.Column(db.Integer, default=0)
+    fire_response_p50 = db.Column(db.Integer)
+    fire_response_p90 = db.Column(db.Integer)
+    fire_response_digest = db.Column(db.Text)
+
     def counts_for_days_ago(self, days):
         return {
             'fire': {
@@ -162,6 +175,63 @@ class AddressSummary(db.Model):
             }
         }
 
+
+# The windows shown on the address page.
+DETAIL_TIMEFRAMES = [7, 30, 90, 365]
+
+class AddressDetail(db.Model):
+    __tablename__ = 'address_details'
+
+    address = db.Column(db.String(50), primary_key=True)
+    # JSON written by the nightly rebuild: {"counts": {department: {days:
+    # count}}, "top_call_types": {department: {days: [[type, count], ...]}},
+    # "business_names": [...], "business_types": [...]}.
+    detail = db.Column(db.Text, nullable=False)
+
+    def as_dict(self):
+        ''' The detail with its windows keyed by number of days again. '''
+        detail = json.loads(self.detail)
+        for field in ['counts', 'top_call_types']:
+            for department, windows in detail[field].items():
+                detail[field][department] = dict((int(days), value) for days, value in windows.iteritems())
+        return detail
+
+
+class HeatmapCell(db.Model):
+    __tablename__ = 'heatmap_cells'
+
+    department = db.Column(db.String(10), primary_key=True)
+    days = db.Column(db.Integer, primary_key=True)
+    level = db.Column(db.Integer, primary_key=True)
+    cell_x = db.Column(db.Integer, primary_key=True)
+    cell_y = db.Column(db.Integer, primary_key=True)
+
+    count = db.Column(db.Integer, nullable=False)
+
+
+# The job_runs name of the nightly address summary rebuild.
+SUMMARY_JOB_NAME = 'count_calls_for_service'
+
+class JobRun(db.Model):
+    __tablename__ = 'job_runs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    job_name = db.Column(db.String(50), index=True, nullable=False)
+    status = db.Column(db.String(10), nullable=False)
+    started_at = db.Column(db.DateTime(timezone=True))
+    finished_at = db.Column(db.DateTime(timezone=True))
+    duration_seconds = db.Column(db.Float)
+    peak_memory_kb = db.Column(db.Integer)
+    # JSON list of {name, seconds, rows, peak_memory_kb}, one per phase.
+    phases = db.Column(db.Text)
+    error = db.Column(db.Text)
+
+    @classmethod
+    def last_success(cls, job_name):
+        ''' When `job_name` last finished successfully, or None. '''
+        return db.session.query(db.func.max(cls.finished_at)) \
+            .filter(cls.job_name == job_name, cls.status == 'succeeded').scalar()
+
         
 class AuditLogEntry(db.Model):
     __tablename__ = 'audit_log'
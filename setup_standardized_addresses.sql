@@ -12,6 +12,7 @@ DROP MATERIALIZED VIEW standardized_fire_incidents;
 CREATE MATERIALIZED VIEW standardized_fire_incidents AS
     SELECT *, clean_address(concat_ws(' ',  street_number::varchar, street_prefix::varchar, street_name::varchar, street_type::varchar, street_suffix::varchar)) AS standardized_address FROM fire_incidents;
 
+CREATE UNIQUE INDEX ON standardized_fire_incidents (cad_call_number);
 CREATE INDEX ON standardized_fire_incidents (standardized_address);
 CREATE INDEX ON standardized_fire_incidents (alarm_datetime);
 
@@ -19,5 +20,6 @@ DROP MATERIALIZED VIEW standardized_police_incidents;
 CREATE MATERIALIZED VIEW standardized_police_incidents AS
     SELECT *, clean_address(concat_ws(' ',  street_number::varchar, street_prefix::varchar, street_name::varchar, street_type::varchar, street_suffix::varchar)) AS standardized_address FROM police_incidents;
 
+CREATE UNIQUE INDEX ON standardized_police_incidents (cad_call_number);
 CREATE INDEX ON standardized_police_incidents (standardized_address);
 CREATE INDEX ON standardized_police_incidents (call_datetime);
\ No newline at end of file
@@ -0,0 +1,82 @@
+class TDigest(object):
+    ''' A merging t-digest: a compact, mergeable sketch of a distribution that
+    keeps quantile estimates accurate at the tails. Centroids near the median
+    may absorb many points, while those near the extremes stay small.
+    '''
+
+    def __init__(self, compression=100):
+        self.compression = compression
+        self.centroids = []
+        self.unmerged = []
+        self.count = 0
+
+    def add(self, value, weight=1):
+        self.unmerged.append([float(value), weight])
+        self.count += weight
+
+        if len(self.unmerged) > self.compression * 5:
+            self.compress()
+
+    def merge(self, other):
+        for mean, weight in other.centroids + other.unmerged:
+            self.add(mean, weight)
+
+    def compress(self):
+        if not self.unmerged:
+            return
+
+        points = sorted(self.centroids + self.unmerged)
+        self.unmerged = []
+
+        merged = []
+        cumulative = 0
+        for mean, weight in points:
+            if merged:
+                last = merged[-1]
+                combined_weight = last[1] + weight
+                q = (cumulative + combined_weight / 2.0) / self.count
+                if combined_weight <= 4 * self.count * q * (1 - q) / self.compression:
+                    last[0] += (mean - last[0]) * weight / combined_weight
+                    last[1] = combined_weight
+                    continue
+
+                cumulative += last[1]
+            merged.append([mean, weight])
+
+        self.centroids = merged
+
+    def quantile(self, q):
+        ''' Estimate the value at quantile `q` (0 to 1), or None if empty. '''
+        self.compress()
+        if not self.centroids:
+            return None
+
+        target = q * self.count
+        cumulative = 0
+        previous = None
+        for mean, weight in self.centroids:
+            center = cumulative + weight / 2.0
+            if center >= target:
+                if previous is None:
+                    return mean
+
+                previous_mean, previous_center = previous
+                fraction = (target - previous_center) / (center - previous_center)
+                return previous_mean + (mean - previous_mean) * fraction
+
+            previous = (mean, center)
+            cumulative += weight
+
+        return self.centroids[-1][0]
+
+    def to_list(self):
+        self.compress()
+        return [[round(mean, 2), weight] for mean, weight in self.centroids]
+
+    @classmethod
+    def from_list(cls, centroids, compression=100):
+        digest = cls(compression)
+        for mean, weight in centroids:
+            digest.add(mean, weight)
+        digest.compress()
+        return digest
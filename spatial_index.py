@@ -0,0 +1,67 @@
+import math
+
+
+def parse_coordinate(value):
+    ''' Incident coordinates are state plane feet stored as strings. Blank,
+    zero and malformed values mean the incident wasn't geocoded. '''
+    try:
+        coordinate = float(value)
+    except (TypeError, ValueError):
+        return None
+
+    if coordinate == 0 or math.isnan(coordinate) or math.isinf(coordinate):
+        return None
+
+    return coordinate
+
+
+class GridIndex(object):
+    ''' A uniform grid over address locations. Each cell is `cell_size` feet
+    on a side, so a radius query only has to look at the handful of cells
+    overlapping the search circle.
+    '''
+
+    def __init__(self, cell_size):
+        self.cell_size = float(cell_size)
+        self.cells = {}
+        self.locations = {}
+
+    def cell_for(self, x, y):
+        return (int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size)))
+
+    def add(self, address, x, y, weight=0):
+        self.locations[address] = (x, y)
+        self.cells.setdefault(self.cell_for(x, y), []).append((address, x, y, weight))
+
+    def location_of(self, address):
+        return self.locations.get(address)
+
+    def nearby(self, x, y, radius, exclude=None):
+        ''' Returns (address, distance, weight) tuples within `radius` feet of
+        (x, y), closest first. '''
+        min_cell_x, min_cell_y = self.cell_for(x - radius, y - radius)
+        max_cell_x, max_cell_y = self.cell_for(x + radius, y + radius)
+
+        found = []
+        for cell_x in range(min_cell_x, max_cell_x + 1):
+            for cell_y in range(min_cell_y, max_cell_y + 1):
+                for address, point_x, point_y, weight in self.cells.get((cell_x, cell_y), []):
+                    if address == exclude:
+                        continue
+
+                    distance = math.hypot(point_x - x, point_y - y)
+                    if distance <= radius:
+                        found.append((address, distance, weight))
+
+        found.sort(key=lambda match: match[1])
+        return found
+
+    def nearby_address(self, address, radius):
+        location = self.location_of(address)
+        if location is None:
+            return []
+
+        return self.nearby(location[0], location[1], radius, exclude=address)
+
+    def __len__(self):
+        return len(self.locations)
@@ -134,7 +134,7 @@ $(document).ready(function() {
       // verification of user's email address and it must arrange for the binding
       // of currentUser to said address when the page is reloaded
       var xhr = new XMLHttpRequest();
-      xhr.open("POST", "/log-in", true);
+      xhr.open("POST", scriptRoot + "/log-in", true);
       // see http://www.openjs.com/articles/ajax_xmlhttp_using_post.php
       var param = "assertion="+assertion;
       param += "&_csrf_token=" + csrfToken;
@@ -151,7 +151,7 @@ $(document).ready(function() {
       // it must arrange for the binding of currentUser to 'null' when the page
       // is reloaded
       var xhr = new XMLHttpRequest();
-      xhr.open("POST", "/log-out", true);
+      xhr.open("POST", scriptRoot + "/log-out", true);
       xhr.send(null);
       xhr.onreadystatechange = simpleXhrSentinel(xhr); }
 
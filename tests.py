@@ -1,20 +1,54 @@
 import unittest
 import mock
 import os
+import BaseHTTPServer
 import datetime
+import gzip
+import json
 import pytz
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
 from httmock import response, HTTMock
+from sqlalchemy import create_engine
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import OperationalError
 
 os.environ['APP_SETTINGS'] = 'config.TestingConfig'
 
-from app import app, db
-from app import fetch_incidents_at_address, count_incidents_by_timeframes
+from app import app, db, user_cache, spatial_index_cache, data_freshness_cache, authorization_cache
+from app import persona_breaker, authorization_breaker
+from app import fetch_incidents_at_address, count_incidents_by_timeframes, activated_table
 from app import get_top_incident_reasons_by_timeframes
 import models
 
-from count_calls_for_service import count_calls
+from count_calls_for_service import count_calls, sum_coordinates, fetch_dispatches_by_address
+from count_calls_for_service import count_calls_from_snapshot, sum_snapshot_coordinates
+from count_calls_for_service import rebuild_summaries, rebuild_summaries_streaming, merge_by_address, PhaseTimer
+from count_calls_for_service import rebuild_windows, shard_bounds, address_detail_row
+from count_calls_for_service import rebuild_summaries_sharded, stream_address_fields, streamed_address_rows
+from incident_snapshot import IncidentSnapshot, today_epoch_day
+from jobs import JobLock, JobLocked, run_job
+import transformer
+from transformer import transform, encode_mark, decode_mark, ExcludeStartingWith, StripSuffix
+from transformer import batch_transformation, filter_batch, Rule
+from loaders import CopyLoader
+from upstream import CircuitBreaker, CircuitOpen, WorkerPool, spreadsheets_client
+from database import current_city, set_city, use_city, replica_reads
+from cities import CityMiddleware, request_city
+import csv_source
+from dispatches import parse_dispatch_datetime, summarize_dispatches
+from sketches import TDigest
+from spatial_index import GridIndex, parse_coordinate
+from heatmap import CellCounter, aggregate_incident_cells, aggregate_snapshot_cells
 
 from factories import FireIncidentFactory, PoliceIncidentFactory, BusinessLicenseFactory, UserFactory
+from factories import AddressSummaryFactory
 
 from flask.ext.login import login_user
 
@@ -63,6 +97,72 @@ class HomeTestCase(unittest.TestCase):
 
         assert rv.status_code == 200
 
+class FastPathTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = app.test_client()
+        db.create_all()
+
+    def tearDown(self):
+        db.drop_all()
+
+    def test_health_check_returns_ok_without_cookies(self):
+        rv = self.app.get('/health')
+
+        self.assertEquals(200, rv.status_code)
+        self.assertEquals('OK', rv.data)
+        self.assertFalse('Set-Cookie' in rv.headers)
+
+    def test_static_files_are_served_without_cookies(self):
+        rv = self.app.get('/static/main.js')
+
+        self.assertEquals(200, rv.status_code)
+        self.assertFalse('Set-Cookie' in rv.headers)
+
+    def test_missing_static_file_returns_404(self):
+        rv = self.app.get('/static/does-not-exist.js')
+
+        self.assertEquals(404, rv.status_code)
+
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock())
+    def test_session_cookie_is_not_resent_when_unchanged(self):
+        with HTTMock(persona_verify):
+            rv = self.app.post('/log-in', data={'assertion': 'sampletoken'})
+        self.assertTrue('session=' in rv.headers.get('Set-Cookie', ''))
+
+        rv = self.app.get('/browse')
+        self.assertEquals(200, rv.status_code)
+        self.assertFalse('session=' in ' '.join(rv.headers.getlist('Set-Cookie')))
+
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock())
+    def test_session_cookie_is_refreshed_near_expiry(self):
+        with HTTMock(persona_verify):
+            self.app.post('/log-in', data={'assertion': 'sampletoken'})
+
+        refresh_window = app.config['SESSION_REFRESH_WINDOW']
+        app.config['SESSION_REFRESH_WINDOW'] = app.permanent_session_lifetime
+        try:
+            rv = self.app.get('/browse')
+        finally:
+            app.config['SESSION_REFRESH_WINDOW'] = refresh_window
+
+        self.assertEquals(200, rv.status_code)
+        self.assertTrue('session=' in ' '.join(rv.headers.getlist('Set-Cookie')))
+
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock())
+    def test_sessions_work_without_a_configured_refresh_window(self):
+        # Deployments using clb_config.Config may not set it.
+        with HTTMock(persona_verify):
+            self.app.post('/log-in', data={'assertion': 'sampletoken'})
+
+        refresh_window = app.config.pop('SESSION_REFRESH_WINDOW')
+        try:
+            rv = self.app.get('/browse')
+        finally:
+            app.config['SESSION_REFRESH_WINDOW'] = refresh_window
+
+        self.assertEquals(200, rv.status_code)
+
 class LoginTestCase(unittest.TestCase):
     # @maybe: Refactor test_login and test_logout.
 
@@ -76,7 +176,7 @@ class LoginTestCase(unittest.TestCase):
     def tearDown(self):
         db.drop_all()
 
-    @mock.patch('app.SpreadsheetsClient', setup_google_mock())
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock())
     def test_login(self):
         ''' Check basic log in flow without talking to Persona.
         '''
@@ -90,7 +190,7 @@ class LoginTestCase(unittest.TestCase):
         response = self.app.get('/browse')
         self.assertTrue('user@example.com' in response.data)
 
-    @mock.patch('app.SpreadsheetsClient', setup_google_mock(email="notexample@example.com"))    
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock(email="notexample@example.com"))    
     def test_login_fails_when_not_in_spreadsheet(self):
         response = self.app.get('/')
         self.assertFalse('user@example.com' in response.data)
@@ -103,7 +203,7 @@ class LoginTestCase(unittest.TestCase):
         response = self.app.get('/')
         self.assertFalse('user@example.com' in response.data)
 
-    @mock.patch('app.SpreadsheetsClient', setup_google_mock(can_view='N'))    
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock(can_view='N'))    
     def test_login_fails_when_not_allowed_to_view(self):
         response = self.app.get('/')
         self.assertFalse('user@example.com' in response.data)
@@ -116,7 +216,7 @@ class LoginTestCase(unittest.TestCase):
         response = self.app.get('/')
         self.assertFalse('user@example.com' in response.data)
 
-    @mock.patch('app.SpreadsheetsClient', setup_google_mock())    
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock())    
     def test_login_successfully_pulls_in_name(self):
         response = self.app.get('/')
         self.assertFalse('user@example.com' in response.data)
@@ -128,7 +228,7 @@ class LoginTestCase(unittest.TestCase):
         response = self.app.get('/browse')
         self.assertTrue('Joe Fireworks' in response.data)
 
-    @mock.patch('app.SpreadsheetsClient', setup_google_mock(can_view_fire='Y'))    
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock(can_view_fire='Y'))    
     def test_login_successfully_pulls_in_fire_viewable_true(self):
         response = self.app.get('/')
         self.assertFalse('user@example.com' in response.data)
@@ -140,7 +240,7 @@ class LoginTestCase(unittest.TestCase):
         user = db.session.query(models.User).filter(models.User.email=='user@example.com').first()
         assert user.can_view_fire_data == True
 
-    @mock.patch('app.SpreadsheetsClient', setup_google_mock(can_view_fire='N'))    
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock(can_view_fire='N'))    
     def test_login_successfully_pulls_in_fire_viewable_false(self):
         response = self.app.get('/')
         self.assertFalse('user@example.com' in response.data)
@@ -152,7 +252,7 @@ class LoginTestCase(unittest.TestCase):
         user = db.session.query(models.User).filter(models.User.email=='user@example.com').first()
         assert user.can_view_fire_data == False
 
-    @mock.patch('app.SpreadsheetsClient', setup_google_mock())
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock())
     def test_logout(self):
         ''' Check basic log out flow without talking to Persona.
         '''
@@ -170,6 +270,353 @@ class LoginTestCase(unittest.TestCase):
         self.assertFalse('user@example.com' in response.data)
 
 
+class StubPersonaHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    ''' Answers every POST after the server's `delay` with its `status` and `body`. '''
+
+    def do_POST(self):
+        self.server.requests += 1
+        time.sleep(self.server.delay)
+        self.send_response(self.server.status)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(self.server.body)
+
+    def log_message(self, *args):
+        pass
+
+class LoginUpstreamTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = app.test_client()
+        db.create_all()
+        authorization_cache.clear()
+
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StubPersonaHandler)
+        self.server.requests = 0
+        self.server.delay = 0
+        self.server.status = 200
+        self.server.body = '{"status": "okay", "email": "user@example.com"}'
+        # Clients that time out hang up before the stub answers.
+        self.server.handle_error = lambda request, client_address: None
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.config = dict(app.config)
+        app.config['PERSONA_VERIFIER_URL'] = 'http://127.0.0.1:%d/verify' % self.server.server_port
+        app.config['PERSONA_TIMEOUT'] = 0.1
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        app.config.update(self.config)
+        persona_breaker.reset()
+        authorization_breaker.reset()
+        authorization_cache.clear()
+        db.drop_all()
+
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock())
+    def test_login_verifies_with_the_persona_server(self):
+        response = self.app.post('/log-in', data={'assertion': 'sampletoken'})
+
+        self.assertEquals(200, response.status_code)
+        self.assertEquals(1, self.server.requests)
+
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock())
+    def test_slow_persona_times_out(self):
+        self.server.delay = 0.3
+
+        started = time.time()
+        response = self.app.post('/log-in', data={'assertion': 'sampletoken'})
+
+        self.assertEquals(503, response.status_code)
+        self.assertLess(time.time() - started, 0.3)
+
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock())
+    def test_failing_persona_is_skipped_once_the_circuit_opens(self):
+        self.server.status = 500
+        self.server.body = 'Internal Server Error'
+
+        for attempt in range(persona_breaker.threshold + 2):
+            response = self.app.post('/log-in', data={'assertion': 'sampletoken'})
+            self.assertEquals(503, response.status_code)
+
+        self.assertEquals(persona_breaker.threshold, self.server.requests)
+
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock())
+    def test_persona_errors_are_not_read_as_answers(self):
+        self.server.status = 500
+
+        response = self.app.post('/log-in', data={'assertion': 'sampletoken'})
+
+        self.assertEquals(503, response.status_code)
+
+    def test_spreadsheet_is_not_read_while_persona_is_unavailable(self):
+        for attempt in range(persona_breaker.threshold):
+            self.assertRaises(IOError, persona_breaker.call, mock.Mock(side_effect=IOError))
+
+        with mock.patch('app.start_fetching_authorization') as start_fetching:
+            response = self.app.post('/log-in', data={'assertion': 'sampletoken'})
+
+        self.assertEquals(503, response.status_code)
+        self.assertFalse(start_fetching.called)
+
+    def test_cached_authorization_is_used_when_the_spreadsheet_fails(self):
+        with mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock()):
+            self.assertEquals(200, self.app.post('/log-in', data={'assertion': 'sampletoken'}).status_code)
+        self.app.post('/log-out')
+
+        failing_client = setup_google_mock()
+        failing_client.return_value.get_worksheets.side_effect = IOError('Google is down')
+        with mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', failing_client):
+            response = self.app.post('/log-in', data={'assertion': 'sampletoken'})
+
+        self.assertEquals(200, response.status_code)
+
+    def test_login_is_unavailable_without_a_cached_authorization(self):
+        failing_client = setup_google_mock()
+        failing_client.return_value.get_worksheets.side_effect = IOError('Google is down')
+        with mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', failing_client):
+            response = self.app.post('/log-in', data={'assertion': 'sampletoken'})
+
+        self.assertEquals(503, response.status_code)
+
+    def test_stalled_spreadsheet_reads_free_their_pool_thread(self):
+        # Takes connections but never answers them.
+        stalled = socket.socket()
+        stalled.bind(('127.0.0.1', 0))
+        stalled.listen(5)
+        self.addCleanup(stalled.close)
+        client = spreadsheets_client(mock.Mock(access_token='token'), 0.1)
+        pool = WorkerPool(1)
+
+        stalled_read = pool.apply_async(client.request, 'GET', 'http://127.0.0.1:%d/feeds' % stalled.getsockname()[1])
+        next_read = pool.apply_async(lambda: 'read')
+
+        self.assertRaises(IOError, stalled_read.get, 1)
+        self.assertEquals('read', next_read.get(1))
+
+    def test_circuit_breaker_closes_after_a_success(self):
+        breaker = CircuitBreaker('Test', threshold=2, reset_after=60)
+        failing = mock.Mock(side_effect=IOError)
+        for attempt in range(2):
+            self.assertRaises(IOError, breaker.call, failing)
+
+        self.assertRaises(CircuitOpen, breaker.call, failing)
+        self.assertEquals(2, failing.call_count)
+
+        breaker.reset_after = 0
+        self.assertEquals('OK', breaker.call(lambda: 'OK'))
+        self.assertFalse(breaker.is_open())
+        self.assertEquals(0, breaker.failures)
+
+
+class UserCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = app.test_client()
+        db.create_all()
+        user_cache.clear()
+
+    def tearDown(self):
+        db.drop_all()
+        user_cache.clear()
+
+    def rename_user_in_database(self, name):
+        db.session.query(models.User).update({'name': name})
+        db.session.commit()
+
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock())
+    def test_logged_in_user_is_served_from_cache(self):
+        with HTTMock(persona_verify):
+            self.app.post('/log-in', data={'assertion': 'sampletoken'})
+
+        self.app.get('/browse')
+        self.rename_user_in_database('Someone Else')
+
+        response = self.app.get('/browse')
+        self.assertTrue('Joe Fireworks' in response.data)
+
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock())
+    def test_cached_user_expires_after_ttl(self):
+        with HTTMock(persona_verify):
+            self.app.post('/log-in', data={'assertion': 'sampletoken'})
+
+        ttl = user_cache.ttl
+        user_cache.ttl = 0
+        try:
+            self.app.get('/browse')
+            self.rename_user_in_database('Someone Else')
+            response = self.app.get('/browse')
+        finally:
+            user_cache.ttl = ttl
+
+        self.assertTrue('Someone Else' in response.data)
+
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock())
+    def test_logging_in_again_invalidates_cached_user(self):
+        with HTTMock(persona_verify):
+            self.app.post('/log-in', data={'assertion': 'sampletoken'})
+
+        self.app.get('/browse')
+        self.rename_user_in_database('Someone Else')
+
+        with mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock(can_view_fire='N')):
+            with HTTMock(persona_verify):
+                self.app.post('/log-in', data={'assertion': 'sampletoken'})
+
+        response = self.app.get('/browse')
+        self.assertTrue('Joe Fireworks' in response.data)
+
+        user = db.session.query(models.User).filter(models.User.email=='user@example.com').first()
+        assert user.can_view_fire_data == False
+
+
+SPRINGFIELD = {'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'SQLALCHEMY_BINDS': {'lbc_data': 'sqlite://'}}
+
+class CityTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = app.test_client()
+        self.cities = mock.patch.dict(app.config['CITIES'], {'springfield': SPRINGFIELD})
+        self.cities.start()
+        db.create_all()
+        with use_city('springfield'):
+            db.create_all()
+
+    def tearDown(self):
+        with use_city('springfield'):
+            db.drop_all()
+        db.drop_all()
+        self.cities.stop()
+
+    def add_heatmap_cell(self, count):
+        db.session.add(models.HeatmapCell(department='police', days=30, level=0, cell_x=1, cell_y=2, count=count))
+        db.session.commit()
+
+    def test_path_prefix_routes_to_city_databases(self):
+        self.add_heatmap_cell(4)
+        with use_city('springfield'):
+            self.add_heatmap_cell(9)
+
+        default_tile = json.loads(self.app.get('/heatmap/police/30/0/0/0.json').data)
+        springfield_tile = json.loads(self.app.get('/springfield/heatmap/police/30/0/0/0.json').data)
+
+        self.assertEquals([[1, 2, 4]], default_tile['cells'])
+        self.assertEquals([[1, 2, 9]], springfield_tile['cells'])
+        self.assertIsNone(current_city())
+
+    def test_path_prefix_is_kept_on_links(self):
+        with use_city('springfield'):
+            AddressSummaryFactory(address='1 MAIN ST')
+            db.session.commit()
+
+        page = self.app.get('/springfield/browse').data
+
+        self.assertTrue('href="/springfield/address/1%20MAIN%20ST"' in page)
+        self.assertTrue('action="/springfield/search"' in page)
+        self.assertTrue('href="/springfield/" id="logo"' in page)
+        # main.js posts logins to scriptRoot + "/log-in".
+        self.assertTrue('var scriptRoot = "/springfield";' in page)
+
+    def test_subdomain_names_city(self):
+        seen = []
+        middleware = CityMiddleware(lambda environ, start_response: seen.append(request_city(environ)),
+                                    app.config['CITIES'], 'subdomain')
+
+        middleware({'HTTP_HOST': 'springfield.example.com:5000', 'PATH_INFO': '/browse'}, None)
+        middleware({'HTTP_HOST': 'www.example.com', 'PATH_INFO': '/springfield/browse'}, None)
+
+        self.assertEquals(['springfield', None], seen)
+
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock())
+    def test_logins_are_per_city(self):
+        with HTTMock(persona_verify):
+            self.app.post('/log-in', data={'assertion': 'sampletoken'})
+
+        self.assertTrue('user@example.com' in self.app.get('/browse').data)
+        self.assertFalse('user@example.com' in self.app.get('/springfield/browse').data)
+
+    def test_jobs_run_against_city_databases(self):
+        with use_city('springfield'):
+            run_job('springfield_job', lambda timer: None)
+            self.assertEquals(1, models.JobRun.query.count())
+
+        self.assertEquals(0, models.JobRun.query.count())
+        self.assertRaises(ValueError, set_city, 'shelbyville')
+
+
+class ReplicaTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = app.test_client()
+        self.replica_config = mock.patch.dict(app.config, {'SQLALCHEMY_REPLICA_URI': 'sqlite://'})
+        self.replica_config.start()
+        self.replica = db.get_replica_engine(app)
+        db.create_all()
+        db.Model.metadata.create_all(self.replica, tables=db.get_tables_for_bind())
+        db.replica_checks.clear()
+        # Start from a session that hasn't written anything, as a request does.
+        db.session.remove()
+
+    def tearDown(self):
+        db.Model.metadata.drop_all(self.replica, tables=db.get_tables_for_bind())
+        db.drop_all()
+        db.replica_checks.clear()
+        self.replica_config.stop()
+
+    def add_heatmap_cells(self, primary_count, replica_count):
+        ''' The same cell with a different count in each database. '''
+        db.session.add(models.HeatmapCell(department='police', days=30, level=0, cell_x=1, cell_y=2,
+                                          count=primary_count))
+        db.session.commit()
+        db.session.remove()
+        self.replica.execute(models.HeatmapCell.__table__.insert(), department='police', days=30, level=0,
+                             cell_x=1, cell_y=2, count=replica_count)
+
+    def tile_counts(self):
+        rv = self.app.get('/heatmap/police/30/0/0/0.json')
+        return [count for cell_x, cell_y, count in json.loads(rv.data)['cells']]
+
+    def test_read_only_routes_read_from_replica(self):
+        self.add_heatmap_cells(4, 9)
+
+        self.assertEquals([9], self.tile_counts())
+
+    def test_lagging_or_failing_replica_falls_back_to_primary(self):
+        self.add_heatmap_cells(4, 9)
+
+        with mock.patch.object(db, 'replica_lag', return_value=60):
+            self.assertEquals([4], self.tile_counts())
+
+        db.replica_checks.clear()
+        with mock.patch.object(db, 'replica_lag', side_effect=OperationalError('SELECT 1', {}, Exception())):
+            self.assertEquals([4], self.tile_counts())
+
+    def test_reads_after_a_post_go_to_primary(self):
+        self.add_heatmap_cells(4, 9)
+
+        self.app.post('/log-out')
+
+        self.assertEquals([4], self.tile_counts())
+
+    def test_csv_exports_stream_from_replica(self):
+        self.replica.execute(models.AddressSummary.__table__.insert(), address='1 MAIN ST')
+
+        rv = self.app.get('/browse.csv')
+
+        self.assertEquals(['1 MAIN ST'], [line.split(',')[0] for line in rv.data.splitlines()[1:]])
+
+    def test_writes_and_reads_after_them_go_to_primary(self):
+        with replica_reads():
+            self.assertEquals(0, models.HeatmapCell.query.count())
+            db.session.add(models.HeatmapCell(department='fire', days=7, level=0, cell_x=0, cell_y=0, count=1))
+            db.session.commit()
+
+            self.assertEquals(1, models.HeatmapCell.query.count())
+
+        self.assertEquals(0, self.replica.execute(models.HeatmapCell.__table__.count()).scalar())
+
+
 class AddressUtilityTestCase(unittest.TestCase):
     def setUp(self):
         self.app = app.test_client()
@@ -414,6 +861,19 @@ class AddressUtilityTestCase(unittest.TestCase):
         assert "Bar, Lawncare" in rv.data
         assert "The Pub, Mowers R Us" in rv.data
 
+    def test_address_page_reads_the_address_detail_snapshot(self):
+        db.session.add(models.AddressDetail(**address_detail_row('456 LALA LN', {
+            'fire_counts': {7: 1, 30: 42, 90: 43, 365: 44},
+            'fire_top_reasons': {365: [('Chest Pain', 44)]},
+            'businesses': [('The Pub', 'Bar')]})))
+        db.session.flush()
+
+        rv = self.app.get('/address/456 lala ln')
+        assert rv.status_code == 200
+        assert '<div class="bignumber">42</div>' in rv.data
+        assert 'Chest Pain' in rv.data
+        assert 'The Pub' in rv.data
+
     def test_no_comment_msg_shows_on_address_with_none(self):
         [FireIncidentFactory(standardized_address="456 LALA LN")
          for i in range(0, 5)]
@@ -424,7 +884,7 @@ class AddressUtilityTestCase(unittest.TestCase):
         assert 'no-action-found' in rv.data
         assert 'Nothing has been done yet with this address. Add a note below, or click the activate button!' in rv.data
 
-    @mock.patch('app.SpreadsheetsClient', setup_google_mock())
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock())
     def test_posting_a_comment_loads_a_comment_into_database(self):
         [FireIncidentFactory(standardized_address="456 LALA LN")
          for i in range(0, 5)]
@@ -442,7 +902,7 @@ class AddressUtilityTestCase(unittest.TestCase):
         comments = models.Action.query.all()
         self.assertEquals(1, len(comments))
 
-    @mock.patch('app.SpreadsheetsClient', setup_google_mock())
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock())
     def test_posting_a_comment_shows_it_on_the_page(self):
         [FireIncidentFactory(standardized_address="456 LALA LN")
          for i in range(0, 5)]
@@ -460,7 +920,7 @@ class AddressUtilityTestCase(unittest.TestCase):
         rv = self.app.get('/address/456 lala ln')
         assert 'This is a test comment' in rv.data
 
-    @mock.patch('app.SpreadsheetsClient', setup_google_mock())
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock())
     def test_posting_two_comments_shows_the_most_recent_last(self):
         [FireIncidentFactory(standardized_address="456 LALA LN")
          for i in range(0, 5)]
@@ -482,7 +942,7 @@ class AddressUtilityTestCase(unittest.TestCase):
         assert 'Test 2' in rv.data
         assert rv.data.find('Test 1') < rv.data.find('Test 2')
 
-    @mock.patch('app.SpreadsheetsClient', setup_google_mock())
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock())
     def test_logging_in_creates_an_audit_log(self):
         app.config['AUDIT_DISABLED'] = False
 
@@ -502,7 +962,7 @@ class AddressUtilityTestCase(unittest.TestCase):
         assert first_entry.method == 'POST'
         assert first_entry.response_code == "200"
 
-    @mock.patch('app.SpreadsheetsClient', setup_google_mock())
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock())
     def test_viewing_an_address_creates_an_audit_log(self):
         app.config['AUDIT_DISABLED'] = False
 
@@ -527,7 +987,7 @@ class AddressUtilityTestCase(unittest.TestCase):
         assert second_entry.resource == '/address/456 lala ln'
         assert second_entry.response_code == "200"
 
-    @mock.patch('app.SpreadsheetsClient', setup_google_mock())
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock())
     def test_posting_a_comment_creates_an_audit_log(self):
         app.config['AUDIT_DISABLED'] = False
 
@@ -554,7 +1014,7 @@ class AddressUtilityTestCase(unittest.TestCase):
         assert second_entry.resource == '/address/456 lala ln/comments'
         assert second_entry.response_code == "302"
 
-    @mock.patch('app.SpreadsheetsClient', setup_google_mock(can_view_fire='N'))
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock(can_view_fire='N'))
     def test_viewing_an_address_does_not_show_fire_data_if_not_allowed(self):
         [FireIncidentFactory(standardized_address="456 LALA LN", alarm_datetime=get_date_days_ago(5),
                              actual_nfirs_incident_type_description="Broken Nose")
@@ -568,7 +1028,7 @@ class AddressUtilityTestCase(unittest.TestCase):
         rv = self.app.get('/address/456 lala ln')
         assert 'Broken Nose' not in rv.data
 
-    @mock.patch('app.SpreadsheetsClient', setup_google_mock())
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock())
     def test_activation_endpoint_activates_address(self):
         [FireIncidentFactory(standardized_address="456 LALA LN")
          for i in range(0, 5)]
@@ -583,7 +1043,7 @@ class AddressUtilityTestCase(unittest.TestCase):
         assert 200 == rv.status_code
         assert 1 == len(models.ActivatedAddress.query.all())
 
-    @mock.patch('app.SpreadsheetsClient', setup_google_mock())
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock())
     def test_deactivation_endpoint_deactivates_address(self):
         [FireIncidentFactory(standardized_address="456 LALA LN")
          for i in range(0, 5)]
@@ -599,7 +1059,143 @@ class AddressUtilityTestCase(unittest.TestCase):
         assert 200 == rv.status_code
         assert 0 == len(models.ActivatedAddress.query.all())
 
-    @mock.patch('app.SpreadsheetsClient', setup_google_mock())
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock())
+    def test_activating_an_active_address_returns_400(self):
+        with HTTMock(persona_verify):
+            response = self.app.post('/log-in', data={'assertion': 'sampletoken'})
+
+        self.app.post('/address/456 lala ln/activate')
+        rv = self.app.post('/address/456 lala ln/activate')
+
+        assert 400 == rv.status_code
+        assert 1 == len(models.Action.query.all())
+
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock())
+    def test_activation_endpoint_updates_address_summary(self):
+        AddressSummaryFactory(address="456 LALA LN")
+        db.session.flush()
+
+        with HTTMock(persona_verify):
+            response = self.app.post('/log-in', data={'assertion': 'sampletoken'})
+
+        self.app.post('/address/456 lala ln/activate')
+
+        assert models.AddressSummary.query.get("456 LALA LN").active == True
+
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock())
+    def test_bulk_activation_activates_only_inactive_addresses(self):
+        [AddressSummaryFactory(address=address) for address in ["1 MAIN ST", "2 MAIN ST", "3 MAIN ST"]]
+        db.session.flush()
+
+        with HTTMock(persona_verify):
+            response = self.app.post('/log-in', data={'assertion': 'sampletoken'})
+
+        self.app.post('/address/1 main st/activate')
+        rv = self.app.post('/addresses/activate', content_type='application/json',
+                           data=json.dumps({'addresses': ['1 main st', '2 main st', '3 MAIN ST']}))
+
+        assert 200 == rv.status_code
+        self.assertEquals({'changed': ['2 MAIN ST', '3 MAIN ST'], 'unchanged': ['1 MAIN ST']},
+                          json.loads(rv.data))
+        self.assertEquals(3, len(models.ActivatedAddress.query.all()))
+        self.assertEquals(3, models.Action.query.filter(models.Action.type == "activated").count())
+        self.assertEquals(3, models.AddressSummary.query.filter(models.AddressSummary.active == True).count())
+
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock())
+    def test_activation_that_loses_a_race_changes_nothing(self):
+        [AddressSummaryFactory(address=address) for address in ["1 MAIN ST", "2 MAIN ST"]]
+        db.session.flush()
+
+        with HTTMock(persona_verify):
+            response = self.app.post('/log-in', data={'assertion': 'sampletoken'})
+
+        self.app.post('/address/1 main st/activate')
+        # Another request activates the address after this one has looked.
+        with mock.patch('app.activated_addresses_among', return_value=set()):
+            rv = self.app.post('/addresses/activate', data={'addresses': ['1 MAIN ST', '2 MAIN ST']})
+            single_rv = self.app.post('/address/1 main st/activate')
+
+        self.assertEquals({'changed': ['2 MAIN ST'], 'unchanged': ['1 MAIN ST']}, json.loads(rv.data))
+        self.assertEquals(400, single_rv.status_code)
+        self.assertEquals(2, models.Action.query.filter(models.Action.type == "activated").count())
+
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock())
+    def test_unique_violation_from_a_race_returns_400(self):
+        AddressSummaryFactory(address="1 MAIN ST")
+        db.session.flush()
+
+        with HTTMock(persona_verify):
+            response = self.app.post('/log-in', data={'assertion': 'sampletoken'})
+
+        self.app.post('/address/1 main st/activate')
+        # The other request commits while this one's INSERT is running.
+        plain_insert = lambda addresses: activated_table.insert().values(address=addresses[0])
+        with mock.patch('app.activated_addresses_among', return_value=set()), \
+                mock.patch('app.activation_insert', plain_insert):
+            single_rv = self.app.post('/address/1 main st/activate')
+            bulk_rv = self.app.post('/addresses/activate', data={'addresses': ['1 MAIN ST']})
+
+        self.assertEquals(('already activated', 400), (single_rv.data, single_rv.status_code))
+        self.assertEquals(400, bulk_rv.status_code)
+        self.assertEquals(1, models.Action.query.filter(models.Action.type == "activated").count())
+
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock())
+    def test_deactivation_that_loses_a_race_changes_nothing(self):
+        [AddressSummaryFactory(address=address) for address in ["1 MAIN ST", "2 MAIN ST"]]
+        db.session.flush()
+
+        with HTTMock(persona_verify):
+            response = self.app.post('/log-in', data={'assertion': 'sampletoken'})
+
+        self.app.post('/address/2 main st/activate')
+        # Another request deactivates the address after this one has looked.
+        with mock.patch('app.activated_addresses_among', return_value=set(['1 MAIN ST', '2 MAIN ST'])):
+            rv = self.app.post('/addresses/deactivate', data={'addresses': ['1 MAIN ST', '2 MAIN ST']})
+
+        self.assertEquals({'changed': ['2 MAIN ST'], 'unchanged': ['1 MAIN ST']}, json.loads(rv.data))
+        self.assertEquals(1, models.Action.query.filter(models.Action.type == "deactivated").count())
+
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock())
+    def test_bulk_deactivation_deactivates_addresses(self):
+        [AddressSummaryFactory(address=address) for address in ["1 MAIN ST", "2 MAIN ST"]]
+        db.session.flush()
+
+        with HTTMock(persona_verify):
+            response = self.app.post('/log-in', data={'assertion': 'sampletoken'})
+
+        self.app.post('/addresses/activate', data={'addresses': ['1 MAIN ST', '2 MAIN ST']})
+        rv = self.app.post('/addresses/deactivate', data={'addresses': ['1 MAIN ST', '9 MAIN ST']})
+
+        assert 200 == rv.status_code
+        self.assertEquals({'changed': ['1 MAIN ST'], 'unchanged': ['9 MAIN ST']}, json.loads(rv.data))
+        self.assertEquals(['2 MAIN ST'], [row.address for row in models.ActivatedAddress.query.all()])
+        self.assertEquals(1, models.Action.query.filter(models.Action.type == "deactivated").count())
+        assert models.AddressSummary.query.get("1 MAIN ST").active == False
+
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock())
+    def test_bulk_activation_requires_addresses(self):
+        with HTTMock(persona_verify):
+            response = self.app.post('/log-in', data={'assertion': 'sampletoken'})
+
+        rv = self.app.post('/addresses/activate', data={})
+
+        assert 400 == rv.status_code
+
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock())
+    def test_bulk_activation_rejects_malformed_json(self):
+        AddressSummaryFactory(address="1 MAIN ST")
+        db.session.flush()
+
+        with HTTMock(persona_verify):
+            response = self.app.post('/log-in', data={'assertion': 'sampletoken'})
+
+        for body in (['1 MAIN ST'], {'addresses': '1 MAIN ST'}, {'addresses': [1]}, {}):
+            rv = self.app.post('/addresses/activate', content_type='application/json', data=json.dumps(body))
+            self.assertEquals(400, rv.status_code)
+
+        self.assertEquals(0, models.ActivatedAddress.query.count())
+
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock())
     def test_activating_address_adds_to_action_station(self):
         [FireIncidentFactory(standardized_address="456 LALA LN")
          for i in range(0, 5)]
@@ -615,7 +1211,7 @@ class AddressUtilityTestCase(unittest.TestCase):
         assert 200 == rv.status_code
         assert 'activated this address' in rv.data
 
-    @mock.patch('app.SpreadsheetsClient', setup_google_mock())
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock())
     def test_deactivating_address_adds_to_action_station(self):
         [FireIncidentFactory(standardized_address="456 LALA LN")
          for i in range(0, 5)]
@@ -633,6 +1229,282 @@ class AddressUtilityTestCase(unittest.TestCase):
         assert 'deactivated this address' in rv.data
 
 
+class SpatialIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = app.test_client()
+        db.create_all()
+        spatial_index_cache.clear()
+
+    def tearDown(self):
+        db.drop_all()
+        spatial_index_cache.clear()
+
+    def test_parse_coordinate_ignores_missing_values(self):
+        self.assertEquals(3960000.0, parse_coordinate('3960000'))
+        self.assertEquals(None, parse_coordinate(''))
+        self.assertEquals(None, parse_coordinate('0'))
+        self.assertEquals(None, parse_coordinate(None))
+        self.assertEquals(None, parse_coordinate('N/A'))
+
+    def test_grid_index_finds_points_within_radius_across_cells(self):
+        index = GridIndex(100)
+        index.add('1 MAIN ST', 1000, 1000)
+        index.add('2 MAIN ST', 1090, 1000)
+        index.add('3 MAIN ST', 1000, 1150)
+        index.add('4 MAIN ST', 1200, 1200)
+
+        nearby = index.nearby_address('1 MAIN ST', 160)
+
+        self.assertEquals(['2 MAIN ST', '3 MAIN ST'], [match[0] for match in nearby])
+        self.assertEquals([90, 150], [match[1] for match in nearby])
+
+    def test_grid_index_returns_nothing_for_unknown_address(self):
+        index = GridIndex(100)
+        index.add('1 MAIN ST', 1000, 1000)
+
+        self.assertEquals([], index.nearby_address('2 MAIN ST', 500))
+
+    def test_sum_coordinates_skips_incidents_without_coordinates(self):
+        incidents = [('123 MAIN ST ', None, '100', '200'),
+                     ('123 MAIN ST', None, '300', '400'),
+                     ('123 MAIN ST', None, '', '400'),
+                     ('9 ELM ST', None, '0', '0')]
+
+        self.assertEquals({'123 MAIN ST': [400.0, 600.0, 2]}, sum_coordinates(incidents))
+
+    def test_address_page_lists_nearby_hot_addresses(self):
+        [FireIncidentFactory(standardized_address="456 LALA LN") for i in range(0, 5)]
+        AddressSummaryFactory(address="456 LALA LN", x_coordinate=1000.0, y_coordinate=1000.0,
+                              fire_incidents_last365=5, police_incidents_last365=0)
+        AddressSummaryFactory(address="460 LALA LN", x_coordinate=1100.0, y_coordinate=1000.0,
+                              fire_incidents_last365=3, police_incidents_last365=9)
+        AddressSummaryFactory(address="1 FAR AWAY ST", x_coordinate=90000.0, y_coordinate=1000.0,
+                              fire_incidents_last365=50, police_incidents_last365=50)
+        db.session.flush()
+
+        rv = self.app.get('/address/456 lala ln')
+
+        assert 'Nearby Hot Addresses' in rv.data
+        assert '460 Lala Ln' in rv.data
+        assert '12 calls, 100 ft away' in rv.data
+        assert '1 Far Away St' not in rv.data
+
+
+class HeatmapTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = app.test_client()
+        db.create_all()
+
+    def tearDown(self):
+        db.drop_all()
+
+    def test_aggregate_incident_cells_rolls_up_levels_and_timeframes(self):
+        now = datetime.datetime.now(pytz.utc)
+        incidents = [('1 MAIN ST', now - datetime.timedelta(days=2), '100', '100'),
+                     ('2 MAIN ST', now - datetime.timedelta(days=20), '300', '100'),
+                     ('3 MAIN ST', now - datetime.timedelta(days=20), '', '100')]
+
+        cells = aggregate_incident_cells(incidents, timeframes=[7, 30], levels=2)
+
+        self.assertEquals({(7, 0, 0, 0): 1, (7, 1, 0, 0): 1,
+                           (30, 0, 0, 0): 1, (30, 0, 1, 0): 1, (30, 1, 0, 0): 2}, cells)
+
+    def test_heatmap_tile_returns_cells_inside_tile(self):
+        db.session.add_all([
+            models.HeatmapCell(department='police', days=30, level=0, cell_x=1, cell_y=2, count=4),
+            models.HeatmapCell(department='police', days=30, level=0, cell_x=64, cell_y=2, count=9),
+            models.HeatmapCell(department='police', days=365, level=0, cell_x=1, cell_y=2, count=7),
+        ])
+        db.session.flush()
+
+        rv = self.app.get('/heatmap/police/30/0/0/0.json')
+
+        self.assertEquals(200, rv.status_code)
+        self.assertEquals({'cell_size': 250, 'cells': [[1, 2, 4]]}, json.loads(rv.data))
+
+    def test_heatmap_tile_rejects_unknown_timeframe(self):
+        rv = self.app.get('/heatmap/police/12/0/0/0.json')
+
+        assert "Page not found" in rv.data
+
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock(can_view_fire='N'))
+    def test_heatmap_tile_hides_fire_data_if_not_allowed(self):
+        with HTTMock(persona_verify):
+            self.app.post('/log-in', data={'assertion': 'sampletoken'})
+
+        rv = self.app.get('/heatmap/fire/30/0/0/0.json')
+
+        self.assertEquals(403, rv.status_code)
+
+
+class DispatchSummaryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = app.test_client()
+        db.create_all()
+
+    def tearDown(self):
+        db.drop_all()
+
+    def test_parse_dispatch_datetime_handles_padded_and_blank_values(self):
+        self.assertEquals(datetime.datetime(2014, 3, 2, 13, 5, 9),
+                          parse_dispatch_datetime('2014-03-02 13:05:09         '))
+        self.assertEquals(datetime.datetime(2014, 3, 2, 13, 5, 9),
+                          parse_dispatch_datetime('03/02/2014 01:05:09 PM'))
+        self.assertEquals(None, parse_dispatch_datetime(''))
+        self.assertEquals(None, parse_dispatch_datetime('not a date'))
+
+    def test_tdigest_quantiles_are_exact_for_small_samples(self):
+        digest = TDigest()
+        [digest.add(value) for value in [300, 100, 200, 400, 500]]
+
+        self.assertEquals(300, digest.quantile(0.5))
+        self.assertEquals(100, digest.quantile(0))
+        self.assertEquals(500, digest.quantile(1))
+        self.assertEquals(300, TDigest.from_list(digest.to_list()).quantile(0.5))
+
+    def test_summarize_dispatches_totals_each_address(self):
+        dispatches = [
+            ('1 MAIN ST', '2014-03-02 13:00:00', '2014-03-02 13:05:00', '2014-03-02 14:00:00', None, None),
+            ('1 MAIN ST', '', '', '', 420, 1800),
+            ('2 MAIN ST', '2014-03-02 13:00:00', '', '', None, None),
+        ]
+
+        summaries = dict(summarize_dispatches(dispatches))
+
+        self.assertEquals(2, summaries['1 MAIN ST']['fire_dispatch_count'])
+        self.assertEquals(3600 + 1800, summaries['1 MAIN ST']['fire_unit_seconds'])
+        self.assertEquals(360, summaries['1 MAIN ST']['fire_response_p50'])
+        self.assertEquals(1, summaries['2 MAIN ST']['fire_dispatch_count'])
+        self.assertEquals(None, summaries['2 MAIN ST']['fire_response_p50'])
+
+    def test_fetch_dispatches_by_address_joins_on_incident_number(self):
+        FireIncidentFactory(standardized_address="1 MAIN ST", incident_number=10,
+                            alarm_datetime=get_date_days_ago(3))
+        FireIncidentFactory(standardized_address="1 MAIN ST", incident_number=10,
+                            alarm_datetime=get_date_days_ago(3))
+        FireIncidentFactory(standardized_address="2 MAIN ST", incident_number=11,
+                            alarm_datetime=get_date_days_ago(400))
+        db.session.add_all([
+            models.FireDispatch(incident_number=10, apparatus_id='E1', response_time_in_sec=300),
+            models.FireDispatch(incident_number=10, apparatus_id='M2', response_time_in_sec=240),
+            models.FireDispatch(incident_number=11, apparatus_id='E1', response_time_in_sec=100),
+        ])
+        db.session.flush()
+
+        dispatches = list(fetch_dispatches_by_address(get_date_days_ago(370)))
+
+        self.assertEquals(2, len(dispatches))
+        self.assertEquals(['1 MAIN ST', '1 MAIN ST'], [dispatch[0] for dispatch in dispatches])
+
+    def test_address_page_shows_dispatch_summary(self):
+        FireIncidentFactory(standardized_address="456 LALA LN")
+        AddressSummaryFactory(address="456 LALA LN", fire_dispatch_count=12, fire_unit_seconds=5400,
+                              fire_response_p50=312, fire_response_p90=601)
+        db.session.flush()
+
+        rv = self.app.get('/address/456 lala ln')
+
+        assert 'Units dispatched:</span> 12' in rv.data
+        assert '1.5 hours' in rv.data
+        assert '5m 12s median' in rv.data
+        assert '10m 01s for 90% of calls' in rv.data
+
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock(can_view_fire='N'))
+    def test_address_page_hides_dispatch_summary_if_not_allowed(self):
+        FireIncidentFactory(standardized_address="456 LALA LN")
+        AddressSummaryFactory(address="456 LALA LN", fire_dispatch_count=12, fire_unit_seconds=5400)
+        db.session.flush()
+
+        with HTTMock(persona_verify):
+            self.app.post('/log-in', data={'assertion': 'sampletoken'})
+
+        rv = self.app.get('/address/456 lala ln')
+
+        assert 'Units dispatched' not in rv.data
+
+
+class CsvExportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = app.test_client()
+        db.create_all()
+
+    def tearDown(self):
+        db.drop_all()
+
+    def create_summary(self, address, fire_last30, police_last30, **kwargs):
+        return AddressSummaryFactory(address=address,
+                                     fire_incidents_last30=fire_last30, fire_incidents_prev30=0,
+                                     police_incidents_last30=police_last30, police_incidents_prev30=0,
+                                     **kwargs)
+
+    def test_browse_csv_exports_every_summary_in_browse_order(self):
+        self.create_summary('1 MAIN ST', 3, 9)
+        self.create_summary('2 MAIN ST', 7, 1, business_count=1, business_types='Bar',
+                            business_names='The Pub', active=True)
+        self.create_summary('3 MAIN ST', 5, 4)
+        db.session.flush()
+
+        rv = self.app.get('/browse.csv?date_range=30&sort_by=fire&sort_order=desc')
+        self.assertEquals(200, rv.status_code)
+        self.assertEquals('text/csv', rv.mimetype)
+        assert 'attachment' in rv.headers['Content-Disposition']
+
+        lines = rv.data.splitlines()
+        self.assertEquals('address,business_count,business_types,business_names,'
+                          'fire_incidents_last30,fire_incidents_prev30,'
+                          'police_incidents_last30,police_incidents_prev30,active', lines[0])
+        self.assertEquals('2 MAIN ST,1,Bar,The Pub,7,0,1,0,True', lines[1])
+        self.assertEquals(['2 MAIN ST', '3 MAIN ST', '1 MAIN ST'],
+                          [line.split(',')[0] for line in lines[1:]])
+
+    def test_browse_csv_streams_in_batches(self):
+        [self.create_summary('%d MAIN ST' % i, i, 0) for i in range(5)]
+        db.session.flush()
+
+        with mock.patch('app.CSV_EXPORT_BATCH_SIZE', 2):
+            rv = self.app.get('/browse.csv?date_range=30&sort_by=police&sort_order=asc')
+
+        self.assertEquals(6, len(rv.data.splitlines()))
+
+    def test_browse_csv_file_name_only_uses_known_sort_keys(self):
+        rv = self.app.get('/browse.csv?date_range=30&sort_by=fire%0D%0AX-Injected:%201')
+
+        assert rv.data.startswith('address,')
+        self.assertEquals('attachment; filename=addresses-last30-by-fire.csv', rv.headers['Content-Disposition'])
+        self.assertFalse('X-Injected' in rv.headers)
+
+    def test_search_csv_exports_the_search_results(self):
+        self.create_summary('1 MAIN ST', 3, 9)
+        self.create_summary('2 OAK ST', 7, 1)
+        db.session.flush()
+        # The search itself needs PostgreSQL's pg_trgm.
+        results = models.AddressSummary.query.filter(models.AddressSummary.address.like('%MAIN%'))
+
+        with mock.patch('app.search_for_address_summaries', return_value=results) as search:
+            rv = self.app.get('/search.csv?q=main')
+            lines = rv.data.splitlines()
+
+        search.assert_called_once_with('main')
+        self.assertEquals('attachment; filename=address-search.csv', rv.headers['Content-Disposition'])
+        self.assertEquals(['1 MAIN ST'], [line.split(',')[0] for line in lines[1:]])
+
+    @mock.patch('gdata.spreadsheets.client.SpreadsheetsClient', setup_google_mock())
+    def test_browse_csv_creates_an_audit_log(self):
+        app.config['AUDIT_DISABLED'] = False
+
+        with HTTMock(persona_verify):
+            self.app.post('/log-in', data={'assertion': 'sampletoken'})
+
+        rv = self.app.get('/browse.csv')
+        assert rv.data.startswith('address,')
+
+        del app.config['AUDIT_DISABLED']
+
+        entries = models.AuditLogEntry.query.all()
+        self.assertEquals(2, len(entries))
+        self.assertEquals('/browse.csv', entries[1].resource)
+
+
 class CountCallsTestCase(unittest.TestCase):
     def setUp(self):
         self.app = app.test_client()
@@ -683,5 +1555,546 @@ class CountCallsTestCase(unittest.TestCase):
         assert counts['123 MAIN ST']['police_counts'][7] == 5
         assert counts['123 MAIN ST']['police_counts'][14] == 5
 
+class IncidentSnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.snapshot_dir = tempfile.mkdtemp()
+
+        def days_ago(days):
+            return datetime.datetime.now(pytz.utc) - datetime.timedelta(days=days, hours=1)
+
+        self.incidents = [('123 MAIN ST', days_ago(2), 'Chest Pain', '1000', '1000')] * 3 + \
+                         [('123 MAIN ST', days_ago(10), 'Fall', '1200', '1000')] * 2 + \
+                         [('123 MAIN ST', days_ago(20), 'Seizure', '', '')] + \
+                         [('9 ELM ST ', days_ago(100), 'Fall', '5000', '7000')] + \
+                         [('9 ELM ST', days_ago(500), 'Fall', '5000', '7000')]
+        self.snapshot = IncidentSnapshot.build(self.snapshot_dir, self.incidents)
+        self.today = today_epoch_day()
+
+    def tearDown(self):
+        shutil.rmtree(self.snapshot_dir)
+
+    def test_snapshot_reopens_from_disk(self):
+        snapshot = IncidentSnapshot.open(self.snapshot_dir)
+
+        self.assertEquals(8, len(snapshot))
+        self.assertEquals([u'123 MAIN ST', u'9 ELM ST'], snapshot.addresses)
+        self.assertEquals(sorted(snapshot.days), list(snapshot.days))
+
+    def test_count_calls_from_snapshot_matches_count_calls(self):
+        timeframes = [7, 14, 30, 365]
+        expected = count_calls([incident[:2] for incident in self.incidents], 'alarm_datetime',
+                               'fire_counts', timeframes)
+        expected['9 ELM ST'] = {'fire_counts': {7: 0, 14: 0, 30: 0, 365: 1}}
+
+        counts = count_calls_from_snapshot(self.snapshot, 'fire_counts', 'fire_prior_counts',
+                                           timeframes, self.today)
+
+        self.assertEquals(expected['123 MAIN ST']['fire_counts'], counts['123 MAIN ST']['fire_counts'])
+        self.assertEquals(expected['9 ELM ST']['fire_counts'], counts['9 ELM ST']['fire_counts'])
+        self.assertEquals({7: 2, 14: 1, 30: 0, 365: 0}, counts['123 MAIN ST']['fire_prior_counts'])
+        self.assertEquals({7: 0, 14: 0, 30: 0, 365: 1}, counts['9 ELM ST']['fire_prior_counts'])
+
+    def test_top_reasons_ranks_call_types_per_address(self):
+        top = self.snapshot.top_reasons(30, self.today, limit=2)
+
+        self.assertEquals({'123 MAIN ST': [('Chest Pain', 3), ('Fall', 2)]}, top)
+
+    def test_snapshot_coordinates_match_sum_coordinates(self):
+        expected = sum_coordinates([(incident[0], None, incident[3], incident[4])
+                                    for incident in self.incidents[:-1]])
+
+        self.assertEquals(expected, sum_snapshot_coordinates(self.snapshot, 365, self.today))
+
+    def test_snapshot_heatmap_cells_match_incident_cells(self):
+        incidents = [(incident[0], incident[1], incident[3], incident[4]) for incident in self.incidents]
+
+        self.assertEquals(aggregate_incident_cells(incidents),
+                          aggregate_snapshot_cells(self.snapshot, self.today))
+
+class RebuildSummariesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = app.test_client()
+        db.create_all()
+        self.snapshot_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        db.drop_all()
+        shutil.rmtree(self.snapshot_dir)
+
+    def create_incidents(self):
+        def days_ago(days):
+            return datetime.datetime.now(pytz.utc) - datetime.timedelta(days=days, hours=1)
+
+        for i in range(12):
+            FireIncidentFactory(standardized_address="%d MAIN ST" % (i % 3), alarm_datetime=days_ago(i * 30),
+                                incident_number=i, x_coordinate='1000', y_coordinate='2000',
+                                actual_nfirs_incident_type_description='Fall')
+            PoliceIncidentFactory(standardized_address="%d MAIN ST" % (i % 4), call_datetime=days_ago(i * 5),
+                                  x_coordinate='1000', y_coordinate='3000')
+        PoliceIncidentFactory(standardized_address="MAIN ST", call_datetime=days_ago(1))
+        BusinessLicenseFactory(business_address='2 MAIN ST ', name='The Pub', business_service_description='Bar')
+        db.session.add(models.FireDispatch(incident_number=3, apparatus_id='E1', response_time_in_sec=300,
+                                           duration_time_in_sec=1200))
+        db.session.add(models.ActivatedAddress(address='1 MAIN ST'))
+        db.session.commit()
+
+    @mock.patch('sys.stdout', mock.Mock())
+    @mock.patch('count_calls_for_service.fetch_business_summary_data',
+                mock.Mock(return_value=[('2 MAIN ST ', 1, 'Bar', 'The Pub')]))
+    def test_rebuild_summaries_writes_summaries_and_heatmap(self):
+        self.create_incidents()
+
+        rebuild_summaries(self.snapshot_dir, concurrent=False)
+
+        summaries = dict((summary.address, summary) for summary in models.AddressSummary.query.all())
+        self.assertEquals(['0 MAIN ST', '1 MAIN ST', '2 MAIN ST', '3 MAIN ST'], sorted(summaries))
+        self.assertEquals(4, summaries['0 MAIN ST'].fire_incidents_last365)
+        self.assertEquals(1, summaries['0 MAIN ST'].fire_incidents_last30)
+        self.assertEquals(2, summaries['0 MAIN ST'].police_incidents_last30)
+        self.assertEquals(1, summaries['0 MAIN ST'].police_incidents_prev30)
+        self.assertAlmostEquals((4 * 2000 + 3 * 3000) / 7.0, summaries['0 MAIN ST'].y_coordinate)
+        self.assertEquals(1, summaries['0 MAIN ST'].fire_dispatch_count)
+        self.assertEquals(1200, summaries['0 MAIN ST'].fire_unit_seconds)
+        self.assertEquals(True, summaries['1 MAIN ST'].active)
+        self.assertEquals('The Pub', summaries['2 MAIN ST'].business_names)
+        assert models.HeatmapCell.query.count() > 0
+
+        detail = models.AddressDetail.query.get('0 MAIN ST').as_dict()
+        self.assertEquals({7: 1, 30: 1, 90: 1, 365: 4}, detail['counts']['fire'])
+        self.assertEquals([['Fall', 4]], detail['top_call_types']['fire'][365])
+        self.assertEquals(['The Pub'], models.AddressDetail.query.get('2 MAIN ST').as_dict()['business_names'])
+
+    @mock.patch('sys.stdout', mock.Mock())
+    @mock.patch('count_calls_for_service.fetch_business_summary_data',
+                mock.Mock(return_value=[('2 MAIN ST ', 1, 'Bar', 'The Pub')]))
+    def test_streaming_rebuild_matches_snapshot_rebuild(self):
+        self.create_incidents()
+
+        rebuild_summaries(self.snapshot_dir, concurrent=False)
+        tables = self.summary_tables()
+
+        rebuild_summaries_streaming(batch_size=2)
+        db.session.expire_all()
+
+        self.assertEquals(tables, self.summary_tables())
+
+    def summary_tables(self):
+        ''' Every row the rebuilds write, as dicts in a stable order. '''
+        def table_rows(model, key):
+            return sorted((dict((column.name, getattr(row, column.name)) for column in model.__table__.columns)
+                           for row in model.query.all()), key=key)
+
+        return [table_rows(models.AddressSummary, lambda row: row['address']),
+                table_rows(models.AddressDetail, lambda row: row['address']),
+                table_rows(models.HeatmapCell, lambda row: sorted(row.items()))]
+
+    @mock.patch('sys.stdout', mock.Mock())
+    @mock.patch('count_calls_for_service.fetch_business_summary_data',
+                mock.Mock(return_value=[('2 MAIN ST ', 1, 'Bar', 'The Pub')]))
+    def test_sharded_rebuild_matches_streaming_rebuild(self):
+        # Worker processes can't see an in-memory database, so this runs in a
+        # city whose databases are files.
+        database_dir = tempfile.mkdtemp()
+        city = {'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(database_dir, 'app.db'),
+                'SQLALCHEMY_BINDS': {'lbc_data': 'sqlite:///' + os.path.join(database_dir, 'data.db')}}
+        try:
+            with mock.patch.dict(app.config['CITIES'], {'shardville': city}), use_city('shardville'):
+                db.create_all()
+                self.create_incidents()
+
+                rebuild_summaries_streaming(batch_size=2)
+                tables = self.summary_tables()
+
+                rebuild_summaries_sharded(3, batch_size=2)
+                db.session.expire_all()
+
+                self.assertEquals(tables, self.summary_tables())
+                self.assertEquals([], [name for name in db.engine.table_names() if '_shard' in name])
+        finally:
+            shutil.rmtree(database_dir)
+
+    @mock.patch('count_calls_for_service.fetch_business_summary_data',
+                mock.Mock(return_value=[('2 MAIN ST ', 1, 'Bar', 'The Pub')]))
+    def test_shards_match_unsharded_summaries(self):
+        self.create_incidents()
+        today, one_year_ago, window_start = rebuild_windows()
+
+        shards = shard_bounds(3, window_start)
+        self.assertEquals(3, len(shards))
+        self.assertEquals(None, shards[0][0])
+        self.assertEquals(None, shards[-1][1])
+
+        def shard_rows(shard, cells):
+            return list(streamed_address_rows(stream_address_fields(shard, today, one_year_ago, window_start,
+                                                                    cells)))
+
+        unsharded_cells = {'fire': CellCounter(today), 'police': CellCounter(today)}
+        unsharded_rows = shard_rows(None, unsharded_cells)
+        sharded_rows = []
+        sharded_cells = CellCounter(today)
+        for shard in shards:
+            cells = {'fire': CellCounter(today), 'police': CellCounter(today)}
+            sharded_rows.extend(shard_rows(shard, cells))
+            sharded_cells.merge(cells['police'])
+
+        self.assertEquals(unsharded_rows, sharded_rows)
+        self.assertEquals(unsharded_cells['police'].cells(), sharded_cells.cells())
+
+    def test_merge_by_address_combines_sorted_streams(self):
+        merged = merge_by_address(iter([('1 A ST', {'a': 1}), ('3 A ST', {'a': 3})]),
+                                  iter([('1 A ST', {'b': 1}), ('2 A ST', {'b': 2})]))
+
+        self.assertEquals([('1 A ST', {'a': 1, 'b': 1}), ('2 A ST', {'b': 2}), ('3 A ST', {'a': 3})],
+                          list(merged))
+
+    @mock.patch('sys.stdout', mock.Mock())
+    def test_phase_timer_records_each_phase(self):
+        timer = PhaseTimer()
+
+        self.assertEquals(3, timer.run('Adding', lambda a, b: a + b, 1, 2))
+        self.assertEquals(['Adding'], [name for name, elapsed in timer.durations])
+
+class JobRunnerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = app.test_client()
+        db.create_all()
+        self.lock_dir = tempfile.mkdtemp()
+        self.lock_config = mock.patch.dict(app.config, {'JOB_LOCK_DIR': self.lock_dir})
+        self.lock_config.start()
+        data_freshness_cache.clear()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+        self.lock_config.stop()
+        shutil.rmtree(self.lock_dir)
+        data_freshness_cache.clear()
+
+    @mock.patch('sys.stdout', mock.Mock())
+    def test_run_job_records_phases(self):
+        def job(timer):
+            timer.run('Loading', lambda: None)
+            timer.count_rows('Loading', 12)
+
+        run_job('test-job', job)
+
+        run = models.JobRun.query.one()
+        self.assertEquals('succeeded', run.status)
+        assert run.peak_memory_kb > 0
+        phases = json.loads(run.phases)
+        self.assertEquals(['Loading'], [phase['name'] for phase in phases])
+        self.assertEquals(12, phases[0]['rows'])
+        self.assertEquals(run.finished_at, models.JobRun.last_success('test-job'))
+
+    @mock.patch('sys.stdout', mock.Mock())
+    def test_run_job_records_failures(self):
+        def job(timer):
+            raise ValueError('no data')
+
+        self.assertRaises(ValueError, run_job, 'test-job', job)
+
+        run = models.JobRun.query.one()
+        self.assertEquals('failed', run.status)
+        assert 'no data' in run.error
+        self.assertEquals(None, models.JobRun.last_success('test-job'))
+
+    def test_overlapping_runs_are_refused(self):
+        job = mock.Mock()
+
+        with JobLock('test-job'):
+            self.assertRaises(JobLocked, run_job, 'test-job', job)
+
+        self.assertFalse(job.called)
+        self.assertEquals(0, models.JobRun.query.count())
+
+    def test_footer_shows_when_data_was_updated(self):
+        db.session.add(models.JobRun(job_name=models.SUMMARY_JOB_NAME, status='succeeded',
+                                     finished_at=datetime.datetime(2014, 8, 1, 2, 30)))
+        db.session.commit()
+
+        rv = self.app.get('/browse')
+
+        assert 'Data updated Aug  1 2014 02:30AM' in rv.data
+
+class StubDBAPI(object):
+    class Error(Exception):
+        pass
+
+    class OperationalError(Error):
+        pass
+
+class TransformerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.host_engine = create_engine('sqlite://')
+        self.dest_engine = create_engine('sqlite://')
+        for engine in [self.host_engine, self.dest_engine]:
+            engine.execute('CREATE TABLE police_incidents (cad_call_number CHAR(25), incident_address CHAR(256))')
+
+        self.host_engine.execute('INSERT INTO police_incidents VALUES (?, ?)',
+                                 [('1', '1 MAIN ST'), ('2', '2 MAIN ST'), ('1', '10 MAIN ST')])
+
+    def dest_rows(self):
+        return sorted(tuple(row) for row in self.dest_engine.execute('SELECT * FROM police_incidents'))
+
+    @mock.patch('sys.stdout', mock.Mock())
+    def test_transform_loads_every_row(self):
+        transform(self.host_engine, self.dest_engine, 'police_incidents', [])
+
+        self.assertEquals(3, len(self.dest_rows()))
+
+    @mock.patch('sys.stdout', mock.Mock())
+    def test_transform_upserts_on_unique_key(self):
+        self.dest_engine.execute("INSERT INTO police_incidents VALUES ('2', 'OLD ADDRESS'), ('3', '3 MAIN ST')")
+
+        transform(self.host_engine, self.dest_engine, 'police_incidents', [], ['cad_call_number'])
+
+        self.assertEquals([('1', '10 MAIN ST'), ('2', '2 MAIN ST'), ('3', '3 MAIN ST')], self.dest_rows())
+
+    @mock.patch('sys.stdout', mock.Mock())
+    def test_incremental_transform_copies_rows_past_the_high_water_mark(self):
+        transform(self.host_engine, self.dest_engine, 'police_incidents', [], ['cad_call_number'],
+                  'cad_call_number')
+        self.host_engine.execute("UPDATE police_incidents SET incident_address = 'CHANGED' WHERE cad_call_number = '1'")
+        self.host_engine.execute("INSERT INTO police_incidents VALUES ('3', '3 MAIN ST')")
+
+        transform(self.host_engine, self.dest_engine, 'police_incidents', [], ['cad_call_number'],
+                  'cad_call_number')
+        self.assertEquals([('1', '10 MAIN ST'), ('2', '2 MAIN ST'), ('3', '3 MAIN ST')], self.dest_rows())
+
+        transform(self.host_engine, self.dest_engine, 'police_incidents', [], ['cad_call_number'],
+                  'cad_call_number', full_refresh=True)
+        self.assertEquals([('1', 'CHANGED'), ('2', '2 MAIN ST'), ('3', '3 MAIN ST')], self.dest_rows())
+
+    @mock.patch('sys.stdout', mock.Mock())
+    @mock.patch('transformer.BATCH_SIZE', 1)
+    def test_resume_continues_after_the_last_committed_batch(self):
+        def fail_on_call_two(row):
+            if row.cad_call_number == '2':
+                raise ValueError('lost the connection')
+            return row
+
+        self.assertRaises(ValueError, transform, self.host_engine, self.dest_engine, 'police_incidents',
+                          [fail_on_call_two], ['cad_call_number'])
+        self.assertEquals(['1'], [key for key, address in self.dest_rows()])
+
+        report = transform(self.host_engine, self.dest_engine, 'police_incidents', [], ['cad_call_number'],
+                           resume=True)
+
+        self.assertEquals(['1', '2'], [key for key, address in self.dest_rows()])
+        self.assertEquals(dict(read=1, skipped=2, retried=0, pushed_down=0, filtered=0, loaded=1), report)
+
+    @mock.patch('sys.stdout', mock.Mock())
+    @mock.patch('time.sleep', mock.Mock())
+    def test_failed_batches_are_retried(self):
+        load_rows = transformer.load_rows
+        failures = [OperationalError('INSERT', {}, Exception('server closed the connection'))]
+
+        def flaky_load_rows(*args):
+            if failures:
+                raise failures.pop()
+            return load_rows(*args)
+
+        with mock.patch('transformer.load_rows', flaky_load_rows):
+            report = transform(self.host_engine, self.dest_engine, 'police_incidents', [], ['cad_call_number'])
+
+        self.assertEquals(3, report['retried'])
+        self.assertEquals([('1', '10 MAIN ST'), ('2', '2 MAIN ST')], self.dest_rows())
+
+    @mock.patch('sys.stdout', mock.Mock())
+    def test_rules_are_pushed_down_to_the_host_database(self):
+        self.host_engine.execute('INSERT INTO police_incidents VALUES (?, ?)', [('4', '4 OAK ST, CLB'), ('5', None)])
+        rules = [StripSuffix('incident_address', ', CLB'), ExcludeStartingWith('incident_address', '2')]
+
+        report = transform(self.host_engine, self.dest_engine, 'police_incidents', rules, ['cad_call_number'])
+
+        self.assertEquals([('1', '10 MAIN ST'), ('4', '4 OAK ST'), ('5', None)], self.dest_rows())
+        self.assertEquals((1, 0), (report['pushed_down'], report['filtered']))
+
+    @mock.patch('sys.stdout', mock.Mock())
+    def test_rules_after_a_function_run_client_side(self):
+        self.host_engine.execute('INSERT INTO police_incidents VALUES (?, ?)', [('4', '4 OAK ST, CLB'), ('5', None)])
+        rules = [lambda row: row, StripSuffix('incident_address', ', CLB'), ExcludeStartingWith('incident_address', '2')]
+
+        report = transform(self.host_engine, self.dest_engine, 'police_incidents', rules, ['cad_call_number'])
+
+        self.assertEquals([('1', '10 MAIN ST'), ('4', '4 OAK ST'), ('5', None)], self.dest_rows())
+        self.assertEquals((0, 1), (report['pushed_down'], report['filtered']))
+
+    def test_rules_must_define_arguments(self):
+        class Uppercase(Rule):
+            def apply_batch(self, batch):
+                return batch
+
+            def push_down(self, columns):
+                return None
+
+        self.assertRaises(TypeError, Uppercase)
+        self.assertEquals("StripSuffix('incident_address', ', CLB')", repr(StripSuffix('incident_address', ', CLB')))
+
+    @mock.patch('sys.stdout', mock.Mock())
+    def test_batch_and_row_transformations_can_be_mixed(self):
+        @batch_transformation
+        def drop_call_two(batch):
+            return filter_batch(batch, np.array(batch['cad_call_number']) != '2')
+
+        def lowercase_address(row):
+            row.incident_address = row.incident_address.lower()
+            return row
+
+        report = transform(self.host_engine, self.dest_engine, 'police_incidents',
+                           [drop_call_two, lowercase_address], ['cad_call_number'])
+
+        self.assertEquals([('1', '10 main st')], self.dest_rows())
+        self.assertEquals(1, report['filtered'])
+
+    @mock.patch('sys.stdout', mock.Mock())
+    def test_staging_load_replaces_the_destination(self):
+        self.dest_engine.execute("INSERT INTO police_incidents VALUES ('9', 'STALE')")
+
+        transform(self.host_engine, self.dest_engine, 'police_incidents', [], ['cad_call_number'], staging=True)
+
+        self.assertEquals([('1', '10 MAIN ST'), ('2', '2 MAIN ST')], self.dest_rows())
+        self.assertFalse(self.dest_engine.has_table('police_incidents_staging'))
+
+    @mock.patch('sys.stdout', mock.Mock())
+    def test_metrics_are_appended_as_json(self):
+        self.host_engine.execute('INSERT INTO police_incidents VALUES (?, ?)', [('5', None)])
+
+        def drop_missing_addresses(row):
+            return row if row.incident_address is not None else None
+
+        metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, metrics_dir)
+        path = os.path.join(metrics_dir, 'metrics.json')
+        for run in range(2):
+            transform(self.host_engine, self.dest_engine, 'police_incidents',
+                      [ExcludeStartingWith('incident_address', '2'), drop_missing_addresses], ['cad_call_number'],
+                      full_refresh=True, metrics_path=path)
+
+        with open(path) as metrics_file:
+            runs = [json.loads(line) for line in metrics_file]
+
+        self.assertEquals(2, len(runs))
+        metrics = runs[-1]
+        self.assertEquals(('police_incidents', 3, 3), (metrics['table'], metrics['source_rows'], metrics['rows']['read']))
+        self.assertEquals(['count', 'fetch', 'load', 'transform'], sorted(metrics['phases']))
+        self.assertEquals([("ExcludeStartingWith('incident_address', '2')", True, 4, 1),
+                           ('drop_missing_addresses', False, 3, 1)],
+                          [(stats['name'], stats['in_database'], stats['rows_in'], stats['dropped'])
+                           for stats in metrics['transformations']])
+        self.assertIsNone(metrics['transformations'][0]['seconds'])
+        self.assertGreaterEqual(metrics['transformations'][1]['seconds'], 0)
+
+    def test_progress_estimates_time_left_from_the_source_rows(self):
+        metrics = transformer.TransformMetrics('police_incidents')
+        metrics.source_rows = 3000
+        metrics.started -= 10
+
+        self.assertEquals('Row #: 1000 of 3000 (100 rows/s, ETA 0:00:20)', metrics.progress(1000))
+
+    @mock.patch('sys.stdout', mock.Mock())
+    def test_csv_gz_exports_load_through_the_same_rules(self):
+        csv_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, csv_dir)
+        path = os.path.join(csv_dir, 'police.csv.gz')
+        export = gzip.open(path, 'wb')
+        export.write('CAD Call Number,Incident Address,Beat\n1,"1 MAIN ST, CLB",4\n\n2,2 MAIN ST,5\n1,10 MAIN ST,4\n')
+        export.close()
+
+        report = transform(None, self.dest_engine, 'police_incidents',
+                           [StripSuffix('incident_address', ', CLB'), ExcludeStartingWith('incident_address', '2')],
+                           ['cad_call_number'], 'cad_call_number', csv_path=path)
+
+        self.assertEquals([('1', '10 MAIN ST')], self.dest_rows())
+        self.assertEquals((3, 1, 1), (report['read'], report['filtered'], report['loaded']))
+
+    def test_csv_fields_are_coerced_to_the_column_types(self):
+        table = db.Table('fire_incidents', db.MetaData(), db.Column('cad_call_number', db.Integer),
+                         db.Column('alarm_datetime', db.DateTime(timezone=True)),
+                         db.Column('district', db.String(6)))
+        timezone = pytz.timezone(csv_source.CSV_TIMEZONE)
+
+        self.assertEquals(42, csv_source.column_coercer(table.c.cad_call_number, timezone)(' 42 '))
+        self.assertIsNone(csv_source.column_coercer(table.c.cad_call_number, timezone)(''))
+        self.assertEquals(datetime.datetime(2014, 8, 1, 19, 30, tzinfo=pytz.utc),
+                          csv_source.column_coercer(table.c.alarm_datetime, timezone)('08/01/2014 12:30:00'))
+        self.assertRaises(ValueError, csv_source.column_coercer(table.c.district, timezone), 'TOO LONG')
+
+    def test_copy_loader_streams_csv_with_nulls(self):
+        table = db.Table('police_incidents', db.MetaData(), db.Column('cad_call_number', db.String),
+                         db.Column('incident_address', db.String))
+        connection = mock.Mock(dialect=postgresql.dialect())
+        copied = []
+        connection.connection.cursor.return_value.copy_expert.side_effect = \
+            lambda statement, buffer: copied.append((statement, buffer.read()))
+
+        CopyLoader(table).insert(connection, [{'cad_call_number': '1', 'incident_address': None},
+                                              {'cad_call_number': '2', 'incident_address': u'"A" ST, \xc9'}])
+
+        self.assertEquals([('COPY police_incidents (cad_call_number, incident_address) FROM STDIN WITH CSV',
+                            '"1",\n"2","""A"" ST, \xc3\x89"\n')], copied)
+
+    @mock.patch('sys.stdout', mock.Mock())
+    @mock.patch('time.sleep', mock.Mock())
+    def test_copy_failures_are_retried(self):
+        table = db.Table('police_incidents', db.MetaData(), db.Column('cad_call_number', db.String))
+        connection = mock.Mock(dialect=postgresql.dialect())
+        # psycopg2's exceptions, as the raw cursor raises them.
+        connection.dialect.dbapi = StubDBAPI
+        copy_expert = connection.connection.cursor.return_value.copy_expert
+        copy_expert.side_effect = [StubDBAPI.OperationalError('server closed the connection'), None]
+        engine = mock.MagicMock()
+        engine.begin.return_value.__enter__.return_value = connection
+        report = dict(retried=0)
+
+        transformer.load_batch(engine, table, [{'cad_call_number': '1'}], None, None, CopyLoader(table), report)
+
+        self.assertEquals(2, copy_expert.call_count)
+        self.assertEquals(1, report['retried'])
+
+    def test_high_water_marks_round_trip_datetimes(self):
+        column = db.Column('call_datetime', db.DateTime(timezone=True))
+        mark = datetime.datetime(2014, 8, 1, 2, 30, 15, 123, pytz.utc)
+
+        self.assertEquals(mark, decode_mark(encode_mark(mark), column))
+
+# Generous enough for a cold cache on a slow dyno; the point is to notice when
+# something heavy lands back on an import path.
+IMPORT_TIME_BUDGET = 1.5
+
+IMPORT_CHECK = '''
+import sys, time
+start = time.time()
+import %s
+print time.time() - start
+print ' '.join(sorted(sys.modules))
+'''
+
+
+class ImportTestCase(unittest.TestCase):
+
+    def import_in_subprocess(self, modules):
+        ''' Seconds taken to import `modules` in a fresh interpreter, and the
+        names of every module loaded by then. '''
+        output = subprocess.check_output([sys.executable, '-c', IMPORT_CHECK % modules],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+        seconds, loaded = output.splitlines()[-2:]
+        return float(seconds), set(loaded.split())
+
+    def test_batch_imports_leave_out_the_web_app(self):
+        seconds, loaded = self.import_in_subprocess('count_calls_for_service, jobs, models')
+
+        for module in ('app', 'gdata', 'oauth2client', 'requests', 'webassets',
+                       'flask_login', 'flask_seasurf'):
+            self.assertNotIn(module, loaded)
+        self.assertLess(seconds, IMPORT_TIME_BUDGET)
+
+    def test_app_import_defers_upstream_clients(self):
+        seconds, loaded = self.import_in_subprocess('app')
+
+        for module in ('gdata', 'oauth2client', 'requests', 'webassets', 'numpy'):
+            self.assertNotIn(module, loaded)
+        self.assertLess(seconds, IMPORT_TIME_BUDGET)
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,43 +1,618 @@
 # interface: 
 # `transformer --hostdb=dbstring1 --destinationdb=dbstring2 transformation.py`
-# `python fire_transformation.py --hostdb=dbstring1 --destinationdb=dbstring2`
+# `python fire_transformation.py (--hostdb=dbstring1 | --csv=export.csv.gz) --destinationdb=dbstring2 [--full-refresh] [--resume] [--staging] [--metrics=path]`
 
+import abc
 import argparse
-from sqlalchemy import create_engine, MetaData, Table
+import collections
+import datetime
+import json
+import time
+from contextlib import contextmanager
+import pytz
+from sqlalchemy import create_engine, MetaData, Table, Column, String, Text, DateTime, Integer, Boolean, tuple_
+from sqlalchemy import and_, or_, case, func
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.sql import select, insert
+from loaders import ExecutemanyLoader, loader_for, prepare_staging, publish_staging
+from csv_source import CsvSource
 
 host_db = None
 destination_db = None
 
-meta = MetaData()
+BATCH_SIZE = 50000
+# Rows per fetchmany from the host database, and between progress lines.
+FETCH_SIZE = 10000
+# Keys per DELETE when upserting, to keep the IN lists a reasonable size.
+DELETE_CHUNK_SIZE = 1000
+MARK_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+# A batch that fails with a connection-level error is retried this many
+# times, waiting RETRY_DELAY seconds longer before each attempt.
+BATCH_RETRIES = 3
+RETRY_DELAY = 5
 
-def transform(host_engine, dest_engine, table_name, transformations):
-    host_table = Table(table_name, meta, autoload=True, autoload_with=host_engine)
+# Kept in the destination database: how far each table has been loaded.
+state_meta = MetaData()
+transformer_state = Table('transformer_state', state_meta,
+                          Column('table_name', String(100), primary_key=True),
+                          Column('high_water_column', String(100)),
+                          Column('high_water_mark', Text),
+                          Column('updated_at', DateTime(timezone=True)))
+# The last batch committed by the current (or last) run of each table.
+transformer_checkpoints = Table('transformer_checkpoints', state_meta,
+                                Column('table_name', String(100), primary_key=True),
+                                Column('key_column', String(100)),
+                                Column('last_key', Text),
+                                Column('rows_read', Integer),
+                                Column('high_water_mark', Text),
+                                Column('completed', Boolean),
+                                Column('updated_at', DateTime(timezone=True)))
 
-    print "Fetching rows..."
-    results = host_engine.execute(select([host_table]))
+def encode_mark(value):
+    ''' High-water marks are stored as text: datetimes in UTC, anything else
+    as it prints. '''
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(pytz.utc).replace(tzinfo=None)
+        return value.strftime(MARK_DATETIME_FORMAT)
+
+    return unicode(value)
+
+def decode_mark(text, column):
+    python_type = column.type.python_type
+    if python_type is datetime.datetime:
+        value = datetime.datetime.strptime(text, MARK_DATETIME_FORMAT)
+        return pytz.utc.localize(value) if getattr(column.type, 'timezone', False) else value
+
+    return python_type(text)
+
+class Row(dict):
+    ''' A mutable row for per-row transformations, which can read and assign
+    columns as attributes the way they used to read RowProxy objects. '''
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+
+# Transformations work on batches: dicts of equal-length column lists (or
+# NumPy arrays), keyed by column name.
+def rows_to_batch(rows, names):
+    return dict((name, [row[name] for row in rows]) for name in names)
+
+def batch_length(batch):
+    for values in batch.itervalues():
+        return len(values)
+    return 0
+
+def batch_to_rows(batch):
+    names = list(batch)
+    columns = [batch[name].tolist() if hasattr(batch[name], 'tolist') else batch[name] for name in names]
+    return [dict(zip(names, values)) for values in zip(*columns)]
+
+def filter_batch(batch, keep):
+    ''' The rows of `batch` where `keep`, a sequence of booleans, is true. '''
+    keep = list(keep)
+    return dict((name, [value for value, kept in zip(values, keep) if kept]) for name, values in batch.iteritems())
+
+def batch_transformation(f):
+    ''' Mark `f` as taking and returning a whole batch rather than one row. '''
+    f.takes_batch = True
+    return f
+
+def as_batch_transformation(f):
+    ''' `f` itself if it takes batches, otherwise an adapter that calls the
+    per-row function `f` on each row of a batch and drops rows it returns
+    None for. '''
+    if getattr(f, 'takes_batch', False):
+        return f
+
+    @batch_transformation
+    def apply_to_rows(batch):
+        names = list(batch)
+        rows = []
+        for row in batch_to_rows(batch):
+            row = f(Row(row))
+            if row is not None:
+                rows.append(row)
+        return rows_to_batch(rows, names)
+
+    return apply_to_rows
+
+
+class Rule(object):
+    ''' A declarative transformation. It's applied to whole batches like a
+    batch_transformation, but transform() can also compile it into the
+    source SELECT so the work is done by the host database. '''
+
+    __metaclass__ = abc.ABCMeta
+
+    takes_batch = True
+
+    def __call__(self, batch):
+        return self.apply_batch(batch)
+
+    @abc.abstractmethod
+    def apply_batch(self, batch):
+        ''' The batch with the rule applied. '''
+
+    @abc.abstractmethod
+    def push_down(self, columns):
+        ''' Rewrite entries of `columns`, the SELECT's column expressions by
+        name, and return a WHERE condition or None. '''
+
+    @abc.abstractmethod
+    def arguments(self):
+        ''' The constructor's arguments, for repr(). '''
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join(repr(value) for value in self.arguments()))
+
+
+class ExcludeStartingWith(Rule):
+    ''' Drop rows whose `column` starts with `prefix`. Rows where it's null
+    are kept. '''
+
+    def __init__(self, column, prefix):
+        self.column = column
+        self.prefix = prefix
+
+    def arguments(self):
+        return (self.column, self.prefix)
+
+    def apply_batch(self, batch):
+        return filter_batch(batch, [value is None or not value.startswith(self.prefix)
+                                    for value in batch[self.column]])
+
+    def push_down(self, columns):
+        # substr rather than LIKE, which ignores case on SQLite.
+        value = columns[self.column]
+        return or_(value == None, func.substr(value, 1, len(self.prefix)) != self.prefix)
+
+
+class StripSuffix(Rule):
+    ''' Remove `suffix` from the end of `column` where it's present. '''
+
+    def __init__(self, column, suffix):
+        self.column = column
+        self.suffix = suffix
+
+    def arguments(self):
+        return (self.column, self.suffix)
+
+    def apply_batch(self, batch):
+        batch = dict(batch)
+        batch[self.column] = [value[:-len(self.suffix)] if value is not None and value.endswith(self.suffix)
+                              else value for value in batch[self.column]]
+        return batch
+
+    def push_down(self, columns):
+        value = columns[self.column]
+        length = func.length(value)
+        has_suffix = and_(length >= len(self.suffix),
+                          func.substr(value, length - len(self.suffix) + 1) == self.suffix)
+        columns[self.column] = case([(has_suffix, func.substr(value, 1, length - len(self.suffix)))], else_=value)
+
+
+class ReplaceValues(Rule):
+    ''' Rewrite `column` through `replacements`, a dict of old to new values;
+    other values are left alone. '''
+
+    def __init__(self, column, replacements):
+        self.column = column
+        self.replacements = replacements
+
+    def arguments(self):
+        return (self.column, self.replacements)
+
+    def apply_batch(self, batch):
+        batch = dict(batch)
+        batch[self.column] = [self.replacements.get(value, value) for value in batch[self.column]]
+        return batch
+
+    def push_down(self, columns):
+        value = columns[self.column]
+        if None in self.replacements:
+            raise ValueError('ReplaceValues can only push down non-null values.')
+
+        columns[self.column] = case([(value == old, new) for old, new in sorted(self.replacements.items())],
+                                    else_=value)
+
+
+def push_down_rules(host_table, transformations):
+    ''' Compile the leading Rules in `transformations` into the source
+    SELECT's column expressions and WHERE conditions. Everything from the
+    first plain function on stays client-side, since the function might
+    change what later rules read. Returns (columns, (rule, condition) pairs,
+    pushed rules, remaining transformations). '''
+    columns = collections.OrderedDict((column.name, column) for column in host_table.columns)
+    conditions = []
+    for index, rule in enumerate(transformations):
+        if not isinstance(rule, Rule):
+            return columns, conditions, transformations[:index], transformations[index:]
+
+        condition = rule.push_down(columns)
+        if condition is not None:
+            conditions.append((rule, condition))
+
+    return columns, conditions, list(transformations), []
+
+
+def read_high_water_mark(dest_engine, table_name, column):
+    ''' The stored high-water mark for `table_name`, or None if it has never
+    been loaded incrementally on `column`. '''
+    transformer_state.create(dest_engine, checkfirst=True)
+    state = dest_engine.execute(select([transformer_state])
+                                .where(transformer_state.c.table_name == table_name)).first()
+    if state is None or state.high_water_column != column.name or state.high_water_mark is None:
+        return None
+
+    return decode_mark(state.high_water_mark, column)
+
+def save_high_water_mark(dest_engine, table_name, column, mark):
+    with dest_engine.begin() as connection:
+        connection.execute(transformer_state.delete().where(transformer_state.c.table_name == table_name))
+        connection.execute(transformer_state.insert(), table_name=table_name, high_water_column=column.name,
+                           high_water_mark=encode_mark(mark), updated_at=datetime.datetime.now(pytz.utc))
+
+def read_checkpoint(dest_engine, table_name):
+    transformer_checkpoints.create(dest_engine, checkfirst=True)
+    return dest_engine.execute(select([transformer_checkpoints])
+                               .where(transformer_checkpoints.c.table_name == table_name)).first()
+
+def write_checkpoint(connection, table_name, key_column, last_key, rows_read, high_water_mark, completed):
+    connection.execute(transformer_checkpoints.delete().where(transformer_checkpoints.c.table_name == table_name))
+    connection.execute(transformer_checkpoints.insert(), table_name=table_name, key_column=key_column.name,
+                       last_key=None if last_key is None else encode_mark(last_key), rows_read=rows_read,
+                       high_water_mark=None if high_water_mark is None else encode_mark(high_water_mark),
+                       completed=completed, updated_at=datetime.datetime.now(pytz.utc))
+
+def load_rows(dest_engine, dest_table, rows, unique_key=None, checkpoint=None, loader=None):
+    ''' Insert `rows` into `dest_table` with `loader` (an executemany by
+    default). With `unique_key`, a list of column names, only the last row
+    for each key is kept and destination rows with the same keys are deleted
+    first in the same transaction, so loading is an upsert on any database
+    and a batch can safely be written twice. `checkpoint` is called with the
+    connection before the transaction commits. Returns the number of rows
+    inserted. '''
+    loader = loader or ExecutemanyLoader(dest_table)
+    rows = [dict(row) for row in rows]
+    if unique_key:
+        rows_by_key = collections.OrderedDict()
+        for row in rows:
+            rows_by_key[tuple(row[column] for column in unique_key)] = row
+        rows = rows_by_key.values()
+
+    with dest_engine.begin() as connection:
+        if unique_key:
+            keys = rows_by_key.keys()
+            key_columns = [dest_table.c[column] for column in unique_key]
+            for start in range(0, len(keys), DELETE_CHUNK_SIZE):
+                chunk = keys[start:start + DELETE_CHUNK_SIZE]
+                if len(key_columns) == 1:
+                    matches_key = key_columns[0].in_([key[0] for key in chunk])
+                else:
+                    matches_key = tuple_(*key_columns).in_(chunk)
+                connection.execute(dest_table.delete().where(matches_key))
+
+        loader.insert(connection, rows)
+
+        if checkpoint is not None:
+            checkpoint(connection)
+
+    return len(rows)
+
+def transformation_name(f):
+    return repr(f) if isinstance(f, Rule) else getattr(f, '__name__', repr(f))
+
+
+class TransformMetrics(object):
+    ''' Where one transform() run spends its time: seconds in each phase
+    (counting the source rows, fetching, transforming and loading), the read
+    rate and an ETA against the source row count, and the time taken and
+    rows dropped by each transformation. '''
+
+    PHASES = ['count', 'fetch', 'transform', 'load']
+
+    def __init__(self, table_name):
+        self.table_name = table_name
+        self.started_at = datetime.datetime.now(pytz.utc)
+        self.started = time.time()
+        self.source_rows = None
+        self.phases = collections.OrderedDict((phase, 0.0) for phase in self.PHASES)
+        self.transformations = []
+
+    @contextmanager
+    def timed(self, phase):
+        phase_started = time.time()
+        try:
+            yield
+        finally:
+            self.phases[phase] += time.time() - phase_started
+
+    def add_transformation(self, f, in_database=False):
+        ''' Start counting for `f`; returns the dict that record() updates.
+        Rules run in the database have no time of their own. '''
+        stats = dict(name=transformation_name(f), in_database=in_database,
+                     seconds=None if in_database else 0.0, rows_in=0, dropped=0)
+        self.transformations.append(stats)
+        return stats
+
+    def record(self, stats, seconds, rows_in, rows_out):
+        if seconds is not None:
+            stats['seconds'] += seconds
+        stats['rows_in'] += rows_in
+        stats['dropped'] += rows_in - rows_out
+
+    def rows_per_second(self, rows_read):
+        elapsed = time.time() - self.started - self.phases['count']
+        return rows_read / elapsed if elapsed > 0 else 0.0
+
+    def progress(self, rows_read):
+        rate = self.rows_per_second(rows_read)
+        if self.source_rows is None or not rate:
+            return "Row #: %d (%.0f rows/s)" % (rows_read, rate)
+
+        remaining = max(self.source_rows - rows_read, 0) / rate
+        return "Row #: %d of %d (%.0f rows/s, ETA %s)" % (
+            rows_read, self.source_rows, rate, datetime.timedelta(seconds=int(remaining)))
+
+    def as_dict(self, report):
+        return {
+            'table': self.table_name,
+            'started_at': self.started_at.isoformat(),
+            'seconds': round(time.time() - self.started, 3),
+            'source_rows': self.source_rows,
+            'rows_per_second': round(self.rows_per_second(report['read']), 1),
+            'rows': report,
+            'phases': collections.OrderedDict((phase, round(seconds, 3))
+                                              for phase, seconds in self.phases.iteritems()),
+            'transformations': [dict(stats, seconds=None if stats['seconds'] is None else round(stats['seconds'], 3))
+                                for stats in self.transformations],
+        }
+
+    def report(self):
+        print "Phase wall times:"
+        for phase, seconds in self.phases.iteritems():
+            print "  %-32s %8.2fs" % (phase, seconds)
+        print "  %-32s %8.2fs" % ('Total', time.time() - self.started)
+        for stats in self.transformations:
+            seconds = 'in database' if stats['seconds'] is None else '%.2fs' % stats['seconds']
+            print "  %-48s %12s  dropped %d of %d" % (stats['name'], seconds, stats['dropped'], stats['rows_in'])
+
+    def write(self, path, report):
+        ''' Append this run to `path` as one line of JSON. '''
+        with open(path, 'a') as metrics_file:
+            metrics_file.write(json.dumps(self.as_dict(report)) + '\n')
+
+
+def load_batch(dest_engine, dest_table, rows, unique_key, checkpoint, loader, report):
+    ''' load_rows, retrying batches that fail with connection-level errors.
+    Only safe because a batch commits with its checkpoint or not at all. '''
+    for attempt in range(BATCH_RETRIES + 1):
+        try:
+            return load_rows(dest_engine, dest_table, rows, unique_key, checkpoint, loader)
+        except OperationalError as e:
+            if attempt == BATCH_RETRIES:
+                raise
+
+            print "Batch of %d rows failed (%s), retrying..." % (len(rows), e.orig)
+            report['retried'] += len(rows)
+            time.sleep(RETRY_DELAY * (attempt + 1))
+
+
+def transform(host_engine, dest_engine, table_name, transformations, unique_key=None,
+              incremental_column=None, full_refresh=False, resume=False, staging=False, metrics_path=None,
+              csv_path=None):
+    ''' Copy `table_name` from the host database to the destination, running
+    each batch of rows through `transformations` in order. Transformations
+    marked with batch_transformation take and return a whole batch; plain
+    per-row functions get each row as a mutable Row and may return None to
+    drop it, and the two can be mixed. With `unique_key`, rows with
+    the same key are collapsed into the last one loaded (see load_rows).
+
+    With `incremental_column`, only rows past the high-water mark recorded
+    for the table by the previous run are copied, and the new mark is saved
+    once every batch is loaded. The mark is inclusive when upserting, so rows
+    sharing the last timestamp aren't missed. `full_refresh` copies every row
+    regardless and then records the mark.
+
+    With a single-column `unique_key`, rows are read in key order and each
+    batch commits together with a checkpoint of the last key it covers, so
+    `resume` can continue an interrupted run after its last committed batch.
+    Leading Rules in `transformations` run in the host database (see
+    push_down_rules). Batches are written with COPY on PostgreSQL and
+    executemany elsewhere (see loaders). With `staging`, every row is loaded
+    into <table>_staging and the destination is replaced with it in one
+    transaction at the end, which implies `full_refresh`. Returns a report of the rows read, skipped, retried,
+    filtered in the database (pushed_down) or here, and loaded.
+
+    Progress lines give the read rate and an ETA against a count of the
+    source rows taken first. At the end the time spent in each phase and
+    each transformation's time and dropped rows are printed and, with
+    `metrics_path`, appended there as a line of JSON (see TransformMetrics).
+
+    With `csv_path`, rows are read from that CSV or CSV.gz export instead of
+    `host_engine`, typed after the destination table (see CsvSource). Every
+    transformation then runs here, the high-water mark filters rows as they
+    are read, and there are no checkpoints to resume from; loading the same
+    file again upserts the same rows. '''
+    dest_table = Table(table_name, MetaData(), autoload=True, autoload_with=dest_engine)
+    if csv_path:
+        if resume:
+            raise ValueError('Only database sources can be resumed.')
+        host_table = dest_table
+    else:
+        host_table = Table(table_name, MetaData(), autoload=True, autoload_with=host_engine)
+
+    key_column = host_table.c[unique_key[0]] if unique_key and len(unique_key) == 1 else None
+    if resume and key_column is None:
+        raise ValueError('Resuming needs a single-column unique key to order batches by.')
+
+    report = dict(read=0, skipped=0, retried=0, pushed_down=0, filtered=0, loaded=0)
+    metrics = TransformMetrics(table_name)
+    last_key = None
+    new_mark = None
+
+    if csv_path:
+        columns, pushed_conditions, pushed_rules = None, [], []
+    else:
+        columns, pushed_conditions, pushed_rules, transformations = push_down_rules(host_table, transformations)
+    source_conditions = []
+    # Rows from a CSV file are filtered by the mark as they're read.
+    row_filter = None
+
+    mark_column = host_table.c[incremental_column] if incremental_column else None
+    if mark_column is not None and not (full_refresh or staging):
+        mark = read_high_water_mark(dest_engine, table_name, mark_column)
+        if mark is not None:
+            print "Fetching rows with %s from %s..." % (incremental_column, encode_mark(mark))
+            source_conditions.append(mark_column >= mark if unique_key else mark_column > mark)
+            if csv_path:
+                row_filter = lambda value: value is not None and (value >= mark if unique_key else value > mark)
+
+    if key_column is not None and not csv_path:
+        checkpoint = read_checkpoint(dest_engine, table_name)
+        if resume and checkpoint is not None and not checkpoint.completed and checkpoint.last_key is not None \
+                and checkpoint.key_column == key_column.name:
+            last_key = decode_mark(checkpoint.last_key, key_column)
+            report['skipped'] = checkpoint.rows_read
+            if mark_column is not None and checkpoint.high_water_mark is not None:
+                new_mark = decode_mark(checkpoint.high_water_mark, mark_column)
+
+            print "Resuming after %s %s..." % (key_column.name, checkpoint.last_key)
+            source_conditions.append(key_column > last_key)
+        elif resume:
+            print "No interrupted run to resume; starting from the beginning."
+
+    if pushed_rules:
+        print "Pushed down to the host database: %s" % ', '.join(repr(rule) for rule in pushed_rules)
+
+    if not csv_path:
+        # Count the source rows and, for each pushed-down condition, how many
+        # survive it and every condition before it.
+        conditions = [condition for rule, condition in pushed_conditions]
+        counts = [func.count()] + [func.sum(case([(and_(*conditions[:index + 1]), 1)], else_=0))
+                                   for index in range(len(conditions))]
+        with metrics.timed('count'):
+            counts = [count or 0 for count in host_engine.execute(
+                select(counts, and_(*source_conditions) if source_conditions else None, [host_table])).first()]
+
+        source_rows = counts[0]
+        dropped_by = dict((rule, before - after) for (rule, condition), before, after
+                          in zip(pushed_conditions, counts, counts[1:]))
+        for rule in pushed_rules:
+            metrics.record(metrics.add_transformation(rule, in_database=True), None,
+                           source_rows, source_rows - dropped_by.get(rule, 0))
+            source_rows -= dropped_by.get(rule, 0)
+        metrics.source_rows = source_rows
+
+        if pushed_conditions:
+            report['pushed_down'] = counts[0] - source_rows
+            print "Filtering in the database saved fetching %d of %d rows." % (report['pushed_down'], counts[0])
+
+        query = select([expression if expression is host_table.c[name] else expression.label(name)
+                        for name, expression in columns.iteritems()])
+        for condition in source_conditions + conditions:
+            query = query.where(condition)
+        if key_column is not None:
+            query = query.order_by(key_column)
+
+    def batch_checkpoint(completed):
+        if key_column is None or csv_path:
+            return None
+
+        rows_read = report['skipped'] + report['read']
+        return lambda connection: write_checkpoint(connection, table_name, key_column, last_key,
+                                                   rows_read, new_mark, completed)
+
+    target_table = dest_table
+    if staging:
+        target_table = prepare_staging(dest_engine, dest_table, keep_existing=last_key is not None)
+        print "Loading into %s..." % target_table.name
+    loader = loader_for(dest_engine, target_table)
+
+    with metrics.timed('fetch'):
+        if csv_path:
+            print "Reading %s..." % csv_path
+            results = CsvSource(csv_path, host_table)
+            if results.ignored:
+                print "Ignoring columns %s has no place for: %s" % (table_name, ', '.join(results.ignored))
+        else:
+            print "Fetching %d rows..." % metrics.source_rows
+            results = host_engine.execute(query)
 
     print "Beginning transformation..."
-    transformed_rows = []
-    for row in results:
-        if len(transformed_rows) % 10000 == 0:
-            print "Row #: ", len(transformed_rows)
+    names = results.keys()
+    transformations = [(metrics.add_transformation(f), as_batch_transformation(f)) for f in transformations]
+
+    def load_pending(rows, completed):
+        with metrics.timed('transform'):
+            batch = rows_to_batch(rows, names)
+            for stats, f in transformations:
+                rows_in = batch_length(batch)
+                started = time.time()
+                batch = f(batch)
+                metrics.record(stats, time.time() - started, rows_in, batch_length(batch))
+            report['filtered'] += len(rows) - batch_length(batch)
+            batch = batch_to_rows(batch)
 
-        if len(transformed_rows) % 50000 == 0:
+        with metrics.timed('load'):
+            report['loaded'] += load_batch(dest_engine, target_table, batch, unique_key,
+                                           batch_checkpoint(completed), loader, report)
+
+    def fetched_rows():
+        while True:
+            with metrics.timed('fetch'):
+                chunk = results.fetchmany(FETCH_SIZE)
+            if not chunk:
+                return
+            for row in chunk:
+                yield row
+
+    pending = []
+    for row in fetched_rows():
+        if row_filter is not None and not row_filter(row[incremental_column]):
+            report['skipped'] += 1
+            continue
+
+        key = row[key_column.name] if key_column is not None else None
+
+        # Only end a batch between keys, so a resumed run never splits one.
+        if len(pending) >= BATCH_SIZE and (key_column is None or key != last_key):
             print "Getting ready to insert..."
-            dest_table = Table(table_name, meta, autoload=True, autoload_with=dest_engine)  
-            dest_engine.execute(dest_table.insert(), transformed_rows)
+            load_pending(pending, False)
+            pending = []
+
+        report['read'] += 1
+        last_key = key
+        if report['read'] % FETCH_SIZE == 0:
+            print metrics.progress(report['read'])
+
+        if mark_column is not None:
+            value = row[incremental_column]
+            if value is not None and (new_mark is None or value > new_mark):
+                new_mark = value
 
-        new_row = row
-        
-        # Run all transformations, stopping if one returns None
-        for f in transformations:
-            new_row = f(new_row)
-            if new_row == None:
-                break
+        pending.append(row)
 
-        if new_row != None:
-            transformed_rows.append(new_row)
+    load_pending(pending, True)
 
+    if staging:
+        print "Replacing %s with %s..." % (dest_table.name, target_table.name)
+        publish_staging(dest_engine, dest_table, target_table)
 
+    if new_mark is not None:
+        save_high_water_mark(dest_engine, table_name, mark_column, new_mark)
 
+    print "Read %(read)d rows, skipped %(skipped)d already loaded, retried %(retried)d, " \
+          "filtered %(pushed_down)d in the database and %(filtered)d here, and loaded %(loaded)d." % report
+    metrics.report()
+    if metrics_path:
+        metrics.write(metrics_path, report)
+    return report
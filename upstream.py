@@ -0,0 +1,127 @@
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+
+def pooled_session(pool_size=10):
+    ''' A requests Session that keeps up to `pool_size` connections per host
+    alive between requests, instead of a new connection for every call. '''
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class LazySession(object):
+    ''' Stands in for pooled_session(), creating it on first use so that
+    importing this module doesn't import requests. '''
+
+    def __init__(self, pool_size=10):
+        self.pool_size = pool_size
+        self.session = None
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        with self.lock:
+            if self.session is None:
+                self.session = pooled_session(self.pool_size)
+
+        return getattr(self.session, name)
+
+
+def spreadsheets_client(credentials, timeout):
+    ''' A gdata SpreadsheetsClient authorized with `credentials` whose
+    connections, including the one that fetches its access token, give up
+    after `timeout` seconds without an answer. Without one, a hung read
+    would keep its WorkerPool thread forever. '''
+    from atom.http_core import ProxiedHttpClient
+    from gdata.gauth import OAuth2TokenFromCredentials
+    from gdata.spreadsheets.client import SpreadsheetsClient
+
+    class TimedHttpClient(ProxiedHttpClient):
+        def _get_connection(self, uri, headers=None):
+            connection = ProxiedHttpClient._get_connection(self, uri, headers)
+            connection.timeout = timeout
+            # Proxied HTTPS connections arrive already connected.
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+            return connection
+
+    class TimedToken(OAuth2TokenFromCredentials):
+        def _refresh(self, unused_request):
+            import httplib2
+            self.credentials._refresh(httplib2.Http(timeout=timeout).request)
+
+    client = SpreadsheetsClient(http_client=TimedHttpClient())
+    TimedToken(credentials).authorize(client)
+    return client
+
+
+class WorkerPool(object):
+    ''' A ThreadPool for running upstream calls in the background, created on
+    first use in each process since threads don't survive gunicorn forking
+    its workers. '''
+
+    def __init__(self, size):
+        self.size = size
+        self.pool = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def apply_async(self, f, *args):
+        with self.lock:
+            if self.pool is None or self.pid != os.getpid():
+                self.pool = ThreadPool(self.size)
+                self.pid = os.getpid()
+
+        return self.pool.apply_async(f, args)
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    ''' Stops calling an upstream once it has failed `threshold` times in a
+    row, so requests fail fast instead of each waiting out a timeout. After
+    `reset_after` seconds calls are let through again; one success closes
+    the circuit and one more failure opens it for another `reset_after`. '''
+
+    def __init__(self, name, threshold=3, reset_after=30):
+        self.name = name
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def is_open(self):
+        with self.lock:
+            return self.opened_at is not None and time.time() - self.opened_at < self.reset_after
+
+    def call(self, f, *args):
+        ''' `f(*args)`, or CircuitOpen without calling it while the circuit is open. '''
+        if self.is_open():
+            raise CircuitOpen('%s is unavailable.' % self.name)
+
+        try:
+            result = f(*args)
+        except Exception:
+            with self.lock:
+                self.failures += 1
+                if self.failures >= self.threshold:
+                    self.opened_at = time.time()
+            raise
+
+        self.reset()
+        return result
+
+    def reset(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None